@@ -0,0 +1,522 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import argparse
+import numpy as np
+import nltk
+import claim_tokenizer
+import claim_embedding
+
+##### Persistent cache of the tokenized and embedded claims #####
+# claims are keyed by a hash of their text and of the tokenizer version,
+# so the notebooks, the scripts and the webapp share the tokens and vectors
+# of the claims they have already seen, and a rerun only computes the claims
+# whose text, tokenizer or word2vec model changed
+#
+# tables of the sqlite file:
+#   tokens    dictionary token -> id (ids are never reused)
+#   claims    token ids of each claim (compressed int32 array)
+#   vectors   average word vector of each claim for each model
+#             (the model version is a hash of its vocabulary and vectors)
+#
+# when the vectors of a claim are missing for a model (new model), they are
+# computed from the cached token ids without tokenizing the claim again
+#
+# reading cached claims does not write to the file: the access times used by
+# the eviction are kept in memory and written every TOUCH_SECONDS (and before
+# an eviction), and the total size is kept in the totals table
+#
+# settings can be given by environment variables:
+# CLAIM_CACHE_DIR: folder of the cache file (PATENT_CACHE_DIR by default)
+# CLAIM_CACHE_MAX_MB: size limit of the cache
+# CLAIM_CACHE_DISABLE: set to 1 to always tokenize and embed
+
+
+# version of the cached tokens
+TOKENIZER_VERSION = 'claim_tokenizer-%d/nltk-%s' % (claim_tokenizer.VERSION, nltk.__version__)
+
+# number of keys in one sqlite query
+QUERY_SIZE = 500
+
+# missing claims are tokenized by a pool of processes above this number
+PARALLEL_MIN_TEXTS = 200
+
+# seconds between two writes of the access times of the cached claims
+TOUCH_SECONDS = 60
+
+
+### function to create the settings of a cache
+# input: folder of the cache file, size limit (bytes)
+# output: dictionary of settings used by the other functions
+def open_cache(directory=None, max_bytes=None):
+    env = os.environ
+    if directory is None:
+        directory = env.get('CLAIM_CACHE_DIR', env.get(
+            'PATENT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache',
+                                             'patent_evaluator')))
+    if max_bytes is None:
+        max_bytes = int(float(env.get('CLAIM_CACHE_MAX_MB', 1024)) * 2**20)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    cache = {
+        'path': os.path.join(directory, 'claims.sqlite'),
+        'max_bytes': max_bytes,
+        # dictionary of the tokens read by this process (token_ids, tokens
+        # and rows are shared by the threads and changed with the lock held)
+        'token_ids': {},
+        'tokens': [None],
+        # rows of the dictionary tokens in the vectors of the last model:
+        # (model version, array)
+        'rows': (None, np.zeros(0, dtype = np.int64)),
+        'counters': {'token_hits': 0, 'token_misses': 0,
+                     'vector_hits': 0, 'vector_misses': 0, 'evicted': 0},
+        # access times not written yet: claim key or (key, model) -> time
+        'touched': {'claims': {}, 'vectors': {}},
+        'touched_at': time.time(),
+        'lock': threading.Lock(),
+    }
+
+    con = _connect(cache)
+    with con:
+        con.execute("""CREATE TABLE IF NOT EXISTS tokens (
+                           token_id INTEGER PRIMARY KEY,
+                           token TEXT UNIQUE NOT NULL)""")
+        con.execute("""CREATE TABLE IF NOT EXISTS claims (
+                           key TEXT PRIMARY KEY,
+                           ids BLOB NOT NULL,
+                           size INTEGER NOT NULL,
+                           accessed_at REAL NOT NULL)""")
+        con.execute("""CREATE TABLE IF NOT EXISTS vectors (
+                           key TEXT NOT NULL,
+                           model TEXT NOT NULL,
+                           vector BLOB NOT NULL,
+                           size INTEGER NOT NULL,
+                           accessed_at REAL NOT NULL,
+                           PRIMARY KEY (key, model))""")
+        con.execute("""CREATE INDEX IF NOT EXISTS claims_accessed
+                           ON claims (accessed_at)""")
+        con.execute("""CREATE INDEX IF NOT EXISTS vectors_accessed
+                           ON vectors (accessed_at)""")
+        con.execute("""CREATE TABLE IF NOT EXISTS totals (
+                           name TEXT PRIMARY KEY,
+                           bytes INTEGER NOT NULL)""")
+        con.execute("""INSERT OR IGNORE INTO totals
+                           SELECT 'entries', (SELECT COALESCE(SUM(size), 0) FROM claims) +
+                                             (SELECT COALESCE(SUM(size), 0) FROM vectors)""")
+
+    return cache
+
+
+# cache used when none is given (created on first use)
+_default_cache = None
+
+
+### function to get the default cache
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = open_cache()
+    return _default_cache
+
+
+# connections of the current thread: path -> (process id, connection)
+_connections = threading.local()
+
+
+### function to get the connection of the current thread to the cache file
+# each thread of each process keeps one connection (a forked worker
+# opens its own)
+def _connect(cache):
+    connections = getattr(_connections, 'by_path', None)
+    if connections is None:
+        connections = _connections.by_path = {}
+    pid, con = connections.get(cache['path'], (None, None))
+    if pid != os.getpid():
+        con = sqlite3.connect(cache['path'], timeout = 30)
+        con.execute('PRAGMA journal_mode=WAL')
+        connections[cache['path']] = (os.getpid(), con)
+    return con
+
+
+### function to update the total size of the claims and vectors
+# must be called in the transaction that changes them
+def _add_bytes(con, delta):
+    con.execute("UPDATE totals SET bytes = bytes + ? WHERE name = 'entries'", (delta,))
+
+
+### function to read the total size of the claims and vectors
+def _total_bytes(con):
+    return con.execute("SELECT bytes FROM totals WHERE name = 'entries'").fetchone()[0]
+
+
+### function to insert new rows, adding the size of the inserted ones
+# rows already written by another process are left as they are
+# input: connection, insert query, rows (with the size at position size_index)
+def _insert(con, query, rows, size_index):
+    added = 0
+    for row in rows:
+        if con.execute(query, row).rowcount == 1:
+            added += row[size_index]
+    _add_bytes(con, added)
+
+
+### function to record the access to cached entries
+# input: cache, 'claims' or 'vectors', keys, time
+def _touch(cache, table, keys, now):
+    with cache['lock']:
+        touched = cache['touched'][table]
+        for key in keys:
+            touched[key] = now
+
+
+### function to write the access times recorded in memory
+# written every TOUCH_SECONDS, or now if force is set
+def _flush_touched(con, cache, force=False):
+    if not force and time.time() - cache['touched_at'] < TOUCH_SECONDS:
+        return
+    with cache['lock']:
+        touched = cache['touched']
+        cache['touched'] = {'claims': {}, 'vectors': {}}
+        cache['touched_at'] = time.time()
+    if not touched['claims'] and not touched['vectors']:
+        return
+    with con:
+        con.executemany('UPDATE claims SET accessed_at = ? WHERE key = ?',
+                        [(now, key) for key, now in touched['claims'].items()])
+        con.executemany('UPDATE vectors SET accessed_at = ? WHERE key = ? AND model = ?',
+                        [(now, key, model) for (key, model), now
+                         in touched['vectors'].items()])
+
+
+### function to compute the key of a claim text
+def text_key(text):
+    if text is None:
+        text = u''
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1(TOKENIZER_VERSION + '\0' + text).hexdigest()
+
+
+# (model, version) of the last model hashed, replaced by one assignment so
+# a thread never reads the version of another model
+_model_version = (None, None)
+
+
+### function to compute the version of a word2vec model
+# two models have the same version only if they have the same tokens
+# in the same rows and the same vectors
+# input: gensim model or vectors loaded by word_vectors.load_vectors
+# output: hexadecimal string
+def model_version(model):
+    global _model_version
+    last_model, last_version = _model_version
+    if last_model is model:
+        return last_version
+
+    vocab, vectors, scales = claim_embedding.model_lookup(model)
+    tokens = [None] * len(vocab)
+    for token, row in vocab.items():
+        tokens[row] = token
+
+    digest = hashlib.sha1(u'\n'.join(tokens).encode('utf-8'))
+    digest.update(str(vectors.dtype) + str(vectors.shape))
+    digest.update(np.ascontiguousarray(vectors).view(np.uint8))
+    if scales is not None:
+        digest.update(np.ascontiguousarray(scales).view(np.uint8))
+    version = digest.hexdigest()[:20]
+
+    _model_version = (model, version)
+    return version
+
+
+### function to read the rows of many keys
+# input: connection, query with a '%s' for the list of keys,
+#        parameters before the keys, keys
+# output: list of rows
+def _select(con, query, params, keys):
+    rows = []
+    for first in range(0, len(keys), QUERY_SIZE):
+        chunk = keys[first:first + QUERY_SIZE]
+        rows.extend(con.execute(query % ','.join('?' * len(chunk)),
+                                list(params) + chunk).fetchall())
+    return rows
+
+
+### function to read the tokens added to the dictionary by any process
+# the tokens are written at their id, with the lock held, so two threads
+# reading the same new tokens do not shift the ids of the later ones
+def _sync_dictionary(con, cache):
+    with cache['lock']:
+        tokens = cache['tokens']
+        for token_id, token in con.execute(
+                'SELECT token_id, token FROM tokens WHERE token_id >= ? ORDER BY token_id',
+                (len(tokens),)):
+            # ids start at 1 and are never removed
+            if token_id >= len(tokens):
+                tokens.extend([None] * (token_id + 1 - len(tokens)))
+            tokens[token_id] = token
+            cache['token_ids'][token] = token_id
+
+
+### function to tokenize the claims missing from the cache
+def _tokenize(texts, tokenizer, processes):
+    texts = [text if text is not None else u'' for text in texts]
+    if tokenizer is not None:
+        return [tokenizer(text) for text in texts]
+    if processes is None and len(texts) < PARALLEL_MIN_TEXTS:
+        processes = 1
+    return claim_tokenizer.tokenize_many(texts, processes)
+
+
+### function to read the token ids of claims, tokenizing the missing ones
+# input: connection, cache, texts, tokenizer function, processes
+# output: list of int32 arrays of dictionary ids
+def _token_ids(con, cache, texts, tokenizer=None, processes=None):
+    keys = [text_key(text) for text in texts]
+    unique = list(set(keys))
+    found = dict((key, np.frombuffer(zlib.decompress(bytes(ids)), dtype = np.int32))
+                 for key, ids in _select(con, 'SELECT key, ids FROM claims WHERE key IN (%s)',
+                                         [], unique))
+    now = time.time()
+
+    missing = [key for key in unique if key not in found]
+    cache['counters']['token_hits'] += len(unique) - len(missing)
+    cache['counters']['token_misses'] += len(missing)
+    if missing:
+        first_text = dict(zip(keys, texts))
+        token_lists = _tokenize([first_text[key] for key in missing], tokenizer, processes)
+
+        # add the new tokens to the dictionary
+        new_tokens = set(token for tokens in token_lists for token in tokens
+                         if token not in cache['token_ids'])
+        with con:
+            if new_tokens:
+                con.executemany('INSERT OR IGNORE INTO tokens (token) VALUES (?)',
+                                [(token,) for token in new_tokens])
+            _sync_dictionary(con, cache)
+            rows = []
+            for key, tokens in zip(missing, token_lists):
+                ids = np.array([cache['token_ids'][token] for token in tokens], dtype = np.int32)
+                data = zlib.compress(ids.tobytes(), 6)
+                rows.append((key, sqlite3.Binary(data), len(data), now))
+                found[key] = ids
+            _insert(con, 'INSERT OR IGNORE INTO claims VALUES (?, ?, ?, ?)', rows, 2)
+
+    if len(unique) > len(missing):
+        _touch(cache, 'claims', [key for key in unique if key not in missing], now)
+
+    return [found[key] for key in keys]
+
+
+### function to map dictionary ids to rows of the vectors of a model
+# output: array (dictionary id -> row, -1 for tokens missing from the model)
+def _model_rows(cache, model, version):
+    with cache['lock']:
+        memo_version, rows = cache['rows']
+        if memo_version != version:
+            rows = np.zeros(0, dtype = np.int64)
+
+        tokens = cache['tokens']
+        if len(rows) < len(tokens):
+            # map the tokens added since the last call
+            vocab = claim_embedding.model_lookup(model)[0]
+            get = vocab.get
+            added = np.fromiter((get(token, -1) if token is not None else -1
+                                 for token in tokens[len(rows):]),
+                                dtype = np.int64, count = len(tokens) - len(rows))
+            rows = np.concatenate([rows, added])
+        cache['rows'] = (version, rows)
+    return rows
+
+
+### function to tokenize many claims through the cache
+# input: list of claim texts, cache, tokenizer function for the missing claims
+#        (claim_tokenizer.tokenize_many by default), number of processes
+# output: list of token lists in the same order as the texts
+def tokenize(texts, cache=None, tokenizer=None, processes=None):
+    if os.environ.get('CLAIM_CACHE_DISABLE') == '1':
+        return _tokenize(texts, tokenizer, processes)
+
+    cache = cache or default_cache()
+    con = _connect(cache)
+    ids_list = _token_ids(con, cache, texts, tokenizer, processes)
+    if any(len(ids) and ids.max() >= len(cache['tokens']) for ids in ids_list):
+        _sync_dictionary(con, cache)
+    _evict(con, cache)
+
+    tokens = cache['tokens']
+    return [[tokens[token_id] for token_id in ids] for ids in ids_list]
+
+
+### function to compute the average word vectors of many claims through the cache
+# input: list of claim texts, word2vec model (see claim_embedding.model_lookup),
+#        cache, tokenizer function for the missing claims, number of processes
+# output: float32 array of size (number of texts, dim), the same vectors
+#         as claim_embedding.embed_documents of the tokens
+def embed(texts, model, cache=None, tokenizer=None, processes=None):
+    if os.environ.get('CLAIM_CACHE_DISABLE') == '1':
+        return claim_embedding.embed_documents(model, _tokenize(texts, tokenizer, processes))
+
+    cache = cache or default_cache()
+    version = model_version(model)
+    dim = claim_embedding.model_lookup(model)[1].shape[1]
+    keys = [text_key(text) for text in texts]
+    unique = list(set(keys))
+
+    con = _connect(cache)
+    found = dict((key, np.frombuffer(bytes(vector), dtype = np.float32))
+                 for key, vector in _select(
+                     con, 'SELECT key, vector FROM vectors WHERE model = ? AND key IN (%s)',
+                     [version], unique))
+    now = time.time()
+
+    missing = [key for key in unique if key not in found]
+    cache['counters']['vector_hits'] += len(unique) - len(missing)
+    cache['counters']['vector_misses'] += len(missing)
+    if missing:
+        first_text = dict(zip(keys, texts))
+        ids_list = _token_ids(con, cache, [first_text[key] for key in missing],
+                              tokenizer, processes)
+        if any(len(ids) and ids.max() >= len(cache['tokens']) for ids in ids_list):
+            # ids written by another process
+            _sync_dictionary(con, cache)
+
+        # dictionary ids -> rows of the model, unknown tokens dropped
+        rows = _model_rows(cache, model, version)
+        indices_list = []
+        for ids in ids_list:
+            indices = rows[ids]
+            indices_list.append(indices[indices >= 0])
+        vocab, vectors, scales = claim_embedding.model_lookup(model)
+        means = claim_embedding.average_indices(indices_list, vectors, scales)
+
+        with con:
+            _insert(con, 'INSERT OR IGNORE INTO vectors VALUES (?, ?, ?, ?, ?)',
+                    [(key, version, sqlite3.Binary(mean.tobytes()), mean.nbytes, now)
+                     for key, mean in zip(missing, means)], 3)
+        found.update(zip(missing, means))
+
+    if len(unique) > len(missing):
+        _touch(cache, 'vectors', [(key, version) for key in unique if key not in missing], now)
+    _evict(con, cache)
+
+    output = np.zeros((len(texts), dim), dtype = np.float32)
+    for i, key in enumerate(keys):
+        output[i] = found[key]
+    return output
+
+
+### function to remove the least recently used entries over the size limit
+# the cache is reduced to 90% of the limit so eviction does not run each time
+def _evict(con, cache):
+    total = _total_bytes(con)
+    if total <= cache['max_bytes']:
+        _flush_touched(con, cache)
+        return
+
+    # the recent accesses decide what is evicted
+    _flush_touched(con, cache, force = True)
+    target = 0.9 * cache['max_bytes']
+    rows = con.execute("""SELECT 'claims', key, '', size, accessed_at FROM claims
+                          UNION ALL
+                          SELECT 'vectors', key, model, size, accessed_at FROM vectors
+                          ORDER BY accessed_at""")
+    evicted = []
+    selected = 0
+    for table, key, model, size, accessed_at in rows:
+        if total - selected <= target:
+            break
+        evicted.append((table, key, model, size))
+        selected += size
+    with con:
+        # only the entries deleted here are subtracted (another process
+        # evicting at the same time deletes and subtracts the others)
+        freed = deleted = 0
+        for table, key, model, size in evicted:
+            if table == 'claims':
+                cursor = con.execute('DELETE FROM claims WHERE key = ?', (key,))
+            else:
+                cursor = con.execute('DELETE FROM vectors WHERE key = ? AND model = ?',
+                                     (key, model))
+            if cursor.rowcount == 1:
+                freed += size
+                deleted += 1
+        _add_bytes(con, -freed)
+    cache['counters']['evicted'] += deleted
+
+
+### function to remove the vectors of the models no longer used
+# input: versions of the models to keep, cache
+# output: number of vectors removed
+def purge_models(keep, cache=None):
+    cache = cache or default_cache()
+    keep = list(keep)
+    condition = 'model NOT IN (%s)' % ','.join('?' * len(keep))
+    con = _connect(cache)
+    with con:
+        # the size is read by the first write of the transaction
+        con.execute("""UPDATE totals SET bytes = bytes -
+                           (SELECT COALESCE(SUM(size), 0) FROM vectors WHERE %s)
+                       WHERE name = 'entries'""" % condition, keep)
+        deleted = con.execute('DELETE FROM vectors WHERE ' + condition, keep).rowcount
+
+    return deleted
+
+
+### function to report the content of the cache and the counters of this process
+# output: dictionary with the number of claims, of vectors per model,
+#         of dictionary tokens, the size and the hit and miss counters
+def stats(cache=None):
+    cache = cache or default_cache()
+    con = _connect(cache)
+    claims = con.execute('SELECT COUNT(*) FROM claims').fetchone()[0]
+    models = dict(con.execute('SELECT model, COUNT(*) FROM vectors GROUP BY model'))
+    tokens = con.execute('SELECT COUNT(*) FROM tokens').fetchone()[0]
+
+    report = {'path': cache['path'], 'tokenizer': TOKENIZER_VERSION,
+              'claims': claims, 'vectors': models, 'dictionary_tokens': tokens,
+              'bytes': _total_bytes(con), 'max_bytes': cache['max_bytes']}
+    report.update(cache['counters'])
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description = 'Report on or fill the claim cache')
+    parser.add_argument('command', choices = ['stats', 'fill', 'purge'])
+    parser.add_argument('--store', help = 'feature store with the claims (fill)')
+    parser.add_argument('--years', type = int, nargs = '+', default = None)
+    parser.add_argument('--word2vec', default = 'models/word2vec_claims_final',
+                        help = 'model whose vectors are filled or kept')
+    parser.add_argument('--processes', type = int, default = None)
+    args = parser.parse_args(argv)
+
+    if args.command in ('fill', 'purge'):
+        from gensim.models import Word2Vec
+        model = Word2Vec.load(args.word2vec)
+
+    if args.command == 'fill':
+        import feature_store
+        for year in (args.years or feature_store.years(args.store)):
+            texts = feature_store.read(args.store, ['claims'], [year], mmap = None)['claims'].values
+            start = time.time()
+            embed(list(texts), model, processes = args.processes)
+            sys.stderr.write('%d: %d claims in %.1fs\n' % (year, len(texts), time.time() - start))
+    elif args.command == 'purge':
+        removed = purge_models([model_version(model)])
+        sys.stderr.write('removed %d vectors of other models\n' % removed)
+
+    report = stats()
+    for name in sorted(report):
+        print('%s: %s' % (name, report[name]))
+
+
+if __name__ == '__main__':
+    main()
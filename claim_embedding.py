@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+##### Average word2vec vectors of many tokenized texts at once #####
+# tokens are mapped to rows of the vector matrix in bulk,
+# the rows of all the texts are gathered in one operation
+# and averaged per text by a segment reduction
+
+
+# lookup tables of the last model used (building them takes a while):
+# (model, vocab, vectors, scales), replaced by one assignment so a thread
+# never reads the tables of another model
+_lookup = (None, None, None, None)
+
+
+### function to read the vocabulary and vector matrix of a word2vec model
+# input: trained gensim word2vec model (or its KeyedVectors),
+#        or vectors loaded by word_vectors.load_vectors
+# output: dictionary token -> row, matrix of size (vocabulary, dim),
+#         scale of each row for int8 matrices (None otherwise)
+def model_lookup(model):
+    global _lookup
+    lookup = _lookup
+    if lookup[0] is model:
+        return lookup[1:]
+
+    if isinstance(model, dict):
+        # exported vectors: already in the right layout
+        return model['vocab'], model['vectors'], model.get('scales')
+
+    wv = getattr(model, 'wv', model)
+    vectors = getattr(wv, 'vectors', None)
+    if vectors is None:
+        # older gensim versions
+        vectors = wv.syn0
+    vocab = dict((token, item.index) for token, item in wv.vocab.items())
+    vectors = np.asarray(vectors, dtype = np.float32)
+
+    _lookup = (model, vocab, vectors, None)
+
+    return vocab, vectors, None
+
+
+### function to map tokens to rows of the vector matrix
+# tokens missing from the vocabulary are dropped
+# input: list of tokens, dictionary token -> row
+# output: int32 array of rows
+def tokens_to_indices(tokens, vocab):
+    get = vocab.get
+    indices = [get(token, -1) for token in tokens]
+    indices = np.fromiter(indices, dtype = np.int32, count = len(indices))
+
+    return indices[indices >= 0]
+
+
+### function to average the word vectors of many texts
+# input: list of index arrays (one per text), matrix of vectors
+#        (float32, float16 or int8), scale of each row for int8 matrices
+# output: float32 array of size (number of texts, dim)
+#         texts without any known token get a zero vector
+def average_indices(indices_list, vectors, scales=None):
+    n_docs = len(indices_list)
+    dim = vectors.shape[1]
+    means = np.zeros((n_docs, dim), dtype = np.float32)
+
+    lengths = np.fromiter((len(indices) for indices in indices_list),
+                          dtype = np.int64, count = n_docs)
+    non_empty = np.flatnonzero(lengths)
+    if len(non_empty) == 0:
+        return means
+
+    # gather the rows of all the texts in one operation
+    all_indices = np.concatenate([indices_list[i] for i in non_empty])
+    gathered = vectors[all_indices]
+    if scales is not None:
+        gathered = gathered * scales[all_indices, None]
+
+    # sum each text's rows (segments start at the cumulative lengths)
+    starts = np.concatenate([[0], np.cumsum(lengths[non_empty])[:-1]])
+    sums = np.add.reduceat(gathered, starts, axis = 0, dtype = np.float64)
+    means[non_empty] = sums / lengths[non_empty, None]
+
+    return means
+
+
+### function to compute the average word vector of many tokenized texts
+# input: word2vec model, list of token lists
+# output: float32 array of size (number of texts, dim)
+def embed_documents(model, texts):
+    vocab, vectors, scales = model_lookup(model)
+    indices_list = [tokens_to_indices(tokens, vocab) for tokens in texts]
+
+    return average_indices(indices_list, vectors, scales)
+
+
+### function to compute the average word vector of one tokenized text
+# output: float32 array of size (1, dim)
+def embed_document(model, text):
+    return embed_documents(model, [text])
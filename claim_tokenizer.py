@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import re
+import sys
+import time
+import string
+import multiprocessing
+from nltk import word_tokenize
+from nltk.corpus import stopwords
+from nltk.stem.wordnet import WordNetLemmatizer
+
+##### Tokenize and clean claim text for the word2vec model #####
+# same output as the original tokenize_cleaning, but the stop list,
+# lemmatizer and number pattern are built once per process
+# and lemmas of frequent words are memoized
+
+
+# version of the tokens produced (change it when the output of
+# tokenize_cleaning changes, cached tokens of other versions are not used)
+VERSION = 1
+
+# maximum number of memoized lemmas (the memo is reset when it is full)
+LEMMA_CACHE_SIZE = 200000
+
+# tokens accepted by float() (numbers are removed from the tokens)
+NUMBER_PATTERN = re.compile(r'^[+-]?(?:\d+\.?\d*|\.\d+)(?:e[+-]?\d+)?$'
+                            r'|^[+-]?(?:inf|infinity|nan)$',
+                            re.IGNORECASE | re.UNICODE)
+
+# resources shared by all calls (built on first use)
+_resources = {'stop_set': None, 'lemmatize': None}
+_lemma_cache = {}
+
+
+### function to build the stop list and the lemmatizer once
+def _init():
+    if _resources['stop_set'] is None:
+        # stop words and punctuations
+        _resources['stop_set'] = frozenset(stopwords.words('english') +
+                                           list(string.punctuation))
+        _resources['lemmatize'] = WordNetLemmatizer().lemmatize
+    return _resources['stop_set'], _resources['lemmatize']
+
+
+### function to read the lemma of a token (memoized)
+def _lemma(token, lemmatize):
+    lemma = _lemma_cache.get(token)
+    if lemma is None:
+        if len(_lemma_cache) >= LEMMA_CACHE_SIZE:
+            _lemma_cache.clear()
+        lemma = lemmatize(token)
+        _lemma_cache[token] = lemma
+    return lemma
+
+
+### function to tokenize and clean a text
+# input: a string of text
+# output: list of tokens (cleaned words) extracted from the text
+# the function lowercases all words, eliminates English stop words,
+# turns words into lemma and removes numbers
+def tokenize_cleaning(text):
+    stop_set, lemmatize = _init()
+
+    # tokenize the text first
+    try:
+        tokens = word_tokenize(text.decode('utf-8'))
+    except:
+        tokens = word_tokenize(text)
+
+    # lowercase, remove stop words and punctuations, use lemma,
+    # and remove numbers (the actual values are not useful)
+    match_number = NUMBER_PATTERN.match
+    tokens_clean = []
+    for token in tokens:
+        token = token.lower()
+        if token in stop_set:
+            continue
+        token = _lemma(token, lemmatize)
+        if match_number(token) is None:
+            tokens_clean.append(token)
+
+    return tokens_clean
+
+
+### function to tokenize many texts
+# input: list of texts, number of processes (number of cores by default,
+#        1 to run in this process), number of texts sent to a process at once
+# output: list of token lists in the same order as the texts
+def tokenize_many(texts, processes=None, chunksize=100):
+    if processes == 1:
+        return [tokenize_cleaning(text) for text in texts]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(tokenize_cleaning, texts, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+### original implementation of tokenize_cleaning (used by the benchmark)
+def _reference_tokenize_cleaning(text):
+    try:
+        tokens = word_tokenize(text.decode('utf-8'))
+    except:
+        tokens = word_tokenize(text)
+    tokens = [w.lower() for w in tokens]
+    stop_list = stopwords.words('english') + list(string.punctuation)
+    tokens_no_stop = [token for token in tokens if token not in stop_list]
+    lemmatizer = WordNetLemmatizer()
+    tokens_lemma = [lemmatizer.lemmatize(token) for token in tokens_no_stop]
+    tokens_no_num = []
+    for token in tokens_lemma:
+        try:
+            float(token)
+        except:
+            tokens_no_num.append(token)
+    return tokens_no_num
+
+
+### function to compare the speed with the original implementation
+# input: list of texts, number of processes of the batch mode
+# output: dictionary with texts per second of each method
+def benchmark(texts, processes=None):
+    results = {}
+
+    start = time.time()
+    reference = [_reference_tokenize_cleaning(text) for text in texts]
+    results['original'] = len(texts) / (time.time() - start)
+
+    _lemma_cache.clear()
+    start = time.time()
+    tokens = [tokenize_cleaning(text) for text in texts]
+    results['cached'] = len(texts) / (time.time() - start)
+
+    start = time.time()
+    tokenize_many(texts, processes)
+    results['multiprocess'] = len(texts) / (time.time() - start)
+
+    results['same_output'] = tokens == reference
+
+    return results
+
+
+if __name__ == '__main__':
+    # usage: python claim_tokenizer.py patent_data/patents_2004.p [n_texts]
+    import pandas as pd
+    claims = pd.read_pickle(sys.argv[1])['claims'].dropna().values
+    if len(sys.argv) > 2:
+        claims = claims[:int(sys.argv[2])]
+
+    results = benchmark(list(claims))
+    for name in ['original', 'cached', 'multiprocess']:
+        print('%s: %.1f texts/s' % (name, results[name]))
+    print('same output: %s' % results['same_output'])
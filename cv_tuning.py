@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import json
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+
+##### Cross validated tuning of the random forest on the net value #####
+# the models are chosen on the net value of the investment: each patent
+# predicted useful is applied for (PATENT_COST) and each useful patent
+# applied for brings USEFUL_VALUE
+#
+# compared with GridSearchCV in the notebooks:
+# - the folds and the standardized float32 features are computed once,
+#   and the training rows of each fold are copied once
+# - the fits of all the (grid point, fold) pairs run on all the cores
+# - n_estimators is not a grid dimension: each forest grows with warm_start
+#   through the n_estimators values (25, 50, 100, ... trees are fitted once)
+# - the validation probabilities are kept, so the net value is computed for
+#   many probability thresholds at once (sorted probabilities, cumulative sums)
+
+
+# price of applying for a patent, value of a useful patent (thousand dollars)
+PATENT_COST = 20
+USEFUL_VALUE = 30
+
+# default grid (combined_nontext_word2vec.ipynb)
+MAX_FEATURES = [2, 4, 6, 8, 10, 12, 14]
+MAX_DEPTH = [2, 4, 6, 8, 10, 12, 14]
+N_ESTIMATORS = [25, 50, 100, 200]
+THRESHOLDS = np.round(np.arange(0.3, 0.71, 0.01), 2)
+
+
+### function to compute the net value of predictions (my_loss_func of the notebooks)
+def net_value(y_actual, y_pred):
+    total_cost = np.sum(y_pred == 1) * PATENT_COST
+    total_value = np.sum((y_actual == 1) & (y_pred == 1)) * USEFUL_VALUE
+    return total_value - total_cost
+
+
+### function to compute the net value for many thresholds at once
+# a patent is predicted useful if its probability is above the threshold
+# (threshold 0.5 gives the predictions of predict())
+# input: labels, probabilities of the useful class, thresholds
+# output: net value for each threshold
+def net_value_curve(y_actual, proba, thresholds=THRESHOLDS):
+    order = np.argsort(proba, kind = 'mergesort')
+    sorted_proba = proba[order]
+    # useful patents among the first k patents by increasing probability
+    useful_below = np.concatenate([[0], np.cumsum(y_actual[order] == 1)])
+
+    # patents above each threshold
+    first_above = np.searchsorted(sorted_proba, thresholds, side = 'right')
+    n_applied = len(proba) - first_above
+    n_useful = useful_below[-1] - useful_below[first_above]
+
+    return n_useful * USEFUL_VALUE - n_applied * PATENT_COST
+
+
+### function to split and subsample the data like the notebooks
+# testing set of test_size patents, then the same number of useful and
+# not useful patents in the training set
+# input: predictors, labels, size of the testing set, random seed of the split,
+#        random seed of the subsampling
+# output: training predictors and labels, testing predictors and labels
+def balanced_split(x_data, y_data, test_size=2000, seed=123, sample_seed=0):
+    from sklearn.model_selection import train_test_split
+
+    x_train, x_test, y_train, y_test = train_test_split(x_data, y_data,
+                                                        test_size = test_size,
+                                                        random_state = seed)
+    rng = np.random.RandomState(sample_seed)
+    useful = rng.permutation(np.flatnonzero(y_train == 1))
+    not_useful = np.flatnonzero(y_train == 0)
+    rows = rng.permutation(np.concatenate([useful[:len(not_useful)], not_useful]))
+
+    return x_train[rows], y_train[rows], x_test, y_test
+
+
+### function to compute the folds and features shared by all the fits
+# input: training predictors and labels, number of folds, standardize
+#        the predictors (the scaler is fitted on all the training rows,
+#        like the notebooks)
+# output: dictionary with the scaler, the float32 features of each fold
+#         (training rows, validation rows) and the labels
+def prepare(x_train, y_train, n_splits=5, standardize=True):
+    from sklearn import preprocessing
+    from sklearn.model_selection import StratifiedKFold
+
+    scaler = None
+    x_std = np.asarray(x_train, dtype = np.float64)
+    if standardize:
+        scaler = preprocessing.StandardScaler()
+        x_std = scaler.fit_transform(x_std)
+    # the trees are fitted on float32 (sklearn converts X at every fit otherwise)
+    x_std = np.ascontiguousarray(x_std, dtype = np.float32)
+    y_train = np.asarray(y_train)
+
+    folds = []
+    # same folds as GridSearchCV(cv = n_splits) for a classifier
+    for train_rows, val_rows in StratifiedKFold(n_splits).split(x_std, y_train):
+        folds.append({'x_train': x_std[train_rows], 'y_train': y_train[train_rows],
+                      'x_val': x_std[val_rows], 'y_val': y_train[val_rows]})
+
+    return {'scaler': scaler, 'x': x_std, 'y': y_train, 'folds': folds}
+
+
+### function to fit one grid point on one fold
+# the forest grows through the n_estimators values with warm_start
+# input: parameters of the forest, fold, n_estimators values, random seed
+# output: dictionary n_estimators -> validation probabilities of the useful class
+def _fit_fold(params, fold, n_estimators, seed):
+    from sklearn.ensemble import RandomForestClassifier
+
+    forest = RandomForestClassifier(warm_start = True, n_jobs = 1,
+                                    random_state = seed, **params)
+    probas = {}
+    for n in sorted(n_estimators):
+        forest.set_params(n_estimators = n)
+        forest.fit(fold['x_train'], fold['y_train'])
+        probas[n] = forest.predict_proba(fold['x_val'])[:, 1]
+    return probas
+
+
+### function to tune the random forest
+# input: prepared folds (see prepare), grid {parameter: values}, n_estimators
+#        values, thresholds, number of processes (-1: all the cores), random seed
+# output: DataFrame with one row per grid point, n_estimators and threshold:
+#         mean and standard deviation of the net value over the folds
+def tune(prepared, grid=None, n_estimators=N_ESTIMATORS, thresholds=THRESHOLDS,
+         n_jobs=-1, seed=0):
+    from sklearn.externals.joblib import Parallel, delayed
+
+    grid = grid or {'max_features': MAX_FEATURES, 'max_depth': MAX_DEPTH}
+    names = sorted(grid)
+    points = [dict(zip(names, values))
+              for values in itertools.product(*[grid[name] for name in names])]
+    folds = prepared['folds']
+    tasks = [(i, j) for i in range(len(points)) for j in range(len(folds))]
+
+    probas = Parallel(n_jobs = n_jobs)(
+        delayed(_fit_fold)(points[i], folds[j], n_estimators, seed) for i, j in tasks)
+
+    # net value of each fold, for all the thresholds at once
+    values = {}
+    for (i, j), fold_probas in zip(tasks, probas):
+        for n, proba in fold_probas.items():
+            values.setdefault((i, n), []).append(
+                net_value_curve(folds[j]['y_val'], proba, thresholds))
+
+    rows = []
+    for (i, n), curves in sorted(values.items()):
+        curves = np.asarray(curves)
+        for threshold, mean, std in zip(thresholds, curves.mean(axis = 0),
+                                        curves.std(axis = 0)):
+            row = dict(points[i])
+            row.update({'n_estimators': n, 'threshold': threshold,
+                        'net_value': mean, 'net_value_std': std})
+            rows.append(row)
+
+    return pd.DataFrame(rows, columns = names + ['n_estimators', 'threshold',
+                                                 'net_value', 'net_value_std'])
+
+
+### function to run the tuning of the notebooks (GridSearchCV) on the same data
+# one grid search per n_estimators value, as the notebooks would need
+# input: prepared folds, grid, n_estimators values, number of processes
+# output: DataFrame with the mean net value (threshold 0.5) of each grid point
+def notebook_grid_search(prepared, grid=None, n_estimators=N_ESTIMATORS, n_jobs=4):
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.model_selection import GridSearchCV
+    from sklearn.metrics.scorer import make_scorer
+
+    grid = grid or {'max_features': MAX_FEATURES, 'max_depth': MAX_DEPTH}
+    scorer = make_scorer(net_value, greater_is_better = True)
+    # the notebooks pass the standardized float64 matrix
+    x = prepared['x'].astype(np.float64)
+
+    results = []
+    for n in n_estimators:
+        grid_model = GridSearchCV(RandomForestClassifier(n_estimators = n), n_jobs = n_jobs,
+                                  param_grid = grid, cv = len(prepared['folds']),
+                                  scoring = scorer)
+        grid_model.fit(x, prepared['y'])
+        result = pd.DataFrame(list(grid_model.cv_results_['params']))
+        result['n_estimators'] = n
+        result['net_value'] = grid_model.cv_results_['mean_test_score']
+        results.append(result)
+
+    return pd.concat(results, ignore_index = True)
+
+
+### function to load the training data of the notebooks
+# input: pickled non-text features, optional .npy matrix of claim vectors
+#        (same rows as the features, for the combined model)
+# output: predictors, labels (payment_times >= 2)
+def load_data(features_path, vectors_path=None):
+    patents = pd.read_pickle(features_path)
+    x_data = patents.drop([column for column in ['id', 'title', 'payment_times',
+                                                 'publication_year']
+                           if column in patents.columns], axis = 1).values
+    if vectors_path:
+        x_data = np.concatenate([x_data, np.load(vectors_path)], axis = 1)
+    y_data = (patents['payment_times'].values >= 2).astype(np.float64)
+
+    return x_data.astype(np.float64), y_data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description = 'Tune the random forest on the cross validated net value')
+    parser.add_argument('--features', default = os.path.join('patent_data', 'nontext_features.p'))
+    parser.add_argument('--vectors', default = None,
+                        help = '.npy claim vectors in the rows of the features')
+    parser.add_argument('--max-features', type = int, nargs = '+', default = MAX_FEATURES)
+    parser.add_argument('--max-depth', type = int, nargs = '+', default = MAX_DEPTH)
+    parser.add_argument('--n-estimators', type = int, nargs = '+', default = N_ESTIMATORS)
+    parser.add_argument('--folds', type = int, default = 5)
+    parser.add_argument('--jobs', type = int, default = -1)
+    parser.add_argument('--compare', action = 'store_true',
+                        help = 'also time the GridSearchCV of the notebooks')
+    parser.add_argument('-o', '--output', help = 'csv file of the results')
+    args = parser.parse_args(argv)
+
+    x_data, y_data = load_data(args.features, args.vectors)
+    x_train, y_train, x_test, y_test = balanced_split(x_data, y_data)
+    # features with fewer columns than the grid allows
+    max_features = [m for m in args.max_features if m <= x_train.shape[1]]
+    grid = {'max_features': max_features, 'max_depth': args.max_depth}
+
+    report = {}
+    start = time.time()
+    prepared = prepare(x_train, y_train, args.folds)
+    results = tune(prepared, grid, args.n_estimators, n_jobs = args.jobs)
+    report['engine_seconds'] = time.time() - start
+
+    best = results.loc[results['net_value'].idxmax()]
+    default = results[results['threshold'] == 0.5]
+    best_default = default.loc[default['net_value'].idxmax()]
+    report['best'] = dict((key, float(value)) for key, value in best.items())
+    report['best_threshold_0.5'] = dict((key, float(value))
+                                        for key, value in best_default.items())
+
+    if args.compare:
+        start = time.time()
+        notebook = notebook_grid_search(prepared, grid, args.n_estimators)
+        report['notebook_seconds'] = time.time() - start
+        report['notebook_best_net_value'] = float(notebook['net_value'].max())
+        report['speedup'] = report['notebook_seconds'] / report['engine_seconds']
+
+    if args.output:
+        results.to_csv(args.output, index = False)
+    print(json.dumps(report, indent = 1, sort_keys = True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import argparse
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+##### Non-text features of the patents #####
+# the 13 non-text predictors (7 one-hot classes, 6 counts) are built here
+# from columnar raw records, with one vectorized operation per column,
+# for the training data (cleaning_nontext.ipynb), the patent pages of the
+# webapp (/output) and the manual inputs (/output_manual)
+#
+# the columns of a raw record are the columns of the scraped DataFrames
+# (scrape_engine.add_record_columns): classification, the 6 counts of
+# NONTEXT_COLUMNS ('num_authors' can be replaced by 'inventor/author')
+# and 'publication date'
+
+
+# classes of the one-hot encoding (class A is the baseline)
+CLASSES = ['B', 'C', 'D', 'E', 'F', 'G', 'H']
+# counts, in the order of the predictors
+NONTEXT_COLUMNS = ['num_applications', 'num_patent_citations',
+                   'num_nonpatent_citations', 'num_claims',
+                   'num_similar_doc', 'num_authors']
+# names of the counts in the PatentRecord of page_extractor
+RECORD_FIELDS = ['num_applications', 'patent_citations', 'non_patent_citations',
+                 'num_claims', 'similar_doc_num', 'num_inventors']
+# names of the counts in the manual input form
+FORM_FIELDS = ['num_applications', 'patent_citations', 'non_patent_citations',
+               'num_claims', 'num_similar_doc', 'num_authors']
+
+
+### function to one-hot encode the top classifications
+# the classes are compared without case and surrounding spaces;
+# class A and unknown classes are all zeros
+# input: classifications (any sequence)
+# output: float array of size (number of patents, 7)
+def one_hot_classes(classes):
+    # only the distinct values are normalized (a handful for many patents)
+    codes, uniques = pd.factorize(np.asarray(classes, dtype = object))
+    names = [value.strip().upper() if isinstance(value, basestring) else None
+             for value in uniques]
+    # column of each distinct value, len(CLASSES) for the baseline
+    table = np.array([CLASSES.index(name) if name in CLASSES else len(CLASSES)
+                      for name in names] + [len(CLASSES)], dtype = np.int64)
+    # missing values have code -1, the last entry of the table
+    return np.eye(len(CLASSES) + 1)[table[codes], :len(CLASSES)]
+
+
+### function to count the inventors of 'inventor/author' cells
+# input: comma separated names (missing cells count 0)
+# output: integer array
+def count_authors(authors):
+    counts = pd.Series(np.asarray(authors, dtype = object)).str.count(',') + 1
+    return counts.fillna(0).values.astype(np.int64)
+
+
+### function to read the publication years
+# input: dates (YYYY-MM-DD text, datetime.date or datetime64)
+# output: integer array (0 for missing dates)
+def publication_years(dates):
+    dates = pd.to_datetime(pd.Series(np.asarray(dates, dtype = object)), errors = 'coerce')
+    return dates.dt.year.fillna(0).values.astype(np.int64)
+
+
+### function to build the non-text predictors
+# input: columns of the raw records (DataFrame or dictionary column -> values)
+# output: float array of size (number of patents, 13)
+def build(columns):
+    counts = []
+    for column in NONTEXT_COLUMNS:
+        if column == 'num_authors' and column not in columns:
+            counts.append(count_authors(columns['inventor/author']))
+        else:
+            counts.append(np.asarray(columns[column], dtype = np.float64))
+
+    return np.concatenate([one_hot_classes(columns['classification']),
+                           np.column_stack(counts).astype(np.float64)], axis = 1)
+
+
+### function to build the predictors of PatentRecords (page_extractor)
+def from_records(records):
+    columns = {'classification': [record.classification for record in records]}
+    for column, field in zip(NONTEXT_COLUMNS, RECORD_FIELDS):
+        columns[column] = [getattr(record, field) for record in records]
+    return build(columns)
+
+
+### function to build the predictors of manual input forms
+# input: list of dictionaries with the fields of the form
+def from_forms(forms):
+    columns = {'classification': [form['patent_class'] for form in forms]}
+    for column, field in zip(NONTEXT_COLUMNS, FORM_FIELDS):
+        columns[column] = [float(form[field]) for form in forms]
+    return build(columns)
+
+
+### row by row version of build (the loops used before this module),
+# kept as the reference of the benchmark
+def _build_rows(columns):
+    rows = []
+    for i in range(len(columns['classification'])):
+        datetime.strptime(columns['publication date'][i], '%Y-%m-%d').year
+        class_one_hot = [0.0] * len(CLASSES)
+        for j in range(len(CLASSES)):
+            if columns['classification'][i] == CLASSES[j]:
+                class_one_hot[j] = 1.0
+        num_authors = len(columns['inventor/author'][i].split(','))
+        counts = [float(columns[column][i]) for column in NONTEXT_COLUMNS[:-1]]
+        rows.append(class_one_hot + counts + [float(num_authors)])
+    return np.asarray(rows)
+
+
+### function to rebuild the raw columns of the training patents
+# the classification is recovered from the one-hot columns, and the dates
+# and inventors are read from the patent lists
+# input: pickled non-text features, folder of the patent lists, years of the lists
+# output: dictionary column -> array, stored predictors of size (n, 13)
+def load_raw(features_path, lists_dir='patent_lists', years=(2004, 2005, 2006, 2007)):
+    import patent_ingest
+
+    features = pd.read_pickle(features_path)
+    paths = [path for _, _, path in patent_ingest.discover(lists_dir, list(years))]
+    listed = pd.DataFrame(
+        [(row['id'], row['publication date'].isoformat() if row['publication date'] else None,
+          row['inventor/author']) for row in patent_ingest.iter_rows(paths)],
+        columns = ['id', 'publication date', 'inventor/author']).set_index('id')
+    listed = listed.reindex(features['id'].values)
+    known = listed['publication date'].notnull().values
+    features, listed = features[known], listed[known]
+
+    one_hot = features[CLASSES].values
+    classification = np.where(one_hot.any(axis = 1),
+                              np.asarray(CLASSES, dtype = object)[one_hot.argmax(axis = 1)], 'A')
+    columns = {'classification': classification.astype(object),
+               'publication date': listed['publication date'].values,
+               'inventor/author': listed['inventor/author'].values}
+    for column in NONTEXT_COLUMNS[:-1]:
+        columns[column] = features[column].values
+
+    stored = features[CLASSES + NONTEXT_COLUMNS].values.astype(np.float64)
+    return columns, stored
+
+
+### function to compare the throughput of the row by row and vectorized builders
+# input: raw columns (see load_raw), stored predictors, repetitions, copies
+#        (the raw columns are repeated to time larger sets)
+# output: dictionary with the rows, the best time of each builder (seconds),
+#         the rows per second and whether the predictors are the same
+def benchmark(columns, stored=None, repeat=5, copies=1):
+    columns = dict((column, np.tile(values, copies)) for column, values in columns.items())
+    n = len(columns['classification'])
+
+    results = {'rows': n}
+    outputs = {}
+    for name, func in [('rows', _build_rows), ('vectorized', build)]:
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            outputs[name] = func(columns)
+            # the vectorized builder also reads the years, like the loop does
+            if name == 'vectorized':
+                publication_years(columns['publication date'])
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name + '_seconds'] = best
+        results[name + '_rows_per_second'] = n / best
+
+    results['identical'] = bool(np.array_equal(outputs['rows'], outputs['vectorized']))
+    if stored is not None:
+        results['same_as_stored'] = bool(np.array_equal(outputs['vectorized'],
+                                                        np.tile(stored, (copies, 1))))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark the non-text feature builder on the training patents')
+    parser.add_argument('--features', default = os.path.join('patent_data', 'nontext_features.p'))
+    parser.add_argument('--lists', default = 'patent_lists')
+    parser.add_argument('--years', type = int, nargs = '+', default = [2004, 2005, 2006, 2007])
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--copies', type = int, default = 1,
+                        help = 'repeat the patents to time a larger set')
+    args = parser.parse_args(argv)
+
+    columns, stored = load_raw(args.features, args.lists, args.years)
+    results = benchmark(columns, stored, args.repeat, args.copies)
+    print('%d patents' % results['rows'])
+    for name in ['rows', 'vectorized']:
+        print('%-10s %8.1f ms  %10.0f rows/s' % (name, results[name + '_seconds'] * 1000,
+                                                 results[name + '_rows_per_second']))
+    print('identical: %s, same as stored features: %s'
+          % (results['identical'], results.get('same_as_stored')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import json
+import urllib
+import numpy as np
+import pandas as pd
+import versioned_folder
+
+##### Columnar on-disk store of the patent data #####
+# the data is partitioned by publication year (one folder per year)
+# and each column is saved as its own numpy file, so a reader
+# only opens the columns and years it needs, memory-mapped
+#
+# layout:
+#   store/schema.json            column -> kind and dtype
+#   store/year=2004/meta.json    number of rows
+#   store/year=2004/<col>.npy    numeric columns
+#   store/year=2004/<col>.offsets.npy, <col>.data.npy   text columns
+#   store/year=2004/<col>.null.npy   missing values of text columns (if any)
+#
+# each year folder is a link to a version written by write_year and
+# published by versioned_folder.py, so a year is never missing or half
+# written, and readers open all the files of a year from the version they
+# resolved
+
+
+### function to choose a compact dtype for a column
+# integer counts and one-hot columns get the smallest integer type,
+# floating point columns are kept in float32 if float32=True
+def compact_dtype(values, float32=False):
+    dtype = values.dtype
+    if dtype == np.bool_:
+        return np.dtype(np.uint8)
+    if dtype.kind in 'iu':
+        if len(values) == 0:
+            return np.dtype(np.int8)
+        low, high = values.min(), values.max()
+        for candidate in [np.uint8, np.int8, np.uint16, np.int16,
+                          np.uint32, np.int32, np.int64]:
+            info = np.iinfo(candidate)
+            if info.min <= low and high <= info.max:
+                return np.dtype(candidate)
+    if dtype.kind == 'f':
+        # integer values stored as float (e.g. one-hot from get_dummies)
+        finite = values[~np.isnan(values)]
+        if len(finite) == len(values) and np.all(finite == np.round(finite)):
+            return compact_dtype(finite.astype(np.int64))
+        if float32:
+            return np.dtype(np.float32)
+    return dtype
+
+
+### function to read the schema of a store
+def read_schema(store):
+    path = os.path.join(store, 'schema.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+# name of a published year folder (not its versions or unfinished writes)
+YEAR_FOLDER = re.compile(r'^year=(\d+)$')
+
+
+### function to list the years saved in a store
+def years(store):
+    if not os.path.isdir(store):
+        return []
+    return sorted(int(match.group(1)) for match in
+                  (YEAR_FOLDER.match(name) for name in os.listdir(store)) if match)
+
+
+### function to get the folder of the current version of a year
+def _year_folder(store, year):
+    return versioned_folder.resolve(os.path.join(store, 'year=%d' % year))
+
+
+### function to list the columns of a store
+def columns(store):
+    return sorted(read_schema(store).keys())
+
+
+def _column_path(folder, column, suffix):
+    return os.path.join(folder, urllib.quote(column, safe = '') + suffix)
+
+
+### function to save a text column as utf-8 bytes and offsets
+def _write_text(folder, column, values):
+    null = np.asarray([value is None or (isinstance(value, float) and np.isnan(value))
+                       for value in values], dtype = bool)
+    encoded = []
+    for value, missing in zip(values, null):
+        if missing:
+            encoded.append(b'')
+        elif isinstance(value, bytes):
+            encoded.append(value)
+        else:
+            encoded.append(unicode(value).encode('utf-8'))
+
+    lengths = np.fromiter((len(value) for value in encoded), dtype = np.int64,
+                          count = len(encoded))
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    data = np.frombuffer(b''.join(encoded), dtype = np.uint8)
+
+    np.save(_column_path(folder, column, '.offsets.npy'), offsets)
+    np.save(_column_path(folder, column, '.data.npy'), data)
+    if null.any():
+        np.save(_column_path(folder, column, '.null.npy'), null)
+
+
+### function to read a text column
+def _read_text(folder, column, mmap):
+    offsets = np.load(_column_path(folder, column, '.offsets.npy'), mmap_mode = mmap)
+    data = np.load(_column_path(folder, column, '.data.npy'), mmap_mode = mmap)
+    null_path = _column_path(folder, column, '.null.npy')
+    null = np.load(null_path) if os.path.exists(null_path) else None
+
+    raw = data.tostring() if hasattr(data, 'tostring') else data.tobytes()
+    values = np.empty(len(offsets) - 1, dtype = object)
+    for i in range(len(values)):
+        if null is not None and null[i]:
+            values[i] = None
+        else:
+            values[i] = raw[offsets[i]:offsets[i + 1]].decode('utf-8')
+
+    return values
+
+
+### function to save the patents of one publication year
+# an existing partition of the same year is replaced
+# input: store folder, year, DataFrame, float32 to store floats in float32
+def write_year(store, year, data, float32=False):
+    schema = read_schema(store)
+    folder = os.path.join(store, 'year=%d' % year)
+    new_folder = versioned_folder.new_version(folder)
+
+    for column in data.columns:
+        values = data[column].values
+        if values.dtype == object:
+            kind, dtype = 'text', 'utf-8'
+            _write_text(new_folder, column, values)
+        else:
+            kind = 'numeric'
+            dtype = compact_dtype(values, float32)
+            # keep the dtype of the other years if it is wider
+            if column in schema and schema[column]['kind'] == 'numeric':
+                dtype = np.promote_types(dtype, np.dtype(str(schema[column]['dtype'])))
+            np.save(_column_path(new_folder, column, '.npy'), values.astype(dtype))
+            dtype = dtype.str
+
+        if column in schema and schema[column]['kind'] != kind:
+            raise ValueError('column %s is %s in the store' % (column, schema[column]['kind']))
+        schema[column] = {'kind': kind, 'dtype': dtype}
+
+    with open(os.path.join(new_folder, 'meta.json'), 'w') as f:
+        json.dump({'rows': int(data.shape[0]), 'columns': list(data.columns)}, f)
+
+    # replace the partition only once it is completely written
+    versioned_folder.publish(folder, new_folder)
+
+    with open(os.path.join(store, 'schema.json'), 'w') as f:
+        json.dump(schema, f, indent = 1, sort_keys = True)
+
+
+### function to replace the values of one numeric column of a year
+# the other columns of the partition are not rewritten
+# input: store folder, year, column, values (one per row of the year)
+def update_column(store, year, column, values):
+    schema = read_schema(store)
+    folder = _year_folder(store, year)
+    with open(os.path.join(folder, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+
+    if column not in schema:
+        raise KeyError('column %s is not in the store' % column)
+    if schema[column]['kind'] != 'numeric':
+        raise ValueError('column %s is %s in the store' % (column, schema[column]['kind']))
+    values = np.asarray(values)
+    if len(values) != meta['rows']:
+        raise ValueError('expected %d values for year %d, got %d'
+                         % (meta['rows'], year, len(values)))
+
+    dtype = np.promote_types(compact_dtype(values), np.dtype(str(schema[column]['dtype'])))
+
+    # write next to the column file and rename it over the old one
+    path = _column_path(folder, column, '.npy')
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, values.astype(dtype))
+    os.rename(path + '.tmp', path)
+
+    if column not in meta['columns']:
+        meta['columns'].append(column)
+        with open(os.path.join(folder, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+    if dtype.str != schema[column]['dtype']:
+        schema[column]['dtype'] = dtype.str
+        with open(os.path.join(store, 'schema.json'), 'w') as f:
+            json.dump(schema, f, indent = 1, sort_keys = True)
+
+
+### function to read columns of a store as arrays
+# input: store folder, list of columns (all by default),
+#        list of years (all by default), mmap: 'r' for memory-mapped
+#        numeric columns, None to read them in memory
+# output: dictionary column -> list of arrays (one per year), years read
+def read_arrays(store, columns=None, year_list=None, mmap='r'):
+    schema = read_schema(store)
+    if columns is None:
+        columns = sorted(schema.keys())
+    if year_list is None:
+        year_list = years(store)
+
+    arrays = dict((column, []) for column in columns)
+    for year in year_list:
+        folder = _year_folder(store, year)
+        with open(os.path.join(folder, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        for column in columns:
+            if column not in schema:
+                raise KeyError('column %s is not in the store' % column)
+            if column not in meta['columns']:
+                # column added after this year was saved
+                values = np.zeros(meta['rows'], dtype = np.dtype(str(schema[column]['dtype']))
+                                  if schema[column]['kind'] == 'numeric' else object)
+            elif schema[column]['kind'] == 'text':
+                values = _read_text(folder, column, mmap)
+            else:
+                values = np.load(_column_path(folder, column, '.npy'), mmap_mode = mmap)
+            arrays[column].append(values)
+
+    return arrays, year_list
+
+
+### function to read a store into a DataFrame
+# input: store folder, list of columns (all by default),
+#        list of years (all by default), mmap (see read_arrays)
+# output: DataFrame with the rows of the years in order
+def read(store, columns=None, years=None, mmap='r'):
+    arrays, years_read = read_arrays(store, columns, years, mmap)
+    if columns is None:
+        columns = sorted(arrays.keys())
+
+    data = {}
+    for column in columns:
+        parts = arrays[column]
+        data[column] = parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    return pd.DataFrame(data, columns = columns)
+
+
+### function to read the publication years of patents from the patent lists
+# input: patent numbers, folder of the patent lists
+# output: integer array (0 for patents missing from the lists)
+def list_years(ids, lists_dir='patent_lists'):
+    import patent_ingest
+
+    paths = [path for _, _, path in patent_ingest.discover(lists_dir)]
+    listed = dict((row['id'], row['publication date'].year)
+                  for row in patent_ingest.iter_rows(paths) if row['publication date'])
+    return np.array([listed.get(patent_id, 0) for patent_id in ids], dtype = np.int64)
+
+
+### function to import a pickled DataFrame into a store
+# input: pickle file, store folder, column with the publication year
+#        or the publication date (the year is read from the date),
+#        folder of the patent lists: read the years from the publication
+#        dates of the lists instead (the year column is overwritten)
+# output: number of patents missing from the lists (not imported)
+def import_pickle(path, store, year_column='publication_year', float32=False,
+                  lists_dir=None):
+    data = pd.read_pickle(path)
+    missing = 0
+    if lists_dir:
+        # the publication_year of nontext_features.p is 2004 for every patent
+        values = list_years(data['id'].values, lists_dir)
+        missing = int(np.sum(values == 0))
+        data, values = data[values > 0].copy(), values[values > 0]
+        if year_column in data.columns:
+            data[year_column] = values.astype(data[year_column].dtype)
+    else:
+        values = data[year_column].values
+        if values.dtype == object:
+            values = pd.to_datetime(values).year
+    for year in sorted(np.unique(values)):
+        write_year(store, int(year), data[values == year], float32)
+
+    return missing
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Import a pickled DataFrame into a feature store')
+    parser.add_argument('pickle', help = 'e.g. patent_data/nontext_features.p')
+    parser.add_argument('store', help = 'e.g. patent_data/nontext_store')
+    parser.add_argument('--year-column', default = 'publication_year')
+    parser.add_argument('--lists', default = None,
+                        help = 'folder of the patent lists to read the publication years from '
+                        '(needed for nontext_features.p)')
+    args = parser.parse_args(argv)
+
+    missing = import_pickle(args.pickle, args.store, args.year_column, lists_dir = args.lists)
+    if missing:
+        print('%d patents missing from the lists were not imported' % missing)
+    print('years: %s' % years(args.store))
+    print('columns: %s' % columns(args.store))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import pickle
+import numpy as np
+
+##### Array-backed evaluation of the random forest model #####
+# the trees of a fitted RandomForestClassifier are flattened into one set
+# of contiguous node arrays, and all the trees are walked at once with
+# numpy operations; this avoids the per-tree overhead of predict_proba,
+# which dominates when scoring one patent at a time (for batches of
+# thousands of rows the cython code of sklearn is faster again)
+#
+# the probabilities are the same as RandomForestClassifier.predict_proba:
+# the rows are cast to float32 like sklearn does before walking the trees,
+# and the leaf probabilities are summed tree by tree in the same order
+
+
+### function to flatten a fitted random forest
+# input: fitted sklearn RandomForestClassifier (single output)
+# output: dictionary of node arrays
+#   feature, threshold: split of each node (leaves point to feature 0)
+#   left, right: children of each node (leaves point to themselves)
+#   is_leaf: whether each node is a leaf
+#   proba: normalized class probabilities of each node
+#   roots: first node of each tree, depth: maximum depth of the trees
+def compile_forest(forest):
+    features, thresholds, lefts, rights, leaves, probas, roots = [], [], [], [], [], [], []
+    offset = 0
+    depth = 0
+
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        n_nodes = tree.node_count
+        left = tree.children_left.astype(np.int64)
+        right = tree.children_right.astype(np.int64)
+        is_leaf = left == -1
+
+        # leaves point to themselves so extra steps do not move them
+        node_ids = np.arange(n_nodes, dtype = np.int64)
+        left = np.where(is_leaf, node_ids, left) + offset
+        right = np.where(is_leaf, node_ids, right) + offset
+        feature = np.where(is_leaf, 0, tree.feature).astype(np.int64)
+
+        # same normalization as DecisionTreeClassifier.predict_proba
+        value = tree.value[:, 0, :forest.n_classes_].astype(np.float64)
+        normalizer = value.sum(axis = 1)[:, None]
+        normalizer[normalizer == 0.0] = 1.0
+
+        features.append(feature)
+        thresholds.append(tree.threshold.astype(np.float64))
+        lefts.append(left)
+        rights.append(right)
+        leaves.append(is_leaf)
+        probas.append(value / normalizer)
+        roots.append(offset)
+
+        offset += n_nodes
+        depth = max(depth, tree.max_depth)
+
+    return {
+        'feature': np.concatenate(features),
+        'threshold': np.concatenate(thresholds),
+        'left': np.concatenate(lefts),
+        'right': np.concatenate(rights),
+        'is_leaf': np.concatenate(leaves),
+        'proba': np.concatenate(probas),
+        'roots': np.asarray(roots, dtype = np.int64),
+        'depth': np.int64(depth),
+        'classes': np.asarray(forest.classes_),
+        'n_features': np.int64(forest.n_features_),
+    }
+
+
+### function to save a compiled forest
+def save_forest(compiled, path):
+    with open(path, 'wb') as f:
+        np.savez(f, **compiled)
+
+
+### function to load a compiled forest
+def load_forest(path):
+    with np.load(path) as data:
+        return dict((name, data[name]) for name in data.files)
+
+
+### function to compute the class probabilities of the compiled forest
+# input: compiled forest, predictors of size (n, number of features)
+# output: probabilities of size (n, number of classes)
+def predict_proba(compiled, X):
+    X = np.asarray(X, dtype = np.float32)
+    if X.ndim == 1:
+        X = X.reshape((1, -1))
+    if X.shape[1] != compiled['n_features']:
+        raise ValueError('expected %d features, got %d'
+                         % (compiled['n_features'], X.shape[1]))
+
+    feature = compiled['feature']
+    threshold = compiled['threshold']
+    left = compiled['left']
+    right = compiled['right']
+    is_leaf = compiled['is_leaf']
+
+    # current node of each (row, tree) pair, and offset of its row in X
+    n_trees = len(compiled['roots'])
+    nodes = np.tile(compiled['roots'], X.shape[0])
+    row_offsets = np.repeat(np.arange(X.shape[0]) * X.shape[1], n_trees)
+    X_flat = X.ravel()
+
+    # only the pairs that have not reached a leaf are moved at each step
+    active = np.flatnonzero(~is_leaf[nodes])
+    for _ in range(int(compiled['depth'])):
+        if len(active) == 0:
+            break
+        current = nodes[active]
+        go_left = X_flat[row_offsets[active] + feature[current]] <= threshold[current]
+        current = np.where(go_left, left[current], right[current])
+        nodes[active] = current
+        active = active[~is_leaf[current]]
+
+    # sum the trees in order (cumsum adds sequentially like the forest does)
+    leaf_proba = compiled['proba'][nodes].reshape((X.shape[0], n_trees, -1))
+    all_proba = np.cumsum(leaf_proba, axis = 1)[:, -1, :]
+
+    return all_proba / len(compiled['roots'])
+
+
+### function to compare the latency with the sklearn model
+# input: sklearn forest, compiled forest, sample predictors,
+#        batch sizes, number of repetitions
+# output: dictionary batch size -> seconds per call of both methods,
+#         and whether the probabilities are identical
+def benchmark(forest, compiled, X, batch_sizes=(1, 10, 1000), repeat=20):
+    results = {}
+    for batch_size in batch_sizes:
+        batch = X[np.arange(batch_size) % X.shape[0]]
+
+        timings = {}
+        for name, func in [('sklearn', forest.predict_proba),
+                           ('compiled', lambda b: predict_proba(compiled, b))]:
+            best = None
+            for _ in range(repeat):
+                start = time.time()
+                func(batch)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best
+
+        timings['identical'] = bool(np.array_equal(forest.predict_proba(batch),
+                                                   predict_proba(compiled, batch)))
+        results[batch_size] = timings
+
+    return results
+
+
+if __name__ == '__main__':
+    # usage: python forest_compiler.py models/final_model.p models/final_model_compiled.npz
+    with open(sys.argv[1], 'rb') as f:
+        forest = pickle.load(f)
+    compiled = compile_forest(forest)
+    save_forest(compiled, sys.argv[2])
+
+    # random standardized predictors
+    X = np.random.RandomState(0).randn(1000, forest.n_features_)
+    for batch_size, timings in sorted(benchmark(forest, compiled, X).items()):
+        print('batch %d: sklearn %.3f ms, compiled %.3f ms, identical: %s'
+              % (batch_size, timings['sklearn'] * 1000, timings['compiled'] * 1000,
+                 timings['identical']))
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import json
+import threading
+import argparse
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+
+##### Pooled HTTP client for the patent pages #####
+# one requests session per process keeps the connections to Google Patents
+# alive between pages (no new TCP/TLS handshake per patent), and every
+# request has a connect and a read timeout so a slow upstream cannot hold a
+# worker indefinitely
+#
+# get_async starts a download on a shared pool of fetch threads and returns
+# immediately; the caller collects the page with .get(timeout), so one web
+# request can have many downloads in flight
+#
+# settings (environment):
+#   HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT   seconds (default 3.05 and 10)
+#   HTTP_POOL_SIZE                            connections kept per host (default 32)
+#   HTTP_FETCH_THREADS                        threads of get_async (default 32)
+
+
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 32))
+FETCH_THREADS = int(os.environ.get('HTTP_FETCH_THREADS', 32))
+
+# identify the scraper to the server
+USER_AGENT = 'patent-usefulness/1.0 (+https://patents.google.com)'
+
+# session and fetch pool of the process (created on first use, and again
+# in a forked child, whose copies of the parent's connections are not usable)
+_state = {'pid': None, 'session': None, 'pool': None}
+_lock = threading.Lock()
+
+
+### function to get the session of the process
+def session():
+    if _state['pid'] != os.getpid():
+        with _lock:
+            if _state['pid'] != os.getpid():
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections = 4, pool_maxsize = POOL_SIZE)
+                s.mount('http://', adapter)
+                s.mount('https://', adapter)
+                s.headers['User-Agent'] = USER_AGENT
+                _state['session'] = s
+                _state['pool'] = None
+                _state['pid'] = os.getpid()
+    return _state['session']
+
+
+### function to download a page
+# input: url, (connect, read) timeouts in seconds
+# output: content of the page (bytes)
+# raises requests.HTTPError for error statuses, requests.Timeout on timeouts
+def get(url, timeout=None):
+    response = session().get(url, timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT))
+    try:
+        response.raise_for_status()
+        return response.content
+    finally:
+        response.close()
+
+
+### function to download a page only if it changed
+# sends the validators of the previous download (If-None-Match and
+# If-Modified-Since); servers that ignore them return the full page
+# input: url, ETag and Last-Modified of the previous download, timeouts
+# output: content (None if the page did not change), ETag, Last-Modified
+def get_conditional(url, etag=None, last_modified=None, timeout=None):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    response = session().get(url, headers = headers,
+                             timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT))
+    try:
+        if response.status_code == 304:
+            return None, etag, last_modified
+        response.raise_for_status()
+        return (response.content, response.headers.get('ETag'),
+                response.headers.get('Last-Modified'))
+    finally:
+        response.close()
+
+
+### function to get the shared pool of fetch threads
+def _fetch_pool():
+    session()
+    if _state['pool'] is None:
+        with _lock:
+            if _state['pool'] is None:
+                _state['pool'] = ThreadPool(FETCH_THREADS)
+    return _state['pool']
+
+
+### function to stop the fetch threads and close the connections
+# waits for the running downloads; called before forking, so that no fetch
+# thread holds a lock copied into the children (they start their own pool)
+def shutdown():
+    with _lock:
+        pool, s = _state['pool'], _state['session']
+        _state['pid'] = _state['session'] = _state['pool'] = None
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if s is not None:
+        s.close()
+
+
+### function to start a function on the fetch threads
+# input: function and its arguments
+# output: AsyncResult (.get(timeout) returns the result or raises its error)
+def submit(func, *args):
+    return _fetch_pool().apply_async(func, args)
+
+
+### function to start downloading a page without waiting for it
+# output: AsyncResult of get(url, timeout)
+def get_async(url, timeout=None):
+    return submit(get, url, timeout)
+
+
+### local server serving the pages of a folder after a delay
+# used to check the client without Google Patents (see main below)
+# the pages have an ETag and If-None-Match requests are answered with 304
+def delay_server(directory, delay=0.0, port=0):
+    import hashlib
+    import BaseHTTPServer
+    import SocketServer
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        # keep the connections alive like Google Patents does
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+            with self.server.lock:
+                self.server.connections += 1
+
+        def do_GET(self):
+            time.sleep(self.server.delay)
+            # /patent/<id>/en -> <id>.html
+            parts = [part for part in self.path.split('/') if part]
+            path = os.path.join(directory, parts[-2] + '.html') if len(parts) >= 2 else ''
+            if not os.path.isfile(path):
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            with open(path, 'rb') as f:
+                body = f.read()
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+        def handle_error(self, request, client_address):
+            # clients giving up on a delayed page (read timeouts)
+            pass
+
+    server = Server(('127.0.0.1', port), Handler)
+    server.delay = delay
+    server.connections = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+### function to find the folder of the pages of stage_benchmark.py
+# (benchmark_fixtures at the root of the repository, also from the flask copy)
+def fixtures_folder():
+    here = os.path.dirname(os.path.abspath(__file__))
+    for folder in [here, os.path.join(here, os.pardir, os.pardir)]:
+        path = os.path.normpath(os.path.join(folder, 'benchmark_fixtures'))
+        if os.path.isdir(path):
+            return path
+    return os.path.join(here, 'benchmark_fixtures')
+
+
+### function to check the client against a delaying local server
+# output: dictionary with the connections opened, the timeout behavior
+#         and the time of sequential and concurrent downloads
+def check(directory, page_id, delay=0.2, n_pages=20):
+    server = delay_server(directory, delay)
+    url = 'http://127.0.0.1:%d/patent/%s/en' % (server.server_address[1], page_id)
+    report = {'delay': delay, 'pages': n_pages}
+
+    # keep-alive: sequential requests share one connection
+    start = time.time()
+    for _ in range(n_pages):
+        get(url)
+    report['sequential_seconds'] = time.time() - start
+    report['sequential_connections'] = server.connections
+
+    # many downloads in flight from one caller
+    start = time.time()
+    results = [get_async(url) for _ in range(n_pages)]
+    pages = [result.get(timeout = delay * n_pages + 5) for result in results]
+    report['concurrent_seconds'] = time.time() - start
+    report['concurrent_pages_ok'] = all(len(page) > 0 for page in pages)
+
+    # read timeout shorter than the delay
+    start = time.time()
+    try:
+        get(url, timeout = (CONNECT_TIMEOUT, delay / 2))
+        report['read_timeout_raised'] = False
+    except requests.Timeout:
+        report['read_timeout_raised'] = True
+    report['read_timeout_seconds'] = time.time() - start
+
+    server.shutdown()
+    server.server_close()
+
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description = 'Check the pooled HTTP client against a local delaying server')
+    parser.add_argument('--pages', default = fixtures_folder(),
+                        help = 'folder of <patent id>.html pages')
+    parser.add_argument('--patent', default = 'US7654321B2')
+    parser.add_argument('--delay', type = float, default = 0.2)
+    parser.add_argument('-n', type = int, default = 20)
+    args = parser.parse_args(argv)
+
+    report = check(args.pages, args.patent, args.delay, args.n)
+    print(json.dumps(report, indent = 1, sort_keys = True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+##### Latency histograms and counters of the webapp #####
+# the stages of scoring a patent (fetch, parse, tokenize, embed, model load,
+# predict, ...) record their durations into histograms, and the requests
+# record their total duration per endpoint
+# the metrics are exposed in the prometheus text format by the /metrics view
+#
+# the stages of a request are also collected in a per-thread trace; when
+# SLOW_REQUEST_SECONDS is set, requests slower than that are logged with the
+# time spent in each stage (stages run in other threads are only added to the
+# trace by functions wrapped with bind_trace)
+
+
+# upper bounds of the histogram buckets (seconds)
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0]
+
+# requests slower than this are logged with their stages (disabled if 0)
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 0))
+
+logger = logging.getLogger('flaskexample.slow_requests')
+
+# histograms: (metric name, label name, label value) -> bucket counts, sum, count
+_histograms = {}
+# counters: name -> value
+_counters = {}
+_lock = threading.Lock()
+
+# stages of the request handled by the current thread
+_trace = threading.local()
+
+
+### function to record a duration into a histogram
+# input: label value (stage or endpoint), seconds, metric and label names
+def observe(label, seconds, metric='patent_stage_seconds', label_name='stage'):
+    key = (metric, label_name, label)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+            _histograms[key] = histogram
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+    stages = getattr(_trace, 'stages', None)
+    if stages is not None and metric == 'patent_stage_seconds':
+        stages.append((label, seconds))
+
+
+### function to increase a counter
+def count(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+### context manager timing a block of code as a stage
+@contextmanager
+def timer(stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(stage, time.time() - start)
+
+
+### function to record the stages of a function run in another thread
+# into the trace of the current request
+# input: function
+# output: function to run in the other thread
+def bind_trace(func):
+    stages = getattr(_trace, 'stages', None)
+
+    @functools.wraps(func)
+    def traced(*args, **kwargs):
+        previous = getattr(_trace, 'stages', None)
+        _trace.stages = stages
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _trace.stages = previous
+    return traced
+
+
+### function to start the trace of a request in the current thread
+def start_trace(endpoint):
+    _trace.endpoint = endpoint
+    _trace.start = time.time()
+    _trace.stages = []
+
+
+### function to finish the trace of a request
+# records the request duration, and logs the stages of slow requests
+# output: duration of the request (None if no trace was started)
+def finish_trace():
+    stages = getattr(_trace, 'stages', None)
+    if stages is None:
+        return None
+
+    seconds = time.time() - _trace.start
+    endpoint = _trace.endpoint
+    _trace.stages = None
+    observe(endpoint, seconds, 'patent_request_seconds', 'endpoint')
+
+    if SLOW_REQUEST_SECONDS and seconds > SLOW_REQUEST_SECONDS:
+        # total time of each stage, in order of first use
+        totals = []
+        for stage, duration in stages:
+            for item in totals:
+                if item[0] == stage:
+                    item[1] += duration
+                    break
+            else:
+                totals.append([stage, duration])
+        breakdown = ', '.join('%s=%.3fs' % (stage, duration) for stage, duration in totals)
+        logger.warning('slow request %s took %.3fs: %s', endpoint, seconds,
+                       breakdown or 'no stages recorded')
+
+    return seconds
+
+
+### function to escape a label value of the prometheus text format
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+### function to format the metrics in the prometheus text format
+# input: additional counters (e.g. the prediction cache counters)
+# output: text of the metrics
+def render(extra_counters=None):
+    with _lock:
+        histograms = sorted((key, dict(value, buckets = list(value['buckets'])))
+                            for key, value in _histograms.items())
+        counters = dict(_counters)
+    counters.update(extra_counters or {})
+
+    lines = []
+    metric_names = []
+    for (metric, label_name, label), histogram in histograms:
+        label = escape_label(label)
+        if metric not in metric_names:
+            metric_names.append(metric)
+            lines.append('# TYPE %s histogram' % metric)
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS, histogram['buckets']):
+            cumulative += bucket
+            lines.append('%s_bucket{%s="%s",le="%g"} %d'
+                         % (metric, label_name, label, bound, cumulative))
+        lines.append('%s_bucket{%s="%s",le="+Inf"} %d'
+                     % (metric, label_name, label, histogram['count']))
+        lines.append('%s_sum{%s="%s"} %.6f' % (metric, label_name, label, histogram['sum']))
+        lines.append('%s_count{%s="%s"} %d' % (metric, label_name, label, histogram['count']))
+
+    for name, value in sorted(counters.items()):
+        lines.append('# TYPE patent_%s_total counter' % name)
+        lines.append('patent_%s_total %d' % (name, value))
+
+    return '\n'.join(lines) + '\n'
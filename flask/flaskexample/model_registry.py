@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import pickle
+import logging
+import threading
+import numpy as np
+from gensim.models import Word2Vec
+import patent_index
+import similar_patents
+import word_vectors
+import forest_compiler
+import model_bundle
+import metrics
+
+##### A process-wide registry of the model files used by the webapp #####
+# each artifact is loaded once and shared by all the requests
+# the file is checked for changes (mtime, size) and reloaded when it changes;
+# if the reload fails, the loaded version keeps being served
+#
+# with a model bundle, the model, scaler and word2vec vectors are one artifact,
+# so they are always reloaded together; get_models returns the three of the
+# same version for one prediction
+
+
+# registered artifacts: name -> dict with path, loader and load information
+_artifacts = {}
+# protect loading / reloading from concurrent requests
+_lock = threading.RLock()
+
+logger = logging.getLogger('flaskexample.model_registry')
+
+# minimum number of seconds between two checks of the same file
+CHECK_INTERVAL = 1.0
+
+# inference-only word2vec vectors (used instead of the gensim model if exported)
+WORD2VEC_VECTORS = 'models/word2vec_vectors'
+WORD2VEC_PRECISION = os.environ.get('WORD2VEC_PRECISION', 'float32')
+
+# array-backed random forest (used instead of the pickled model if compiled)
+COMPILED_MODEL = 'models/final_model_compiled.npz'
+
+# versioned bundle of the model, scaler and word2vec vectors (model_bundle.py),
+# used instead of the separate files if it exists
+MODEL_BUNDLE = os.environ.get('MODEL_BUNDLE', 'models/bundle')
+
+
+### function to load a pickled object
+# the files were written by python 2 pickle in the notebooks
+def load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+### function to load a trained word2vec model
+def load_word2vec(path):
+    return Word2Vec.load(path)
+
+
+### function to load vectors exported by word_vectors.py
+# input: path to the matrix file in the export folder
+def load_exported_vectors(path):
+    return word_vectors.load_vectors(os.path.dirname(path), WORD2VEC_PRECISION)
+
+
+### function to load a model bundle with all its components
+# input: path to the manifest of the bundle (a new version of the bundle
+#        is a new manifest, so all the components are reloaded together)
+# output: Bundle
+def load_bundle(path):
+    bundle = model_bundle.open_bundle(os.path.dirname(path))
+    for name in model_bundle.COMPONENTS:
+        bundle.get(name)
+    return bundle
+
+
+### function to read the resident memory of the current process (bytes)
+# returns None if it cannot be measured on this platform
+def _current_rss():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+### function to read the signature of a file
+# the signature changes when the file is rewritten
+def _file_signature(path):
+    stat = os.stat(path)
+    return (stat.st_mtime, stat.st_size)
+
+
+### function to make loaded arrays read-only
+# the objects are shared by all requests and must not be modified in place
+def _freeze(obj):
+    if isinstance(obj, np.ndarray):
+        obj.flags.writeable = False
+    elif isinstance(obj, (list, tuple, dict)):
+        for item in (obj.values() if isinstance(obj, dict) else obj):
+            if isinstance(item, np.ndarray):
+                item.flags.writeable = False
+    return obj
+
+
+### function to register an artifact
+# input: name used by the views, path to the file, loader function,
+#        optional: the file may not exist (skipped by warm_up)
+# the file is not read until the artifact is requested
+def register(name, path, loader=load_pickle, optional=False):
+    with _lock:
+        _artifacts[name] = {
+            'path': path,
+            'loader': loader,
+            'optional': optional,
+            'obj': None,
+            'signature': None,
+            'version': 0,
+            'checked_at': 0.0,
+            'load_seconds': None,
+            'rss_delta': None,
+            'loaded_at': None,
+        }
+
+
+### function to (re)load one artifact
+# must be called with the lock held
+def _load(entry):
+    rss_before = _current_rss()
+    start = time.time()
+
+    signature = _file_signature(entry['path'])
+    obj = _freeze(entry['loader'](entry['path']))
+
+    entry['load_seconds'] = time.time() - start
+    metrics.observe('model_load', entry['load_seconds'])
+    rss_after = _current_rss()
+    if rss_before is not None and rss_after is not None:
+        entry['rss_delta'] = rss_after - rss_before
+
+    entry['obj'] = obj
+    entry['signature'] = signature
+    entry['version'] += 1
+    entry['loaded_at'] = time.time()
+    entry['checked_at'] = entry['loaded_at']
+
+    return obj
+
+
+### function to reload an artifact whose file changed
+# must be called with the lock held
+# output: new object, or the loaded one if the new file cannot be loaded
+def _reload(name, entry):
+    try:
+        return _load(entry)
+    except Exception:
+        # e.g. a file being replaced: retried at the next check
+        logger.exception('reloading %s from %s failed, keeping version %d',
+                         name, entry['path'], entry['version'])
+        metrics.count('model_reload_failures')
+        return entry['obj']
+
+
+### function to get a shared handle on an artifact
+# input: name of the registered artifact (or of a component of the bundle)
+# output: loaded object (loaded on first use, reloaded if the file changed)
+def get(name):
+    if name not in _artifacts and name in model_bundle.COMPONENTS and 'bundle' in _artifacts:
+        return get('bundle').get(name)
+
+    entry = _artifacts[name]
+    obj = entry['obj']
+    now = time.time()
+
+    # fast path: loaded and checked recently
+    if obj is not None and now - entry['checked_at'] < CHECK_INTERVAL:
+        return obj
+
+    with _lock:
+        if entry['obj'] is None:
+            return _load(entry)
+
+        entry['checked_at'] = now
+        try:
+            signature = _file_signature(entry['path'])
+        except OSError:
+            # keep serving the loaded version if the file is being replaced
+            return entry['obj']
+
+        if signature != entry['signature']:
+            return _reload(name, entry)
+
+        return entry['obj']
+
+
+### function to get the model, scaler and word2vec vectors used together
+# with a bundle, the three come from the same loaded version (separate get
+# calls could straddle a reload and pair a new scaler with the old forest)
+# output: dictionary component name -> loaded object
+def get_models():
+    if 'bundle' in _artifacts:
+        bundle = get('bundle')
+        return dict((name, bundle.get(name)) for name in model_bundle.COMPONENTS)
+    return dict((name, get(name)) for name in model_bundle.COMPONENTS)
+
+
+### function to force loading of artifacts
+# input: names to load (all registered artifacts by default)
+# useful to warm up the process before serving requests
+def reload(names=None):
+    if names is None:
+        names = list(_artifacts.keys())
+
+    with _lock:
+        for name in names:
+            _load(_artifacts[name])
+
+
+### function to warm up the registry without reloading loaded artifacts
+def warm_up(names=None):
+    if names is None:
+        names = list(_artifacts.keys())
+
+    for name in names:
+        try:
+            get(name)
+        except (IOError, OSError):
+            if not _artifacts[name]['optional']:
+                raise
+
+
+### function to compute a fingerprint of the model files
+# input: names of the artifacts (all registered artifacts by default;
+#        names that are not registered are left out)
+# output: string that changes whenever one of the files changes
+# loaded artifacts whose file changed are reloaded first, so the
+# fingerprint always describes the models used by get()
+def fingerprint(names=None):
+    if names is None:
+        names = _artifacts.keys()
+
+    parts = []
+    for name in sorted(name for name in names if name in _artifacts):
+        entry = _artifacts[name]
+        try:
+            signature = _file_signature(entry['path'])
+        except OSError:
+            signature = None
+
+        if entry['obj'] is not None and signature is not None:
+            with _lock:
+                if signature != entry['signature']:
+                    _reload(name, entry)
+
+        parts.append('%s:%s' % (name, signature))
+
+    return '|'.join(parts)
+
+
+### function to report load time and memory footprint of the artifacts
+# output: dictionary name -> load information
+def stats():
+    report = {}
+    for name, entry in _artifacts.items():
+        report[name] = {
+            'path': entry['path'],
+            'loaded': entry['obj'] is not None,
+            'version': entry['version'],
+            'load_seconds': entry['load_seconds'],
+            'rss_delta_bytes': entry['rss_delta'],
+            'file_bytes': entry['signature'][1] if entry['signature'] else None,
+            'loaded_at': entry['loaded_at'],
+        }
+
+    return report
+
+
+# artifacts used by the webapp (paths relative to the flask folder)
+if os.path.exists(os.path.join(MODEL_BUNDLE, 'manifest.json')):
+    register('bundle', os.path.join(MODEL_BUNDLE, 'manifest.json'), loader=load_bundle)
+else:
+    register('scaler', 'models/final_model_scaler.p')
+    if os.path.exists(COMPILED_MODEL):
+        register('model', COMPILED_MODEL, loader=forest_compiler.load_forest)
+    else:
+        register('model', 'models/final_model.p')
+    if os.path.exists(word_vectors.vectors_path(WORD2VEC_VECTORS, WORD2VEC_PRECISION)):
+        register('word2vec', word_vectors.vectors_path(WORD2VEC_VECTORS, WORD2VEC_PRECISION),
+                 loader=load_exported_vectors)
+    else:
+        register('word2vec', 'models/word2vec_claims_final', loader=load_word2vec)
+register('patent_numbers', 'models/patent_numbers.p')
+# built by patent_index.py (optional)
+register('patent_index', 'models/patent_index/predictors.npy',
+         loader=patent_index.load_index, optional=True)
+# built by similar_patents.py (optional)
+register('similar_index', 'models/similar_index/vectors.npy',
+         loader=similar_patents.load_index, optional=True)
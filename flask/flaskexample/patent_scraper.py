@@ -2,7 +2,6 @@
 
 import numpy as np
 import pandas as pd
-import urllib
 import io
 from bs4 import BeautifulSoup
 from datetime import datetime
@@ -12,17 +11,55 @@ from nltk import word_tokenize
 from nltk.corpus import stopwords
 from nltk.stem.wordnet import WordNetLemmatizer
 import string
+import page_extractor
+import page_cache
+import http_client
+import claim_embedding
+import claim_tokenizer
+import claim_cache
+import feature_builder
+import metrics
 
 ##### A list of functions to scrape information from Google Patent page #####
 
 
+# how the claim divs are read by the single pass extractor
+# (matches read_patent_claims and read_patent_claims_WO below)
+CLAIM_TEXT = 'text'
+CLAIM_TEXT_WO = 'string'
+
+
+### function to download a html page
+# the connections are pooled and kept alive by http_client, with timeouts
+# input: a url
+# output: html content of the page
+def download_page(url):
+    with metrics.timer('download'):
+        return http_client.get(url)
+
+
+### function to read a html page through the page cache
+# the page is only downloaded if it is not cached
+# input: a url
+# output: html content of the page
+def fetch_page(url):
+    return page_cache.get_page(url, download_page)
+
+
+### function to parse a html page
+# input: html content of the page
+# output: BeautifulSoup output
+def parse_soup(page):
+    return BeautifulSoup(page, "lxml")
+
+
 ### function to read a html page
 # input: a url
 # output: BeautifulSoup output
 def generate_soup(url):
     # read the page
-    page = urllib.urlopen(url).read()
-    soup = BeautifulSoup(page, "lxml")
+    page = fetch_page(url)
+    soup = parse_soup(page)
     
     return soup
 
@@ -240,94 +277,46 @@ def find_num_inventors(soup):
 
 
 ### function to compute average word-vector for a text
+# it returns a vector of size (1, dim), zero if no word is in the vocabulary
+# use claim_embedding.embed_documents for many texts at once
 def dec_vec(model, text):
-    # store the vector for each word
-    vectors = []
-    
-    # compute on each word
-    for j in range(len(text)):
-        try:
-            vectors.append(model.wv[text[j]])
-        except:
-            continue
-    
-    if not vectors:
-        vectors_mean = np.zeros((1, 100))
-    else:
-        vectors_mean = np.nanmean(vectors, axis = 0)
-        vectors_mean = vectors_mean.reshape((1, 100))
-    
-    # return vector mean
-    return vectors_mean
+    return claim_embedding.embed_document(model, text)
 
 
 
 ### function to tokenize and clean a text
+# the stop list, lemmatizer and number pattern are built once by claim_tokenizer
+# use claim_tokenizer.tokenize_many for many texts at once
 def tokenize_cleaning(text):
-    # tokenize the text first
-    try:
-        tokens = word_tokenize(text.decode('utf-8'))
-    except:
-        tokens = word_tokenize(text)
-    
-    # lowercase all the words
-    tokens = [w.lower() for w in tokens]
-    
-    # clean up stop words and punctuations 
-    stop_list = stopwords.words('english') + list(string.punctuation)
-
-    tokens_no_stop = [token for token in tokens
-                        if token not in stop_list]            
-
-    # use lemma instead
-    # reason: remove the influence of plural or tense
-    # but retain the subtle difference in legal writting
-    lemmatizer = WordNetLemmatizer()
-    tokens_lemma = [lemmatizer.lemmatize(token) for token in tokens_no_stop]
-    
-    # remove numbers (the actual values are not useful)
-    tokens_no_num = []
-    for token in tokens_lemma:
-        try:
-            float(token)
-        except:
-            tokens_no_num.append(token)
-    
-    return tokens_no_num
+    with metrics.timer('tokenize'):
+        return claim_tokenizer.tokenize_cleaning(text)
 
 
 
 ### function to format claims of a patent by trained word2vec
 # for the new patents input into the webapp
 # it returns a vector of size (1, 100)
-def format_claims(text):
-    # tokenize the text first
-    cleaned_text = tokenize_cleaning(text)
-    
+# an already loaded word2vec model can be passed to avoid reading it again
+# claims already seen are read from claim_cache (same vector as dec_vec)
+def format_claims(text, word2vec_model=None):
     # read the model
-    word2vec_model = Word2Vec.load('models/word2vec_claims_final')
+    if word2vec_model is None:
+        word2vec_model = Word2Vec.load('models/word2vec_claims_final')
     
-    # compute the vector for the cleaned text
-    vec = dec_vec(word2vec_model, cleaned_text)
+    # cached vector, or tokenize the text and compute its vector
+    # (includes the tokenization of claims missing from the claim cache)
+    with metrics.timer('embed'):
+        vec = claim_cache.embed([text], word2vec_model, tokenizer = tokenize_cleaning)
     
     return vec
 
 
 ### function to read all the relevant information of a new patent
 # intercept column is added to the features (first one)
-def read_patent_info(soup, WO_index):
+def read_patent_info(soup, WO_index, word2vec_model=None):
     
     # add top classification of the patent
     patent_class = find_patent_class(soup)
-    # one-hot encode the classes
-    class_one_hot = np.zeros(7)
-    classes = ['B', 'C', 'D', 'E', 'F', 'G', 'H']
-    
-    for i in range(len(classes)):
-        ind_class = classes[i]
-        if patent_class == ind_class:
-            class_one_hot[i] = 1
-    class_one_hot = class_one_hot.reshape((1, 7))
     
     # number of fine applications
     num_applications = find_patent_applications(soup)
@@ -350,13 +339,44 @@ def read_patent_info(soup, WO_index):
     # all other features except for classification
     patent_nontext = [num_applications, patent_citations, non_patent_citations,
                       num_claims, similar_doc_num, num_authors]
-    patent_nontext = np.asarray(patent_nontext)
-    patent_nontext = patent_nontext.reshape((1, 6))
-    # combine with classification
-    patent_nontext = np.concatenate([class_one_hot, patent_nontext], axis = 1)
+    
+    return format_features(patent_class, patent_nontext, claim_content,
+                           word2vec_model)
+
+
+### function to read all the relevant information of a new patent from its page
+# the page is read in a single pass by page_extractor (no BeautifulSoup tree)
+# input: html page, WO_index (1 for international patents), word2vec model
+# output: PatentRecord with the page information and the predictors
+def read_patent_page(page, WO_index, word2vec_model=None):
+    if WO_index == 0:
+        claim_text = CLAIM_TEXT
+    else:
+        claim_text = CLAIM_TEXT_WO
+    with metrics.timer('parse'):
+        record = page_extractor.extract_page(page, WO_index, claim_text)
+    
+    # non-text predictors of the record, combined with the claim vector
+    patent_features = np.concatenate([feature_builder.from_records([record]),
+                                      format_claims(record.claim_content, word2vec_model)],
+                                     axis = 1)
+    
+    return record, patent_features
+
+
+### function to format the predictors of a patent
+# input: top classification, list of the 6 non-text features, claim text
+# output: predictors of size (1, 113)
+def format_features(patent_class, patent_nontext, claim_content,
+                    word2vec_model=None):
+    # one-hot encoded class and counts, of size (1, 13)
+    columns = dict((column, [value]) for column, value in
+                   zip(feature_builder.NONTEXT_COLUMNS, patent_nontext))
+    columns['classification'] = [patent_class]
+    patent_nontext = feature_builder.build(columns)
     
     # format claims by the trained word2vec
-    patent_claims = format_claims(claim_content)
+    patent_claims = format_claims(claim_content, word2vec_model)
     # combine the text vector with the non-text features
     patent_features = np.concatenate([patent_nontext, patent_claims], axis = 1)
     
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import model_registry as models
+
+##### Cache of the predictions of the scoring pages #####
+# predictions are keyed by patent number (or a hash of the manual inputs)
+# and by a fingerprint of the loaded models, so loading new models
+# invalidates the cached predictions (the entries of the old models are
+# dropped by the memory backend, and expire from the shared sqlite file)
+#
+# two backends are available:
+# MemoryBackend: LRU dictionary in the process (default)
+# SqliteBackend: sqlite file shared by the workers of a deployment
+#                (used when PREDICTION_CACHE_PATH is set)
+
+
+# models the predictions depend on (the bundle, or the separate files)
+MODEL_NAMES = ['bundle', 'scaler', 'model', 'word2vec', 'patent_index']
+
+# default size and time to live (seconds)
+MAX_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', 10000))
+TTL = float(os.environ.get('PREDICTION_CACHE_TTL', 24 * 3600))
+
+
+### LRU dictionary with time to live
+class MemoryBackend(object):
+    def __init__(self, max_size=MAX_SIZE, ttl=TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                return None
+            # most recently used entries are at the end
+            self.entries[key] = entry
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # new models: the entries of this process can no longer be read
+    def invalidate(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+### LRU table with time to live in a sqlite file shared by processes
+# values are stored as JSON
+class SqliteBackend(object):
+    def __init__(self, path, max_size=MAX_SIZE, ttl=TTL):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        # connection of each thread: (process id, connection)
+        self.local = threading.local()
+        con = self._connect()
+        with con:
+            con.execute("""CREATE TABLE IF NOT EXISTS predictions (
+                               key TEXT PRIMARY KEY,
+                               value TEXT NOT NULL,
+                               stored_at REAL NOT NULL,
+                               accessed_at REAL NOT NULL)""")
+            con.execute("""CREATE INDEX IF NOT EXISTS predictions_accessed
+                               ON predictions (accessed_at)""")
+
+    # one connection per thread and process (a forked worker opens its own)
+    def _connect(self):
+        pid, con = getattr(self.local, 'connection', (None, None))
+        if pid != os.getpid():
+            con = sqlite3.connect(self.path, timeout = 30)
+            con.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = (os.getpid(), con)
+        return con
+
+    def get(self, key):
+        con = self._connect()
+        row = con.execute('SELECT value, stored_at FROM predictions WHERE key = ?',
+                          (key,)).fetchone()
+        if row is None:
+            return None
+        value, stored_at = row
+        now = time.time()
+        if self.ttl is not None and now - stored_at > self.ttl:
+            return None
+        with con:
+            con.execute('UPDATE predictions SET accessed_at = ? WHERE key = ?',
+                        (now, key))
+        return json.loads(value)
+
+    def put(self, key, value):
+        now = time.time()
+        con = self._connect()
+        with con:
+            con.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)',
+                        (key, json.dumps(value), now, now))
+            # remove the least recently used entries over the size limit
+            con.execute("""DELETE FROM predictions WHERE key IN (
+                               SELECT key FROM predictions ORDER BY accessed_at DESC
+                               LIMIT -1 OFFSET ?)""", (self.max_size,))
+
+    def clear(self):
+        con = self._connect()
+        with con:
+            con.execute('DELETE FROM predictions')
+
+    # new models: the other workers may already have written entries for
+    # them, so the entries of the old models are left to the size limit
+    # and the time to live
+    def invalidate(self):
+        pass
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+
+
+# backend in use, fingerprint of the models of the cached entries, counters
+_state = {'backend': None, 'fingerprint': None}
+_counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+_lock = threading.Lock()
+
+
+### function to choose the backend of the cache
+def set_backend(backend):
+    with _lock:
+        _state['backend'] = backend
+        _state['fingerprint'] = None
+
+
+### function to get the backend (chosen from the environment on first use)
+def backend():
+    if _state['backend'] is None:
+        path = os.environ.get('PREDICTION_CACHE_PATH')
+        if path:
+            set_backend(SqliteBackend(path))
+        else:
+            set_backend(MemoryBackend())
+    return _state['backend']
+
+
+### function to build the versioned key of a prediction
+# the backend is told when the fingerprint changes
+def _versioned_key(key):
+    fingerprint = models.fingerprint(MODEL_NAMES)
+    cache = backend()
+    if fingerprint != _state['fingerprint']:
+        with _lock:
+            if _state['fingerprint'] is not None:
+                cache.invalidate()
+                _counters['invalidations'] += 1
+            _state['fingerprint'] = fingerprint
+
+    return hashlib.sha1((fingerprint + '|' + key).encode('utf-8')).hexdigest()
+
+
+### function to build the key of a patent number
+def patent_key(patent_number):
+    return 'patent:' + patent_number
+
+
+### function to build the key of the manual inputs
+# the inputs are normalized so that equivalent forms share the prediction
+# (the title does not change the prediction and is left out)
+def manual_key(form):
+    normalized = {
+        'patent_class': form['patent_class'].strip().upper(),
+        'claims': ' '.join(form['claims'].split()),
+    }
+    for field in ['num_authors', 'num_applications', 'patent_citations',
+                  'non_patent_citations', 'num_claims', 'num_similar_doc']:
+        normalized[field] = float(form[field])
+
+    return 'manual:' + hashlib.sha1(json.dumps(normalized, sort_keys = True)
+                                    .encode('utf-8')).hexdigest()
+
+
+### function to read a cached prediction
+# output: cached value or None
+def get(key):
+    value = backend().get(_versioned_key(key))
+    with _lock:
+        if value is None:
+            _counters['misses'] += 1
+        else:
+            _counters['hits'] += 1
+    return value
+
+
+### function to store a prediction
+def put(key, value):
+    backend().put(_versioned_key(key), value)
+
+
+### function to report the hit and miss counters of this process
+def stats():
+    report = dict(_counters)
+    report['size'] = len(backend())
+    report['backend'] = type(backend()).__name__
+    return report
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+from multiprocessing.pool import ThreadPool
+import patent_scraper as ps
+import model_registry as models
+import patent_index
+import forest_compiler
+import prediction_cache
+import http_client
+import metrics
+import feature_builder
+import claim_cache
+import similar_patents
+
+##### Functions to score patents with the final model #####
+# shared by the single patent pages and the batch API
+
+
+# number of threads downloading and reading patent pages in a batch
+BATCH_WORKERS = 8
+# maximum number of patents in one batch request
+MAX_BATCH_SIZE = 1000
+# maximum number of similar patents per query
+MAX_SIMILAR = 100
+# seconds a page waits for a patent scored on a fetch thread
+REQUEST_TIMEOUT = float(os.environ.get('SCORING_TIMEOUT', 20))
+
+# fields of the manual input form
+MANUAL_FIELDS = ['title', 'num_authors', 'patent_class', 'num_applications',
+                 'patent_citations', 'non_patent_citations', 'num_claims',
+                 'claims', 'num_similar_doc']
+
+
+### function to clean a patent number typed by a user
+def clean_patent_number(patent_number):
+    # remove leading and trailing space, and the spaces in the string
+    return patent_number.strip().replace(' ', '')
+
+
+### function to find a patent in the index of known patents
+# input: patent number, word2vec vectors used for the other patents
+# output: title and predictors of size (1, 113), or None if unknown
+#         (or if the index was built with other word2vec vectors)
+def known_patent(patent_number, word2vec_model):
+    try:
+        index = models.get('patent_index')
+    except (IOError, OSError):
+        # the index has not been built
+        return None
+    if not patent_index.built_with(index, word2vec_model):
+        # stale claim vectors: the patents are read like unknown ones
+        metrics.count('stale_patent_index')
+        return None
+
+    with metrics.timer('index_lookup'):
+        return patent_index.lookup(index, patent_number)
+
+
+### function to read the predictors of a patent
+# known patents are read from the index, the others from Google Patents
+# input: patent number, word2vec vectors (the registered ones by default)
+# output: title and predictors of size (1, 113)
+def patent_predictors(patent_number, word2vec_model=None):
+    if word2vec_model is None:
+        word2vec_model = models.get('word2vec')
+    known = known_patent(patent_number, word2vec_model)
+    if known is not None:
+        return known
+
+    # url to the patent page
+    url = 'https://patents.google.com/patent/' + patent_number + '/en'
+
+    # check if a patent is international patent (different format)
+    if patent_number[:2] == 'WO':
+        WO_index = 1
+    else:
+        WO_index = 0
+
+    try:
+        # page cache lookup and download on a miss
+        with metrics.timer('fetch'):
+            page = ps.fetch_page(url)
+        record, predictors = ps.read_patent_page(page, WO_index, word2vec_model)
+    except Exception:
+        metrics.count('scrape_failures')
+        raise
+
+    return record.title, predictors
+
+
+### function to format the predictors of a manually entered patent
+# input: dictionary with the fields of the manual input form,
+#        word2vec vectors (the registered ones by default)
+# output: predictors of size (1, 113)
+def manual_predictors(form, word2vec_model=None):
+    if word2vec_model is None:
+        word2vec_model = models.get('word2vec')
+    return np.concatenate([feature_builder.from_forms([form]),
+                           ps.format_claims(form['claims'], word2vec_model)],
+                          axis = 1)
+
+
+### function to predict the probabilities of a set of patents
+# the scaler and the model are called once on the whole matrix
+# (the compiled forest of forest_compiler.py gives the same probabilities)
+# input: predictors of size (n, 113), models of models.get_models (the
+#        ones used to compute the predictors; the current ones by default)
+# output: probabilities of size (n, 2) (not useful, useful)
+def predict(predictors, used=None):
+    used = used or models.get_models()
+    scaler = used['scaler']
+    model = used['model']
+    with metrics.timer('predict'):
+        predictors = scaler.transform(predictors)
+        if isinstance(model, dict):
+            return forest_compiler.predict_proba(model, predictors)
+        return model.predict_proba(predictors)
+
+
+### function to turn the probabilities into the displayed result
+def result_label(proba):
+    if proba[0] > 0.5:
+        return 'not useful'
+    else:
+        return 'useful'
+
+
+### function to score one patent number
+# predictions are cached by prediction_cache
+# input: patent number
+# output: title and probabilities (not useful, useful)
+def score_patent(patent_number):
+    key = prediction_cache.patent_key(patent_number)
+    cached = prediction_cache.get(key)
+    if cached is not None:
+        return cached['title'], cached['proba']
+
+    # the same version of the models for the claim vector and the prediction
+    used = models.get_models()
+    title, predictors = patent_predictors(patent_number, used['word2vec'])
+    proba = [float(p) for p in predict(predictors, used)[0]]
+    prediction_cache.put(key, {'title': title, 'proba': proba})
+
+    return title, proba
+
+
+### function to score one patent number on a fetch thread of http_client
+# this only bounds the wait of the request thread: the caller stops waiting
+# after REQUEST_TIMEOUT, while the fetch thread finishes the download and
+# caches the page and the prediction for the next request
+# output: AsyncResult of score_patent (.get(timeout) raises
+#         multiprocessing.TimeoutError if it is not finished in time)
+def score_patent_async(patent_number):
+    return http_client.submit(metrics.bind_trace(score_patent), patent_number)
+
+
+### function to score one manually entered patent
+# predictions are cached by prediction_cache
+# input: dictionary with the fields of the manual input form
+# output: probabilities (not useful, useful)
+def score_manual(form):
+    key = prediction_cache.manual_key(form)
+    cached = prediction_cache.get(key)
+    if cached is not None:
+        return cached['proba']
+
+    used = models.get_models()
+    proba = [float(p) for p in predict(manual_predictors(form, used['word2vec']), used)[0]]
+    prediction_cache.put(key, {'proba': proba})
+
+    return proba
+
+
+### function to read the predictors of one batch item
+# cached predictions are returned in place of the predictors
+# errors are returned so that one patent does not fail the whole batch
+# input: ('patent', number) or ('manual', form), models of models.get_models
+# output: result information, predictors or None, cache key
+def _batch_item(item, used):
+    kind, value = item
+    key = None
+    try:
+        if kind == 'patent':
+            info = {'patent_number': value}
+            value = info['patent_number'] = clean_patent_number(value)
+            key = prediction_cache.patent_key(value)
+        else:
+            info = {'title': value.get('title') if hasattr(value, 'get') else None}
+            missing = [field for field in MANUAL_FIELDS if field not in value]
+            if missing:
+                raise ValueError('missing fields: ' + ', '.join(missing))
+            key = prediction_cache.manual_key(value)
+
+        cached = prediction_cache.get(key)
+        if cached is not None:
+            if kind == 'patent':
+                info['title'] = cached['title']
+            info['proba'] = cached['proba']
+            info['result'] = result_label(cached['proba'])
+            return info, None, key
+
+        if kind == 'patent':
+            info['title'], predictors = patent_predictors(value, used['word2vec'])
+        else:
+            predictors = manual_predictors(value, used['word2vec'])
+        return info, predictors, key
+    except Exception as e:
+        info['error'] = '%s: %s' % (type(e).__name__, e)
+        return info, None, key
+
+
+### function to score a batch of patents
+# input: list of patent numbers, list of manual input dictionaries
+# output: list of results in the input order (patent numbers first),
+#         each result has either the probabilities or an error
+def score_batch(patent_numbers=(), manual=()):
+    items = ([('patent', number) for number in patent_numbers] +
+             [('manual', form) for form in manual])
+    if not items:
+        return []
+
+    # one version of the models for the whole batch
+    used = models.get_models()
+    # download and read the patents concurrently
+    pool = ThreadPool(min(BATCH_WORKERS, len(items)))
+    try:
+        read = pool.map(lambda item: _batch_item(item, used), items)
+    finally:
+        pool.close()
+
+    # stack the predictors of all the patents read without error
+    rows = [i for i, (info, predictors, key) in enumerate(read)
+            if predictors is not None]
+    results = [info for info, predictors, key in read]
+
+    if rows:
+        y_pred = predict(np.concatenate([read[i][1] for i in rows], axis = 0), used)
+        for proba, i in zip(y_pred, rows):
+            proba = [float(p) for p in proba]
+            results[i]['proba'] = proba
+            results[i]['result'] = result_label(proba)
+
+            cached = {'proba': proba}
+            if items[i][0] == 'patent':
+                cached['title'] = results[i]['title']
+            prediction_cache.put(read[i][2], cached)
+
+    return results
+
+
+### function to read the claim vector of one similar patent query
+# patents of the similar patent index use their indexed vector, the others
+# are read like score_patent (errors are returned, like _batch_item)
+# input: loaded similar patent index, patent number, word2vec vectors
+# output: result information, claim vector or None, row to leave out
+def _similar_item(index, patent_number, word2vec_model):
+    info = {'patent_number': patent_number}
+    try:
+        row = index['rows'].get(patent_number)
+        if row is not None:
+            info['title'] = index['titles'][row]
+            return info, index['vectors'][row], row
+
+        info['title'], predictors = patent_predictors(patent_number, word2vec_model)
+        return info, predictors[0, similar_patents.VECTOR_OFFSET:], -1
+    except Exception as e:
+        info['error'] = '%s: %s' % (type(e).__name__, e)
+        return info, None, -1
+
+
+### function to find the known patents most similar to a set of patents
+# the queries are searched together in the similar patent index (a query
+# patent is left out of its own results)
+# input: list of patent numbers, list of claim texts, number of similar patents,
+#        loaded similar patent index (the registered one by default)
+# output: list of results in the input order (patent numbers first), each
+#         result has either the similar patents or an error (claims without
+#         any word of the word2vec vocabulary have no vector to compare)
+# raises IOError if the similar patent index has not been built,
+# similar_patents.StaleIndexError if it was built with other word2vec vectors
+def similar_batch(patent_numbers=(), claims=(), k=similar_patents.K, index=None):
+    if index is None:
+        index = models.get('similar_index')
+    # the queries are embedded with the vectors of the index
+    word2vec_model = models.get('word2vec')
+    if not patent_index.built_with(index, word2vec_model):
+        raise similar_patents.StaleIndexError(
+            'the similar patent index was built with other word2vec vectors')
+    k = max(1, min(int(k), MAX_SIMILAR))
+    patent_numbers = [clean_patent_number(number) for number in patent_numbers]
+
+    read = []
+    if patent_numbers:
+        # download and read the unknown patents concurrently
+        pool = ThreadPool(min(BATCH_WORKERS, len(patent_numbers)))
+        try:
+            read = pool.map(lambda number: _similar_item(index, number, word2vec_model),
+                            patent_numbers)
+        finally:
+            pool.close()
+    if claims:
+        # all the claim texts are embedded at once
+        with metrics.timer('embed'):
+            vectors = claim_cache.embed(list(claims), word2vec_model,
+                                        tokenizer = ps.tokenize_cleaning)
+        read.extend(({}, vector, -1) for vector in vectors)
+
+    for info, vector, exclude in read:
+        if vector is not None and not np.any(vector):
+            info['error'] = 'ValueError: no known words in the claims'
+    rows = [i for i, (info, vector, exclude) in enumerate(read)
+            if vector is not None and 'error' not in info]
+    results = [info for info, vector, exclude in read]
+
+    if rows:
+        with metrics.timer('similar_search'):
+            similar = similar_patents.similar(index, [read[i][1] for i in rows], k,
+                                              [read[i][2] for i in rows])
+        for patents, i in zip(similar, rows):
+            results[i]['similar'] = patents
+
+    return results
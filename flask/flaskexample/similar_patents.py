@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import feature_builder
+import versioned_folder
+
+##### Nearest neighbour search over the claim vectors #####
+# the averaged word2vec vectors of the claims of the known patents are saved
+# as unit length float32 rows, so the cosine similarity of a set of queries
+# with all the patents is one matrix product; the search is exact and runs
+# block by block over the patents (and the queries), keeping the k best
+# patents of each query, so the memory does not grow with the corpus
+#
+# the exact search reads every vector for every query (about 10 ms for 100k
+# patents); an index built with clusters also saves the patents grouped by
+# spherical k-means cluster, and a query can then compare only the patents of
+# the n_probe clusters with the closest centroids (approximate, see the recall
+# of benchmark)
+#
+# the vectors of a patent page or a manual input come from format_claims
+# (the same embedding as the predictors of the model)
+#
+# an index is written into a new version folder and published by
+# versioned_folder.py, so a reader never mixes the files of two versions
+#
+# the index records the version of the word2vec model of its vectors (taken
+# from the patent index it is built from); queries embedded by another model
+# must not be compared with them (patent_index.built_with)
+#
+# layout of an index folder:
+#   ids.json          patent numbers in row order
+#   titles.json       titles in row order
+#   meta.json         version of the word2vec model of the vectors
+#   vectors.npy       float32 unit vectors of size (number of patents, dim)
+#   centroids.npy     optional: unit centroids of the clusters
+#   offsets.npy       optional: first row of each cluster (and the last row + 1)
+
+
+# first column of the claim vector in the 113 predictors
+VECTOR_OFFSET = len(feature_builder.CLASSES) + len(feature_builder.NONTEXT_COLUMNS)
+# patents and queries compared at once (a block of scores is
+# QUERY_BLOCK_SIZE x BLOCK_SIZE floats)
+BLOCK_SIZE = 16384
+QUERY_BLOCK_SIZE = 256
+# default number of similar patents
+K = 10
+# default number of clusters compared by a query of a clustered index
+N_PROBE = 8
+
+
+### error raised when an index was built with another word2vec model
+class StaleIndexError(ValueError):
+    pass
+
+
+### function to scale vectors to unit length
+# vectors of claims without known words (all zeros) stay zero
+# input: matrix of size (n, dim)
+# output: float32 matrix of size (n, dim)
+def normalize(vectors):
+    vectors = np.array(vectors, dtype = np.float32, ndmin = 2)
+    norms = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+    norms[norms == 0] = 1.0
+    return vectors / norms[:, None]
+
+
+### function to cluster unit vectors by spherical k-means
+# input: unit vectors, number of clusters, iterations, number of vectors
+#        used to fit the centroids, random seed
+# output: unit centroids of size (n_clusters, dim)
+def kmeans(vectors, n_clusters, iterations=10, sample_size=50000, seed=0):
+    rng = np.random.RandomState(seed)
+    sample = np.asarray(vectors[np.sort(rng.permutation(len(vectors))[:sample_size])])
+    centroids = sample[rng.permutation(len(sample))[:n_clusters]]
+    for _ in range(iterations):
+        labels = search({'vectors': centroids}, sample, 1)[0][:, 0]
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        # empty clusters keep their centroid
+        empty = np.bincount(labels, minlength = len(centroids)) == 0
+        sums[empty] = centroids[empty]
+        centroids = normalize(sums)
+    return centroids
+
+
+### function to group unit vectors by cluster
+# input: unit vectors, number of clusters
+# output: order of the rows grouped by cluster, unit centroids, first row of
+#         each cluster in that order (and the number of rows)
+def cluster(vectors, n_clusters):
+    centroids = kmeans(vectors, n_clusters)
+    labels = search({'vectors': centroids}, vectors, 1)[0][:, 0]
+    order = np.argsort(labels, kind = 'mergesort')
+    offsets = np.searchsorted(labels[order], np.arange(n_clusters + 1)).astype(np.int64)
+    return order, centroids, offsets
+
+
+### function to save an index
+# input: index folder, list of patent numbers, list of titles,
+#        claim vectors of size (number of patents, dim),
+#        number of clusters (0: exact search only),
+#        version of the word2vec model of the vectors
+def save_index(path, ids, titles, vectors, n_clusters=0, word2vec_version=None):
+    folder = versioned_folder.new_version(path)
+    vectors = normalize(vectors)
+    ids, titles = list(ids), list(titles)
+
+    if n_clusters:
+        order, centroids, offsets = cluster(vectors, n_clusters)
+        vectors = vectors[order]
+        ids = [ids[i] for i in order]
+        titles = [titles[i] for i in order]
+        np.save(os.path.join(folder, 'centroids.npy'), centroids)
+        np.save(os.path.join(folder, 'offsets.npy'), offsets)
+
+    with open(os.path.join(folder, 'ids.json'), 'w') as f:
+        json.dump(ids, f)
+    with open(os.path.join(folder, 'titles.json'), 'w') as f:
+        json.dump(titles, f)
+    with open(os.path.join(folder, 'meta.json'), 'w') as f:
+        json.dump({'word2vec_version': word2vec_version}, f)
+    np.save(os.path.join(folder, 'vectors.npy'), vectors)
+
+    # readers reload the index when the published vectors change
+    versioned_folder.publish(path, folder)
+
+
+### function to build an index from the predictors of a patent index
+# input: patent index folder (patent_index.py), similar patent index folder,
+#        number of clusters (0: exact search only)
+def build_from_patent_index(index_path, path, n_clusters=0):
+    import patent_index
+
+    index = patent_index.load_index(os.path.join(index_path, 'predictors.npy'))
+    ids = [None] * len(index['rows'])
+    for patent_number, row in index['rows'].items():
+        ids[row] = patent_number
+
+    save_index(path, ids, index['titles'], index['predictors'][:, VECTOR_OFFSET:],
+               n_clusters, index['word2vec_version'])
+
+
+### function to load an index
+# input: path to the vectors.npy file of the index folder
+# output: dictionary with the patent numbers, the row of each patent,
+#         the titles, the memory-mapped unit vectors, the clusters
+#         (centroids and offsets, None if the index has no clusters) and
+#         the version of the word2vec model (None if it was not saved)
+def load_index(path):
+    # all the files are read from the same version
+    folder = versioned_folder.resolve(os.path.dirname(path))
+    with open(os.path.join(folder, 'ids.json'), 'r') as f:
+        ids = json.load(f)
+    with open(os.path.join(folder, 'titles.json'), 'r') as f:
+        titles = json.load(f)
+    meta = {}
+    if os.path.exists(os.path.join(folder, 'meta.json')):
+        with open(os.path.join(folder, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+    index = {
+        'ids': ids,
+        'rows': dict((patent_number, i) for i, patent_number in enumerate(ids)),
+        'titles': titles,
+        'vectors': np.load(os.path.join(folder, os.path.basename(path)), mmap_mode = 'r'),
+        'centroids': None,
+        'offsets': None,
+        'word2vec_version': meta.get('word2vec_version'),
+    }
+    if os.path.exists(os.path.join(folder, 'centroids.npy')):
+        index['centroids'] = np.load(os.path.join(folder, 'centroids.npy'))
+        index['offsets'] = np.load(os.path.join(folder, 'offsets.npy'))
+
+    return index
+
+
+### function to find the k most similar patents of a set of queries
+# input: loaded index (or dictionary with a 'vectors' matrix of unit rows),
+#        query vectors of size (n, dim) (scaled to unit length here),
+#        number of patents per query, rows to leave out of the results of
+#        each query (e.g. the query patent itself, -1 for none),
+#        clusters compared by each query (exact search if 0 or if the
+#        index has no clusters)
+# output: rows of size (n, k) and cosine similarities of size (n, k),
+#         most similar first (similarity -inf if fewer than k patents
+#         were compared)
+def search(index, queries, k=K, exclude=None, n_probe=0, block_size=BLOCK_SIZE,
+           query_block_size=QUERY_BLOCK_SIZE):
+    vectors = index['vectors']
+    queries = normalize(queries)
+    n_queries = len(queries)
+    k = min(k, len(vectors))
+    exclude = (np.full(n_queries, -1, dtype = np.int64) if exclude is None
+               else np.asarray(exclude, dtype = np.int64))
+    if n_probe and index.get('centroids') is not None:
+        return _search_clusters(index, queries, k, exclude, n_probe)
+
+    best_rows = np.zeros((n_queries, k), dtype = np.int64)
+    best_scores = np.zeros((n_queries, k), dtype = np.float32)
+    for first_query in range(0, n_queries, query_block_size):
+        query_rows = slice(first_query, first_query + query_block_size)
+        block_queries = queries[query_rows]
+        positions = np.arange(len(block_queries))[:, None]
+        rows = np.zeros((len(block_queries), 0), dtype = np.int64)
+        scores = np.zeros((len(block_queries), 0), dtype = np.float32)
+
+        for first in range(0, len(vectors), block_size):
+            block = np.dot(block_queries, vectors[first:first + block_size].T)
+            # excluded rows of this block
+            excluded = exclude[query_rows] - first
+            hit = (excluded >= 0) & (excluded < block.shape[1])
+            block[np.flatnonzero(hit), excluded[hit]] = -np.inf
+
+            # k best of the block, merged with the k best so far
+            top = np.argpartition(-block, min(k, block.shape[1]) - 1, axis = 1)[:, :k]
+            rows = np.concatenate([rows, top + first], axis = 1)
+            scores = np.concatenate([scores, block[positions, top]], axis = 1)
+            if rows.shape[1] > k:
+                keep = np.argpartition(-scores, k - 1, axis = 1)[:, :k]
+                rows, scores = rows[positions, keep], scores[positions, keep]
+
+        order = np.argsort(-scores, axis = 1, kind = 'mergesort')
+        best_rows[query_rows] = rows[positions, order]
+        best_scores[query_rows] = scores[positions, order]
+
+    return best_rows, best_scores
+
+
+### function to search the patents of the closest clusters only
+# input: loaded index with clusters, unit queries, number of patents per
+#        query, excluded row of each query, clusters compared by each query
+# output: same as search
+def _search_clusters(index, queries, k, exclude, n_probe):
+    vectors, offsets = index['vectors'], index['offsets']
+    probes = search({'vectors': index['centroids']}, queries, n_probe)[0]
+
+    best_rows = np.zeros((len(queries), k), dtype = np.int64)
+    best_scores = np.full((len(queries), k), -np.inf, dtype = np.float32)
+    for i, (query, clusters) in enumerate(zip(queries, probes)):
+        # the patents of a cluster are contiguous rows
+        rows = np.concatenate([np.arange(offsets[c], offsets[c + 1]) for c in clusters])
+        scores = np.concatenate([np.dot(vectors[offsets[c]:offsets[c + 1]], query)
+                                 for c in clusters])
+        scores[rows == exclude[i]] = -np.inf
+        top = np.arange(len(scores))
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind = 'mergesort')]
+        best_rows[i, :len(top)] = rows[top]
+        best_scores[i, :len(top)] = scores[top]
+
+    return best_rows, best_scores
+
+
+### function to search the similar patents and describe them
+# input: loaded index, query vectors, number of patents per query,
+#        rows to leave out of the results of each query, clusters compared
+#        by each query (N_PROBE for clustered indexes by default)
+# output: list (one per query) of lists of dictionaries with the patent
+#         number, title and cosine similarity of the similar patents
+def similar(index, queries, k=K, exclude=None, n_probe=N_PROBE):
+    rows, scores = search(index, queries, k, exclude, n_probe)
+    results = []
+    for query_rows, query_scores in zip(rows, scores):
+        results.append([{'patent_number': index['ids'][row], 'title': index['titles'][row],
+                         'score': float(score)}
+                        for row, score in zip(query_rows, query_scores)
+                        if np.isfinite(score)])
+    return results
+
+
+### function to find the k most similar patents by brute force
+# every similarity is computed in float64 at once and fully sorted
+# (the reference of the benchmark)
+# output: rows of size (n, k), similarity of the k-th patent of each query
+def brute_force(vectors, queries, k=K):
+    vectors = np.asarray(vectors, dtype = np.float64)
+    queries = normalize(queries).astype(np.float64)
+    scores = np.dot(queries, vectors.T)
+    rows = np.argsort(-scores, axis = 1, kind = 'mergesort')[:, :k]
+    return rows, scores[np.arange(len(queries)), rows[:, -1]]
+
+
+### function to measure the latency and recall of the search
+# input: index (dictionary with the unit vectors, and the centroids and
+#        offsets of a clustered index), query vectors, number of patents per
+#        query, clusters compared by each query (0: exact search),
+#        bulk size (queries per search call)
+# output: list of dictionaries (one per n_probe value) with the median and
+#         99th percentile latency of single queries (seconds), the queries
+#         per second in bulk and the recall of the k most similar patents
+#         against brute force (patents with the same similarity as the k-th
+#         count as found), and the seconds of the brute force search
+def benchmark(index, queries, k=K, n_probes=(0, N_PROBE), bulk_size=100):
+    vectors = index['vectors']
+    start = time.time()
+    expected, kth = brute_force(vectors, queries, k)
+    brute_seconds = time.time() - start
+    vectors64 = np.asarray(vectors, dtype = np.float64)
+    unit_queries = normalize(queries).astype(np.float64)
+
+    results = []
+    for n_probe in n_probes:
+        latencies = []
+        rows = []
+        for query in queries:
+            start = time.time()
+            rows.append(search(index, query, k, n_probe = n_probe)[0][0])
+            latencies.append(time.time() - start)
+        rows = np.asarray(rows)
+
+        start = time.time()
+        for first in range(0, len(queries), bulk_size):
+            search(index, queries[first:first + bulk_size], k, n_probe = n_probe)
+        bulk_seconds = time.time() - start
+
+        # similarities of the patents found, in float64
+        found = np.einsum('ijk,ik->ij', vectors64[rows], unit_queries)
+        # ties at the k-th similarity may be ordered differently
+        recall = np.sum(found >= kth[:, None] - 1e-6) / float(rows.size)
+
+        results.append({
+            'patents': len(vectors),
+            'queries': len(queries),
+            'k': k,
+            'n_probe': n_probe,
+            'median_seconds': float(np.median(latencies)),
+            'p99_seconds': float(np.percentile(latencies, 99)),
+            'bulk_queries_per_second': len(queries) / bulk_seconds,
+            'brute_force_seconds': brute_seconds,
+            'recall': float(recall),
+        })
+
+    return results
+
+
+### function to grow a set of vectors to a benchmark size
+# the vectors are repeated with small random perturbations
+# input: unit vectors, number of rows, random seed
+def synthetic_vectors(vectors, size, seed=0):
+    rng = np.random.RandomState(seed)
+    vectors = np.asarray(vectors, dtype = np.float32)
+    rows = rng.randint(0, len(vectors), size)
+    noise = rng.normal(0, 0.05, (size, vectors.shape[1])).astype(np.float32)
+    return normalize(vectors[rows] + noise)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description = 'Build or benchmark the similar patent index')
+    subparsers = parser.add_subparsers(dest = 'command')
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('--patent-index', default = 'models/patent_index')
+    build_parser.add_argument('-o', '--output', default = 'models/similar_index')
+    build_parser.add_argument('--clusters', type = int, default = 0,
+                              help = 'number of clusters (about the square root of '
+                              'the number of patents), 0 for exact search only')
+    bench_parser = subparsers.add_parser('benchmark')
+    bench_parser.add_argument('--index', default = 'models/similar_index')
+    bench_parser.add_argument('--size', type = int, default = None,
+                              help = 'grow the index to this number of patents '
+                              '(perturbed copies of the indexed vectors)')
+    bench_parser.add_argument('--clusters', type = int, default = None,
+                              help = 'cluster the benchmark vectors (by default the '
+                              'clusters of the index, none if it was grown)')
+    bench_parser.add_argument('--n-probe', type = int, nargs = '+', default = [0, 4, N_PROBE, 16])
+    bench_parser.add_argument('--queries', type = int, default = 200)
+    bench_parser.add_argument('-k', type = int, default = K)
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        build_from_patent_index(args.patent_index, args.output, args.clusters)
+        print('indexed %d patents in %s'
+              % (len(load_index(os.path.join(args.output, 'vectors.npy'))['ids']),
+                 args.output))
+    else:
+        index = load_index(os.path.join(args.index, 'vectors.npy'))
+        if args.size:
+            index = {'vectors': synthetic_vectors(index['vectors'], args.size),
+                     'centroids': None, 'offsets': None}
+        if args.clusters:
+            order, index['centroids'], index['offsets'] = cluster(index['vectors'],
+                                                                  args.clusters)
+            index['vectors'] = np.asarray(index['vectors'])[order]
+        n_probes = [n for n in args.n_probe if n == 0 or index['centroids'] is not None]
+
+        rng = np.random.RandomState(1)
+        queries = np.asarray(index['vectors'][rng.randint(0, len(index['vectors']),
+                                                          args.queries)])
+        queries = queries + rng.normal(0, 0.05, queries.shape).astype(np.float32)
+        results = benchmark(index, queries, args.k, n_probes)
+        print('%d patents, %d queries, brute force %.2fs'
+              % (results[0]['patents'], results[0]['queries'],
+                 results[0]['brute_force_seconds']))
+        for result in results:
+            print('%-8s median %6.2f ms, p99 %6.2f ms, %6.0f queries/s in bulk, recall@%d %.4f'
+                  % ('exact' if not result['n_probe'] else 'probe %d' % result['n_probe'],
+                     result['median_seconds'] * 1000, result['p99_seconds'] * 1000,
+                     result['bulk_queries_per_second'], result['k'], result['recall']))
+
+
+if __name__ == '__main__':
+    main()
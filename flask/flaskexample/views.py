@@ -1,10 +1,33 @@
 from flask import render_template
-from flask import request, redirect
+from flask import request, redirect, jsonify, Response
 from flaskexample import app
 import pandas as pd
 import pickle
 import numpy as np
 import patent_scraper as ps
+import model_registry as models
+import scoring
+import similar_patents
+import prediction_cache
+import metrics
+from multiprocessing import TimeoutError
+
+
+# seconds before the page of a patent still being scored is reloaded
+RETRY_AFTER = 5
+
+
+@app.before_request
+def start_request_trace():
+    # time the stages of the request, labelled by route (not by path, so that
+    # unknown urls do not create a histogram each)
+    rule = request.url_rule
+    metrics.start_trace(rule.rule if rule is not None else 'unmatched')
+
+
+@app.teardown_request
+def finish_request_trace(exception):
+    metrics.finish_trace()
 
 
 @app.route('/patent')
@@ -14,7 +37,7 @@ def patent_input():
 @app.route('/input')
 def patent_input2():
     # load the list of patent numbers
-    random_number = pickle.load(open('models/patent_numbers.p', 'r'))
+    random_number = models.get('patent_numbers')
     # randomly select a number
     choice = np.random.choice(range(len(random_number)), 1)
     # find the patent number
@@ -48,54 +71,60 @@ def error():
     return render_template("error.html")
 
 
+@app.route('/model_status')
+def model_status():
+    # load time and memory footprint of the shared models
+    return jsonify(models.stats())
+
+
+@app.route('/cache_status')
+def cache_status():
+    # hit and miss counters of the prediction cache
+    return jsonify(prediction_cache.stats())
+
+
+@app.route('/metrics')
+def metrics_text():
+    # stage and request latency histograms, failure and cache counters
+    cache = prediction_cache.stats()
+    counters = {'prediction_cache_hits': cache['hits'],
+                'prediction_cache_misses': cache['misses'],
+                'prediction_cache_invalidations': cache['invalidations']}
+    return Response(metrics.render(counters), mimetype = 'text/plain')
+
+
 @app.route('/output')
 def patent_output():
   #pull patent number from user input
   patent_number = request.args.get('patent_number')
-      
-  # remove leading and trailing space
-  patent_number = patent_number.strip()
-  # remove the spaces in the string
-  patent_number = patent_number.replace(' ', '')
   
   if patent_number is not None:
-     
-      ### scrape patent information from the Google patent page
-      # url to the patent page
-      url = 'https://patents.google.com/patent/' + patent_number + '/en'
-      soup = ps.generate_soup(url)
+      # remove leading and trailing space, and the spaces in the string
+      patent_number = scoring.clean_patent_number(patent_number)
       
-      # check if a patent is international patent (different format)
-      if patent_number[:2] == 'WO':
-          WO_index = 1
-      else:
-          WO_index = 0
-      
-      # read the predictors
+      ### scrape patent information from the Google patent page
+      # read the predictors and predict on the patent
+      # (this thread waits at most REQUEST_TIMEOUT for the fetch thread)
       try:
-          predictors = ps.read_patent_info(soup, WO_index)
-      except:
+          scored = scoring.score_patent_async(patent_number)
+          title, proba = scored.get(scoring.REQUEST_TIMEOUT)
+      except TimeoutError:
+          # the fetch thread keeps going and caches the page and the
+          # prediction: the reloaded page is answered from the caches
+          return (render_template("scoring.html", patent_number = patent_number,
+                                  retry_after = RETRY_AFTER),
+                  503, {'Retry-After': str(RETRY_AFTER)})
+      except Exception:
+          # unknown patent, unreadable page or missing model
+          app.logger.exception('scoring %s failed', patent_number)
           return redirect("/error")
       
-      # scale the predictors
-      scaler = pickle.load(open("models/final_model_scaler.p", 'r'))
-      predictors = scaler.transform(predictors)
-      
-      #input the model
-      model = pickle.load(open("models/final_model.p", 'r'))
-      
-      # predict on the patent
-      y_pred = model.predict_proba(predictors)
-      
       # format the result
       patents = []
       
-      patents.append(dict(patent_number=patent_number, title=ps.find_patent_title(soup), proba = y_pred[0]))
+      patents.append(dict(patent_number=patent_number, title=title, proba = proba))
       
-      if y_pred[0][0] > 0.5:
-          the_result = 'not useful' 
-      else:
-          the_result = 'useful'
+      the_result = scoring.result_label(proba)
       return render_template("output.html", patents = patents, the_result = the_result)
   
   else:
@@ -107,56 +136,110 @@ def patent_output():
 def patent_output2():
   #pull information from user input
   title = request.args.get('title').strip()
-  num_authors = request.args.get('num_authors')
-  patent_class = request.args.get('patent_class')
-  num_applications = request.args.get('num_applications')
-  patent_citations = request.args.get('patent_citations')
-  non_patent_citations = request.args.get('non_patent_citations')  
-  num_claims = request.args.get('num_claims')  
-  claims = request.args.get('claims')
-  num_similar_doc = request.args.get('num_similar_doc')
   
-  # format the non-text features
-  patent_nontext = [num_applications, patent_citations, non_patent_citations,
-                    num_claims, num_similar_doc, num_authors]
-  patent_nontext = np.asarray(patent_nontext)
-  patent_nontext = patent_nontext.reshape((1, 6))
+  # format the predictors and predict on the patent
+  proba = scoring.score_manual(request.args)
+  
+  # format the result
+  patents = []
+  patents.append(dict(title=title, proba = proba))
+  
+  # turn the result into binary
+  the_result = scoring.result_label(proba)
+  return render_template("output_manual.html", patents = patents, the_result = the_result)
+
+
+
+### function to read a list field of a JSON request
+# output: list (empty if the field is missing), or None if the field is not
+#         a list of items of the given types
+def json_list(data, name, types):
+  values = data.get(name)
+  if values is None:
+      return []
+  if not isinstance(values, list) or not all(isinstance(value, types) for value in values):
+      return None
+  return values
+
+
+@app.route('/batch_output', methods=['POST'])
+def batch_output():
+  # JSON input: {"patent_numbers": [...], "manual": [{manual form fields}, ...]}
+  data = request.get_json(force = True, silent = True)
+  if not isinstance(data, dict):
+      return jsonify(error = 'expected a JSON object'), 400
+  
+  patent_numbers = json_list(data, 'patent_numbers', basestring)
+  manual = json_list(data, 'manual', dict)
+  if patent_numbers is None or manual is None:
+      return jsonify(error = 'patent_numbers must be a list of strings and '
+                     'manual a list of objects'), 400
+  if len(patent_numbers) + len(manual) > scoring.MAX_BATCH_SIZE:
+      return jsonify(error = 'at most %d patents per batch' % scoring.MAX_BATCH_SIZE), 400
   
-  # one-hot encode the classes
-  class_one_hot = np.zeros(7)
-  classes = ['B', 'C', 'D', 'E', 'F', 'G', 'H']
-    
-  for i in range(len(classes)):
-      ind_class = classes[i]
-      if patent_class == ind_class:
-          class_one_hot[i] = 1
-  class_one_hot = class_one_hot.reshape((1, 7))
-  # combine with other features
-  patent_nontext = np.concatenate([class_one_hot, patent_nontext], axis = 1)
+  # per patent results, in the input order (patent numbers first)
+  results = scoring.score_batch(patent_numbers, manual)
   
+  return jsonify(results = results)
+
+
+
+@app.route('/similar')
+def similar_output():
+  # known patents with the most similar claims, for a patent number or claims
+  patent_number = request.args.get('patent_number', '').strip()
+  claims = request.args.get('claims', '').strip()
+  if not patent_number and not claims:
+      return jsonify(error = 'expected patent_number or claims'), 400
+  try:
+      k = int(request.args.get('k', similar_patents.K))
+  except ValueError:
+      return jsonify(error = 'k must be an integer'), 400
   
-  # format the claims
-  patent_claims = ps.format_claims(claims)
-  # combine the text vector with the non-text features
-  predictors = np.concatenate([patent_nontext, patent_claims], axis = 1)
+  try:
+      index = models.get('similar_index')
+  except (IOError, OSError):
+      return jsonify(error = 'the similar patent index has not been built'), 503
+  try:
+      if patent_number:
+          result = scoring.similar_batch([patent_number], k = k, index = index)[0]
+      else:
+          result = scoring.similar_batch(claims = [claims], k = k, index = index)[0]
+  except similar_patents.StaleIndexError as e:
+      return jsonify(error = str(e)), 503
   
-  # scale the predictors
-  scaler = pickle.load(open("models/final_model_scaler.p", 'r'))
-  predictors = scaler.transform(predictors)
+  if 'error' in result:
+      return jsonify(result), 404
+  return jsonify(result)
+
+
+@app.route('/batch_similar', methods=['POST'])
+def batch_similar():
+  # JSON input: {"patent_numbers": [...], "claims": [claim texts], "k": 10}
+  data = request.get_json(force = True, silent = True)
+  if not isinstance(data, dict):
+      return jsonify(error = 'expected a JSON object'), 400
   
-  #input the model
-  model = pickle.load(open("models/final_model.p", 'r'))
+  patent_numbers = json_list(data, 'patent_numbers', basestring)
+  claims = json_list(data, 'claims', basestring)
+  if patent_numbers is None or claims is None:
+      return jsonify(error = 'patent_numbers and claims must be lists of strings'), 400
+  if len(patent_numbers) + len(claims) > scoring.MAX_BATCH_SIZE:
+      return jsonify(error = 'at most %d patents per batch' % scoring.MAX_BATCH_SIZE), 400
+  try:
+      k = int(data.get('k', similar_patents.K))
+  except (TypeError, ValueError):
+      return jsonify(error = 'k must be an integer'), 400
   
-  # predict on the patent
-  y_pred = model.predict_proba(predictors)
+  try:
+      index = models.get('similar_index')
+  except (IOError, OSError):
+      return jsonify(error = 'the similar patent index has not been built'), 503
   
-  # format the result
-  patents = []
-  patents.append(dict(title=title, proba = y_pred[0]))
+  # per query results, in the input order (patent numbers first)
+  try:
+      results = scoring.similar_batch(patent_numbers, claims, k, index)
+  except similar_patents.StaleIndexError as e:
+      return jsonify(error = str(e)), 503
   
-  # turn the result into binary
-  if y_pred[0][0] > 0.5:
-      the_result = 'not useful' 
-  else:
-      the_result = 'useful'
-  return render_template("output_manual.html", patents = patents, the_result = the_result)
+  return jsonify(results = results)
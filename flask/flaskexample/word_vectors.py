@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import versioned_folder
+
+##### Inference-only word2vec vectors #####
+# the trained gensim model keeps its training state, but scoring only needs
+# the vocabulary and the vector matrix; the exported matrices are
+# memory-mapped, so all the workers of the webapp share the same pages
+#
+# each export is written into a new version folder and published by
+# versioned_folder.py, so a running webapp never reads the vocabulary of
+# one export with the matrix of another, or a half written matrix
+#
+# layout of an export folder:
+#   vocab.json            tokens in row order
+#   vectors_float32.npy   vector matrix
+#   vectors_float16.npy   optional half precision matrix
+#   vectors_int8.npy      optional int8 matrix
+#   scales_int8.npy       scale of each row of the int8 matrix
+
+
+PRECISIONS = ['float32', 'float16', 'int8']
+
+
+### function to find the matrix file of a precision
+def vectors_path(path, precision='float32'):
+    return os.path.join(path, 'vectors_%s.npy' % precision)
+
+
+### function to quantize a matrix to int8 with one scale per row
+# output: int8 matrix, float32 scales (row = int8 row * scale)
+def quantize_int8(vectors):
+    scales = np.abs(vectors).max(axis = 1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+
+    return quantized, scales.astype(np.float32)
+
+
+### function to export the vectors of a trained word2vec model
+# input: gensim word2vec model, export folder, precisions to export
+def export_vectors(model, path, precisions=('float32',)):
+    folder = versioned_folder.new_version(path)
+    write_vectors(model, folder, precisions)
+
+    # readers reload the vectors when the published matrix changes
+    versioned_folder.publish(path, folder)
+
+
+### function to write the vectors of a word2vec model into a new folder
+# (export_vectors, or the folder of a new model bundle)
+# input: gensim word2vec model or exported vectors, folder, precisions
+def write_vectors(model, path, precisions=('float32',)):
+    import claim_embedding
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    vocab, vectors, _ = claim_embedding.model_lookup(model)
+    tokens = [None] * len(vocab)
+    for token, row in vocab.items():
+        tokens[row] = token
+
+    with open(os.path.join(path, 'vocab.json'), 'w') as f:
+        json.dump(tokens, f)
+
+    vectors = np.asarray(vectors, dtype = np.float32)
+    for precision in precisions:
+        if precision == 'float32':
+            np.save(vectors_path(path, precision), vectors)
+        elif precision == 'float16':
+            np.save(vectors_path(path, precision), vectors.astype(np.float16))
+        elif precision == 'int8':
+            quantized, scales = quantize_int8(vectors)
+            np.save(vectors_path(path, precision), quantized)
+            np.save(os.path.join(path, 'scales_int8.npy'), scales)
+        else:
+            raise ValueError('unknown precision %s' % precision)
+
+
+### function to load exported vectors
+# input: export folder, precision of the matrix
+# output: dictionary with the vocabulary (token -> row), the memory-mapped
+#         matrix and the row scales (int8 only), usable in place of the
+#         word2vec model by claim_embedding and patent_scraper.format_claims
+def load_vectors(path, precision='float32'):
+    # all the files are read from the same version
+    path = versioned_folder.resolve(path)
+    with open(os.path.join(path, 'vocab.json'), 'r') as f:
+        tokens = json.load(f)
+
+    vectors = {
+        'vocab': dict((token, row) for row, token in enumerate(tokens)),
+        'vectors': np.load(vectors_path(path, precision), mmap_mode = 'r'),
+        'scales': None,
+        'precision': precision,
+    }
+    if precision == 'int8':
+        vectors['scales'] = np.load(os.path.join(path, 'scales_int8.npy'))
+
+    return vectors
+
+
+### function to read the resident memory of the process (bytes)
+def _current_rss():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+### function to measure load time and memory of a loader in a new process
+# the child process loads the vectors and embeds a document to touch them
+def _measure_load(loader, args, sample):
+    import multiprocessing
+    import claim_embedding
+
+    def child(queue):
+        rss_before = _current_rss()
+        start = time.time()
+        vectors = loader(*args)
+        claim_embedding.embed_document(vectors, sample)
+        seconds = time.time() - start
+        rss_after = _current_rss()
+        queue.put((seconds, rss_after - rss_before
+                   if rss_before is not None and rss_after is not None else None))
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target = child, args = (queue,))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    return result
+
+
+### function to compare the exported vectors with the original model
+# input: path of the gensim model, export folder, number of sample documents
+# output: dictionary precision -> accuracy drift, startup time and memory
+def report(model_path, path, n_docs=1000, doc_length=200, seed=0):
+    from gensim.models import Word2Vec
+    import claim_embedding
+
+    model = Word2Vec.load(model_path)
+    vocab, original, _ = claim_embedding.model_lookup(model)
+    tokens = list(vocab.keys())
+
+    # random documents drawn from the vocabulary
+    rng = np.random.RandomState(seed)
+    docs = [[tokens[i] for i in rng.randint(0, len(tokens), doc_length)]
+            for _ in range(n_docs)]
+    reference = claim_embedding.embed_documents(model, docs)
+
+    results = {}
+    seconds, rss = _measure_load(Word2Vec.load, (model_path,), docs[0])
+    results['gensim'] = {'load_seconds': seconds, 'rss_delta_bytes': rss}
+
+    for precision in PRECISIONS:
+        if not os.path.exists(vectors_path(path, precision)):
+            continue
+        vectors = load_vectors(path, precision)
+        embedded = claim_embedding.embed_documents(vectors, docs)
+
+        rows = np.asarray(vectors['vectors'], dtype = np.float32)
+        if vectors['scales'] is not None:
+            rows = rows * vectors['scales'][:, None]
+        cosine = (np.sum(rows * original, axis = 1) /
+                  np.maximum(np.linalg.norm(rows, axis = 1) *
+                             np.linalg.norm(original, axis = 1), 1e-12))
+
+        seconds, rss = _measure_load(load_vectors, (path, precision), docs[0])
+        results[precision] = {
+            'max_abs_error_vectors': float(np.abs(rows - original).max()),
+            'min_cosine_vectors': float(cosine.min()),
+            'max_abs_error_documents': float(np.abs(embedded - reference).max()),
+            'file_bytes': os.path.getsize(vectors_path(path, precision)),
+            'load_seconds': seconds,
+            'rss_delta_bytes': rss,
+        }
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description = 'Export inference-only word2vec vectors')
+    parser.add_argument('model', help = 'trained gensim word2vec model')
+    parser.add_argument('output', help = 'export folder')
+    parser.add_argument('--precision', nargs = '+', default = PRECISIONS,
+                        choices = PRECISIONS)
+    parser.add_argument('--no-report', action = 'store_true')
+    args = parser.parse_args(argv)
+
+    from gensim.models import Word2Vec
+    export_vectors(Word2Vec.load(args.model), args.output, args.precision)
+
+    if not args.no_report:
+        results = report(args.model, args.output)
+        print(json.dumps(results, indent = 1, sort_keys = True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+import os
+import gc
+import sys
+import json
+import time
+import errno
+import signal
+import socket
+import urllib
+import urllib2
+import argparse
+import threading
+import subprocess
+from werkzeug.serving import ThreadedWSGIServer, WSGIRequestHandler
+
+##### Pre-fork multi-worker server of the webapp #####
+# the parent process loads the model, scaler and word2vec vectors (and the
+# other registered artifacts) once, runs warm-up requests against fixture
+# patents, then forks the workers; the workers share the loaded pages
+# copy-on-write and accept connections on the socket of the parent, each
+# with a threaded werkzeug server limited to a number of request threads
+#
+# the parent runs no thread other than the main one when it forks (the warm-up
+# scores synchronously and the fetch threads of http_client are stopped): a
+# lock held by another thread would stay locked forever in the workers
+#
+# to keep the shared pages shared, the garbage collector must not touch the
+# objects of the parent: python 3.7+ freezes them (gc.freeze); python 2 has no
+# freeze, so the parent moves them to the oldest generation (gc.collect) and
+# the workers never run full collections (the young generations still collect
+# the garbage of the requests)
+#
+# the caches (predictions, metrics) are per worker, so /metrics reports the
+# worker that answered; the sqlite caches and the http client open their
+# connections per process
+#
+# run from the flask folder: python serve.py --workers 4 --threads 4
+# scaling benchmark: python serve.py --benchmark 1 2 4
+
+
+# default number of workers and request threads per worker
+WORKERS = int(os.environ.get('SERVE_WORKERS', 0)) or None
+THREADS = int(os.environ.get('SERVE_THREADS', 4))
+# listen backlog shared by the workers
+BACKLOG = 128
+# full collections of the workers (python 2): never, in practice
+FULL_COLLECTION_THRESHOLD = 10**9
+# workers exiting within this many seconds of their start are failures, and
+# are replaced after a delay doubling with each failure in a row (up to the max)
+MIN_WORKER_SECONDS = 10
+RESPAWN_DELAY = 0.5
+MAX_RESPAWN_DELAY = 60
+
+# fixture patents of the fill pages (/fill=...), requested during the warm-up
+# (from the page cache or the index; failures are ignored without network)
+WARM_UP_PATENTS = ['US7948209B2', 'US8278036B2']
+# manual inputs requested during the warm-up and by the benchmark
+WARM_UP_FORMS = [
+    {'title': 'Method for processing a signal', 'patent_class': 'G',
+     'num_authors': '3', 'num_applications': '2', 'num_claims': '20',
+     'patent_citations': '15', 'non_patent_citations': '4', 'num_similar_doc': '8',
+     'claims': '1. A method of processing a signal, comprising: receiving the signal '
+               'at a sensor; converting the signal into digital samples; and '
+               'filtering the digital samples with an adaptive filter.'},
+    {'title': 'Composition for the treatment of inflammation', 'patent_class': 'A',
+     'num_authors': '5', 'num_applications': '1', 'num_claims': '12',
+     'patent_citations': '6', 'non_patent_citations': '22', 'num_similar_doc': '3',
+     'claims': '1. A pharmaceutical composition comprising a compound of formula I '
+               'and a pharmaceutically acceptable carrier, wherein the compound '
+               'inhibits the expression of an inflammatory cytokine.'},
+]
+
+
+### function to build the url of a manual input
+def manual_url(form):
+    return '/output_manual?' + urllib.urlencode(sorted(form.items()))
+
+
+### function to warm up the webapp before serving
+# loads the registered artifacts and runs each fixture request once, so the
+# lookup tables and the first-request code paths are built in the parent;
+# the patents are scored in this thread (/output would score them on the
+# fetch threads)
+# output: dictionary url -> (status code or error, seconds)
+def warm_up(app, forms=WARM_UP_FORMS, patent_numbers=WARM_UP_PATENTS):
+    from flaskexample import model_registry, scoring
+
+    model_registry.warm_up()
+    results = {}
+    client = app.test_client()
+    for url in [manual_url(form) for form in forms]:
+        start = time.time()
+        results[url] = (client.get(url).status_code, time.time() - start)
+    for number in patent_numbers:
+        start = time.time()
+        try:
+            scoring.score_patent(number)
+            status = 'scored'
+        except Exception as e:
+            # e.g. no network for a patent missing from the caches
+            status = repr(e)
+        results['/output?patent_number=' + number] = (status, time.time() - start)
+    return results
+
+
+### function to stop the threads of the parent before forking
+# raises RuntimeError if a thread is still running after the timeout
+def stop_threads(timeout=30):
+    from flaskexample import http_client
+
+    http_client.shutdown()
+    others = [thread for thread in threading.enumerate()
+              if thread is not threading.current_thread()]
+    for thread in others:
+        thread.join(timeout)
+    alive = [thread.name for thread in others if thread.is_alive()]
+    if alive:
+        raise RuntimeError('threads still running before forking: ' + ', '.join(alive))
+
+
+### request handler without the access log of every request
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, code='-', size='-'):
+        pass
+
+
+### threaded werkzeug server on an inherited socket
+# at most `threads` requests are handled at once; while they are all busy, the
+# worker stops accepting and the other workers take the new connections
+class WorkerServer(ThreadedWSGIServer):
+    def __init__(self, sock, app, threads):
+        host, port = sock.getsockname()[:2]
+        ThreadedWSGIServer.__init__(self, host, port, app, QuietHandler, fd = sock.fileno())
+        self.slots = threading.BoundedSemaphore(threads)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        try:
+            ThreadedWSGIServer.process_request(self, request, client_address)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadedWSGIServer.process_request_thread(self, request, client_address)
+        finally:
+            self.slots.release()
+
+
+### function to keep the objects of the parent out of the garbage collector
+# called in the parent just before forking
+def freeze_gc():
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    else:
+        # survivors of gc.collect are in the oldest generation
+        threshold = gc.get_threshold()
+        gc.set_threshold(threshold[0], threshold[1], FULL_COLLECTION_THRESHOLD)
+
+
+### function to serve requests in a worker process
+# input: listening socket, wsgi application, number of request threads
+def serve_worker(sock, app, threads):
+    WorkerServer(sock, app, threads).serve_forever()
+
+
+### function to fork one worker
+# output: pid of the worker
+def _fork_worker(sock, app, threads):
+    pid = os.fork()
+    if pid == 0:
+        # the parent handles the signals of the server
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            serve_worker(sock, app, threads)
+        finally:
+            os._exit(1)
+    return pid
+
+
+### function to run the pre-fork server
+# input: address, number of workers (number of cores by default), request
+#        threads per worker, run the warm-up requests, file receiving the
+#        pids of the parent and the workers (json, written when serving)
+# workers that exit are replaced (after a delay if they keep failing);
+# SIGINT or SIGTERM stop all the workers
+def serve(host='127.0.0.1', port=5000, workers=None, threads=THREADS, warm=True,
+          pid_file=None):
+    import multiprocessing
+
+    workers = workers or multiprocessing.cpu_count()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(BACKLOG)
+
+    start = time.time()
+    from flaskexample import app
+    if warm:
+        for url, (status, seconds) in sorted(warm_up(app).items()):
+            sys.stderr.write('warm-up %s: %s in %.3fs\n' % (url[:60], status, seconds))
+    sys.stderr.write('models loaded in %.1fs, starting %d workers with %d threads on %s:%d\n'
+                     % (time.time() - start, workers, threads, host, port))
+    stop_threads()
+    freeze_gc()
+
+    # pid -> start time of each worker
+    pids = dict((_fork_worker(sock, app, threads), time.time()) for _ in range(workers))
+    if pid_file:
+        with open(pid_file, 'w') as f:
+            json.dump({'parent': os.getpid(), 'workers': sorted(pids)}, f)
+
+    stopping = []
+    # workers in a row that exited soon after starting
+    failures = 0
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while pids:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                break
+            raise
+        if pid not in pids:
+            continue
+        started = pids.pop(pid)
+        if stopping:
+            continue
+
+        failures = failures + 1 if time.time() - started < MIN_WORKER_SECONDS else 0
+        delay = min(MAX_RESPAWN_DELAY, RESPAWN_DELAY * 2 ** (failures - 1)) if failures else 0
+        sys.stderr.write('worker %d exited (status %d), starting a new one in %.1fs\n'
+                         % (pid, status, delay))
+        # signals interrupt the delay
+        deadline = time.time() + delay
+        while not stopping and time.time() < deadline:
+            time.sleep(max(0, min(0.5, deadline - time.time())))
+        if not stopping:
+            pids[_fork_worker(sock, app, threads)] = time.time()
+    sock.close()
+
+
+### function to read the memory of a process from /proc
+# output: dictionary with the resident (rss) and proportional (pss: shared
+#         pages divided among the processes sharing them) set sizes in bytes
+def process_memory(pid):
+    memory = {'rss': 0, 'pss': 0}
+    path = '/proc/%d/smaps_rollup' % pid
+    if not os.path.exists(path):
+        path = '/proc/%d/smaps' % pid
+    with open(path, 'r') as f:
+        for line in f:
+            field = line.split(':')[0]
+            if field in ('Rss', 'Pss'):
+                memory[field.lower()] += int(line.split()[1]) * 1024
+    return memory
+
+
+### function to measure the throughput of /output_manual
+# input: server url, number of requests, number of concurrent clients
+# output: requests per second, number of failed requests
+def measure_throughput(url, n_requests=400, concurrency=8, forms=WARM_UP_FORMS):
+    urls = [url + manual_url(forms[i % len(forms)]) for i in range(n_requests)]
+    failures = []
+    lock = threading.Lock()
+
+    def client(offset):
+        for i in range(offset, n_requests, concurrency):
+            try:
+                urllib2.urlopen(urls[i], timeout = 60).read()
+            except Exception:
+                with lock:
+                    failures.append(i)
+
+    start = time.time()
+    clients = [threading.Thread(target = client, args = (i,)) for i in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return n_requests / (time.time() - start), len(failures)
+
+
+### function to wait for a server to answer
+def _wait_ready(url, timeout=300):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib2.urlopen(url + '/about', timeout = 5).read()
+            return
+        except Exception:
+            time.sleep(0.5)
+    raise RuntimeError('the server at %s did not start' % url)
+
+
+### function to measure the scaling of the server with the number of workers
+# each worker count runs in a new server process
+# input: worker counts, threads per worker, requests and concurrent clients
+#        per measure, port, command starting the server (this script by default)
+# output: list of dictionaries with the throughput and the memory of the
+#         workers (rss of each worker, total pss of the parent and the workers)
+def benchmark(worker_counts, threads=THREADS, n_requests=400, concurrency=None,
+              port=5050, command=None):
+    command = command or [sys.executable, os.path.abspath(__file__)]
+    url = 'http://127.0.0.1:%d' % port
+    pid_file = os.path.abspath('.serve_benchmark_pids.json')
+
+    results = []
+    for workers in worker_counts:
+        server = subprocess.Popen(command + ['--workers', str(workers), '--threads', str(threads),
+                                             '--port', str(port), '--pid-file', pid_file])
+        try:
+            _wait_ready(url)
+            with open(pid_file, 'r') as f:
+                pids = json.load(f)
+            # one untimed round so every worker has served requests
+            measure_throughput(url, 4 * workers * threads, workers * threads)
+            rate, failures = measure_throughput(url, n_requests,
+                                                concurrency or 2 * workers * threads)
+
+            memory = dict((pid, process_memory(pid)) for pid in pids['workers'])
+            parent = process_memory(pids['parent'])
+            results.append({
+                'workers': workers,
+                'threads': threads,
+                'requests_per_second': rate,
+                'failures': failures,
+                'worker_rss_bytes': [memory[pid]['rss'] for pid in pids['workers']],
+                'total_pss_bytes': parent['pss'] + sum(m['pss'] for m in memory.values()),
+                'parent_rss_bytes': parent['rss'],
+            })
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+            if os.path.exists(pid_file):
+                os.remove(pid_file)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description = 'Serve the webapp with pre-forked workers')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 5000)
+    parser.add_argument('--workers', type = int, default = WORKERS,
+                        help = 'worker processes (number of cores by default)')
+    parser.add_argument('--threads', type = int, default = THREADS,
+                        help = 'request threads per worker')
+    parser.add_argument('--no-warm-up', action = 'store_true')
+    parser.add_argument('--pid-file', default = None)
+    parser.add_argument('--benchmark', type = int, nargs = '+', default = None,
+                        metavar = 'WORKERS',
+                        help = 'measure the throughput of /output_manual and the '
+                        'memory for these numbers of workers')
+    parser.add_argument('--requests', type = int, default = 400,
+                        help = 'requests per benchmark measure')
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        results = benchmark(args.benchmark, args.threads, args.requests, port = args.port)
+        single = results[0]['requests_per_second'] / results[0]['workers']
+        for result in results:
+            print('%2d workers: %7.1f requests/s (%.2fx one worker), %d failures, '
+                  'rss per worker %.0f MB, total pss %.0f MB'
+                  % (result['workers'], result['requests_per_second'],
+                     result['requests_per_second'] / single, result['failures'],
+                     max(result['worker_rss_bytes']) / 2.0**20,
+                     result['total_pss_bytes'] / 2.0**20))
+        print(json.dumps(results, indent = 1, sort_keys = True))
+    else:
+        serve(args.host, args.port, args.workers, args.threads, not args.no_warm_up,
+              args.pid_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pandas as pd
+import feature_store
+import page_extractor
+import page_cache
+import http_client
+import scrape_engine
+
+##### Incremental refresh of the maintenance fee labels #####
+# the label of the models is payment_times >= 2, and payment_times grows
+# as the patents age; instead of scraping every patent again, only the
+# patents whose label can still change are downloaded (conditional requests
+# when the server supports them), only their legal events are parsed, and
+# only the payment_times column of the feature store is rewritten
+#
+# US maintenance fees are due 3.5, 7.5 and 11.5 years after the grant and
+# can be paid with a surcharge during the 6 months after the due date;
+# a patent whose fee was not paid in time has expired, and a patent with
+# 2 payments is already labeled useful, so neither label can change
+
+
+# years after the grant when the fees are due, late payment period
+FEE_DUE_YEARS = [3.5, 7.5, 11.5]
+GRACE_YEARS = 0.5
+# fee payments appear on the patent page some time after they are made
+RECORDING_DELAY_DAYS = 120
+# patents with at least this many payments are labeled useful
+LABEL_THRESHOLD = 2
+
+
+### function to compute the dates after which each fee cannot be recorded
+# input: grant dates (datetime64 array)
+# output: array of size (number of patents, number of fees)
+def window_closes(grant_dates):
+    grant_dates = np.asarray(grant_dates, dtype = 'datetime64[D]')
+    days = [int(round((due + GRACE_YEARS) * 365.25)) + RECORDING_DELAY_DAYS
+            for due in FEE_DUE_YEARS]
+    return grant_dates[:, None] + np.asarray(days, dtype = 'timedelta64[D]')
+
+
+### function to find the patents whose label can still change
+# a fee window that closed before the stored count was read, without a
+# payment, means the patent expired; windows that closed after it was read
+# may hold payments that the stored count does not show yet
+# input: stored payment_times, grant dates (datetime64, NaT if unknown),
+#        date of the refresh, threshold of the label
+#        (None to find the patents whose payment_times can still change),
+#        dates when the stored counts were read (datetime64 array or one
+#        date, NaT or None if unknown: no fee is assumed to have lapsed)
+# output: boolean array
+def can_change(payment_times, grant_dates, today, threshold=LABEL_THRESHOLD, observed=None):
+    payment_times = np.asarray(payment_times)
+    closes = window_closes(grant_dates)
+    known = ~np.isnat(closes[:, 0])
+
+    if observed is None:
+        observed = np.datetime64('NaT')
+    observed = np.broadcast_to(np.asarray(observed, dtype = 'datetime64[D]'),
+                               payment_times.shape)
+    # counts read after the refresh date are read as of the refresh date
+    observed = np.where(observed > np.datetime64(today, 'D'),
+                        np.datetime64(today, 'D'), observed)
+    unknown = np.isnat(observed)
+    observed = np.where(unknown, np.datetime64(0, 'D'), observed)
+
+    # number of fee windows that were over when the count was read
+    closed = np.where(unknown, 0, np.sum(closes < observed[:, None], axis = 1))
+    remaining = len(FEE_DUE_YEARS) - closed
+    # a fee that was not paid in its window means the patent expired
+    lapsed = payment_times < closed
+
+    if threshold is None:
+        return known & ~lapsed & (payment_times < len(FEE_DUE_YEARS))
+    return (known & ~lapsed & (payment_times < threshold) &
+            (payment_times + remaining >= threshold))
+
+
+### function to open the state of the refresh jobs
+# the validators of the last download of each patent are kept for the
+# conditional requests of the next refresh
+def open_state(path):
+    con = sqlite3.connect(path, timeout = 30)
+    with con:
+        con.execute("""CREATE TABLE IF NOT EXISTS refresh_state (
+                           patent_id TEXT PRIMARY KEY,
+                           etag TEXT,
+                           last_modified TEXT,
+                           payment_times INTEGER NOT NULL,
+                           checked_at REAL NOT NULL)""")
+    return con
+
+
+### function to read the fee payments of one patent
+# input: (patent id, url, ETag, Last-Modified, payment_times of the last check),
+#        rate limiter
+# output: patent id, payment_times (None on errors), ETag, Last-Modified, status
+def _check_patent(target, wait):
+    patent_id, url, etag, last_modified, previous = target
+    try:
+        wait(url)
+        page, etag, last_modified = http_client.get_conditional(url, etag, last_modified)
+        if page is None:
+            return patent_id, previous, etag, last_modified, 'not modified'
+        # keep the fresh page for the other scrapers
+        page_cache.put(url, page)
+        return patent_id, page_extractor.count_fee_payments(page), etag, last_modified, 'downloaded'
+    except Exception as e:
+        return patent_id, None, etag, last_modified, 'error: %s: %s' % (type(e).__name__, e)
+
+
+### function to refresh the labels of a feature store
+# input: store folder, DataFrame read by scrape_engine.read_patent_lists
+#        (for the grant dates and urls), state file, date of the refresh,
+#        track_payments: refresh every patent whose payment_times can change
+#        (not only the label), download threads, requests per second,
+#        dry_run: report the changes without updating the store
+#        since: date when the stored counts were scraped (the counts of the
+#        patents already in the state file were read at their last check)
+# output: report DataFrame with one row per checked patent
+def refresh(store, patent_list, state_path=None, today=None, track_payments=False,
+            workers=8, rate=2.0, dry_run=False, since=None):
+    today = today or time.strftime('%Y-%m-%d')
+    state_path = state_path or os.path.join(store, 'label_refresh.sqlite')
+    patent_list = patent_list.drop_duplicates('id').set_index('id')
+    since = np.datetime64(since, 'D') if since else np.datetime64('NaT')
+
+    con = open_state(state_path)
+    try:
+        state = dict((row[0], row[1:]) for row in con.execute(
+            'SELECT patent_id, etag, last_modified, payment_times, checked_at FROM refresh_state'))
+
+        # stored labels of all the years
+        arrays, years = feature_store.read_arrays(store, ['id', 'payment_times'], mmap = None)
+        targets = []
+        for year, ids, payments in zip(years, arrays['id'], arrays['payment_times']):
+            listed = patent_list.reindex(ids)
+            grant_dates = pd.to_datetime(listed['grant date'], errors = 'coerce').values
+            # latest count read of each patent, and when it was read
+            counts = np.array(payments)
+            observed = np.repeat(since, len(ids))
+            for i, patent_id in enumerate(ids):
+                if patent_id in state and state[patent_id][2] >= counts[i]:
+                    counts[i] = state[patent_id][2]
+                    observed[i] = np.datetime64(int(state[patent_id][3]), 's')
+            mask = can_change(counts, grant_dates.astype('datetime64[D]'), today,
+                              None if track_payments else LABEL_THRESHOLD, observed)
+            mask &= listed['result link'].notnull().values
+            for row in np.flatnonzero(mask):
+                targets.append((year, row, ids[row], listed['result link'].values[row],
+                                listed['grant date'].values[row], int(payments[row])))
+
+        wait = scrape_engine.make_rate_limiter(rate)
+        pending = []
+        for year, row, patent_id, url, grant, stored in targets:
+            etag, last_modified, previous = state.get(patent_id, (None, None, stored, 0))[:3]
+            pending.append((patent_id, url, etag, last_modified, previous))
+
+        pool = ThreadPool(max(1, min(workers, len(pending))))
+        try:
+            checked = pool.map(lambda target: _check_patent(target, wait), pending)
+        finally:
+            pool.close()
+
+        now = time.time()
+        with con:
+            con.executemany('INSERT OR REPLACE INTO refresh_state VALUES (?, ?, ?, ?, ?)',
+                            [(patent_id, etag, last_modified, payments, now)
+                             for patent_id, payments, etag, last_modified, status in checked
+                             if payments is not None])
+    finally:
+        con.close()
+
+    # compare with the stored values
+    report = []
+    updates = {}
+    for (year, row, patent_id, url, grant, stored), result in zip(targets, checked):
+        payments, status = result[1], result[4]
+        if payments is not None and payments < stored:
+            # fee payments are never removed from a page: keep the stored value
+            status = 'fewer payments on page (%d), kept' % payments
+            payments = stored
+        new = stored if payments is None else payments
+        if new != stored:
+            updates.setdefault(year, []).append((row, new))
+        report.append({
+            'id': patent_id,
+            'grant_date': grant,
+            'old_payment_times': stored,
+            'new_payment_times': new,
+            'old_label': int(stored >= LABEL_THRESHOLD),
+            'new_label': int(new >= LABEL_THRESHOLD),
+            'status': status,
+        })
+
+    if not dry_run:
+        for year, rows in updates.items():
+            payments = np.array(arrays['payment_times'][years.index(year)])
+            for row, value in rows:
+                payments[row] = value
+            feature_store.update_column(store, year, 'payment_times', payments)
+
+    return pd.DataFrame(report, columns = ['id', 'grant_date', 'old_payment_times',
+                                           'new_payment_times', 'old_label',
+                                           'new_label', 'status'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description = 'Refresh the maintenance fee labels of a feature store')
+    parser.add_argument('lists', nargs = '+', help = 'patent_lists csv files')
+    parser.add_argument('--store', required = True, help = 'feature store folder')
+    parser.add_argument('--state', default = None,
+                        help = 'state file (label_refresh.sqlite in the store by default)')
+    parser.add_argument('--today', default = None, help = 'date of the refresh (YYYY-MM-DD)')
+    parser.add_argument('--since', default = None,
+                        help = 'date when the stored payment counts were scraped (YYYY-MM-DD); '
+                        'without it no fee is assumed lapsed before the first refresh')
+    parser.add_argument('--track-payments', action = 'store_true',
+                        help = 'check every patent whose payment_times can change')
+    parser.add_argument('--workers', type = int, default = 8)
+    parser.add_argument('--rate', type = float, default = 2.0)
+    parser.add_argument('--dry-run', action = 'store_true')
+    parser.add_argument('--report', help = 'csv file for the report (stdout by default)')
+    args = parser.parse_args(argv)
+
+    patent_list = scrape_engine.read_patent_lists(args.lists)
+    report = refresh(args.store, patent_list, args.state, args.today,
+                     args.track_payments, args.workers, args.rate, args.dry_run,
+                     args.since)
+
+    changed = report[report['old_label'] != report['new_label']]
+    sys.stderr.write('%d patents checked, %d payment counts changed, %d labels changed, '
+                     '%d errors\n' % (report.shape[0],
+                                      np.sum(report['old_payment_times'] != report['new_payment_times']),
+                                      changed.shape[0],
+                                      np.sum(report['status'].str.startswith('error'))))
+    if args.report:
+        report.to_csv(args.report, index = False)
+    else:
+        report.to_csv(sys.stdout, index = False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import feature_builder
+import forest_compiler
+import word_vectors
+import versioned_folder
+
+##### Versioned bundle of the final model #####
+# the random forest, the standardization scaler and the word2vec vectors
+# are saved together in one folder with a manifest recording the feature
+# layout they expect, the checksum of every file and the training data
+#
+# every array is a separate .npy file, loaded memory-mapped when the
+# component is first used (opening a bundle only reads the manifest)
+#
+# each build is written into a new version folder and published by
+# versioned_folder.py: the bundle path is a link to the current version, and
+# an opened Bundle reads all its components from the version it resolved
+#
+# layout of a bundle folder:
+#   manifest.json
+#   forest/<array>.npy       compiled random forest (forest_compiler.py)
+#   scaler/mean.npy, scaler/scale.npy
+#   word2vec/vocab.json, word2vec/vectors_float32.npy   (word_vectors.py)
+
+
+# version of the bundle layout
+FORMAT_VERSION = 1
+
+# components of a bundle
+COMPONENTS = ['model', 'scaler', 'word2vec']
+
+
+### error raised for missing, corrupted or incompatible bundles
+class BundleError(ValueError):
+    pass
+
+
+### function to list the expected order of the predictors
+# input: dimension of the claim vectors
+# output: list of predictor names (7 classes, 6 counts, vector elements)
+def feature_order(vector_dim=100):
+    return (['class_' + name for name in feature_builder.CLASSES] +
+            list(feature_builder.NONTEXT_COLUMNS) +
+            ['claims_vector_%d' % i for i in range(vector_dim)])
+
+
+### function to compute the checksum of a file
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+### function to save the final model as a bundle
+# the bundle is written into a new version folder, then published at the
+# path (the previous version stays readable by the processes using it)
+# input: bundle folder, fitted RandomForestClassifier (or a compiled forest),
+#        fitted StandardScaler, word2vec model (or exported vectors),
+#        training information (e.g. {'years': [2004, 2007], 'patents': 10030}),
+#        version name (the creation time by default)
+# output: manifest
+def build(path, forest, scaler, word2vec_model, training=None, version=None):
+    import claim_embedding
+
+    compiled = forest if isinstance(forest, dict) else forest_compiler.compile_forest(forest)
+    vector_dim = claim_embedding.model_lookup(word2vec_model)[1].shape[1]
+    n_features = len(feature_order(vector_dim))
+    if int(compiled['n_features']) != n_features or len(scaler.mean_) != n_features:
+        raise BundleError('expected %d predictors, the forest has %d and the scaler %d'
+                          % (n_features, int(compiled['n_features']), len(scaler.mean_)))
+
+    folder_path = versioned_folder.new_version(path)
+    for folder in ['forest', 'scaler']:
+        os.makedirs(os.path.join(folder_path, folder))
+
+    for name, array in compiled.items():
+        np.save(os.path.join(folder_path, 'forest', name + '.npy'), array)
+    np.save(os.path.join(folder_path, 'scaler', 'mean.npy'), scaler.mean_)
+    np.save(os.path.join(folder_path, 'scaler', 'scale.npy'), scaler.scale_)
+    # gensim models and exported vectors are written the same way
+    word_vectors.write_vectors(word2vec_model, os.path.join(folder_path, 'word2vec'))
+
+    files = {}
+    for folder in ['forest', 'scaler', 'word2vec']:
+        for name in sorted(os.listdir(os.path.join(folder_path, folder))):
+            file_path = os.path.join(folder_path, folder, name)
+            files[folder + '/' + name] = {'bytes': os.path.getsize(file_path),
+                                          'sha256': file_checksum(file_path)}
+
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'version': version or time.strftime('%Y%m%d-%H%M%S'),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'features': {
+            'classes': list(feature_builder.CLASSES),
+            'counts': list(feature_builder.NONTEXT_COLUMNS),
+            'vector_dim': int(vector_dim),
+            'n_features': n_features,
+        },
+        'model': {'kind': 'compiled_forest', 'n_trees': len(compiled['roots']),
+                  'classes': [int(c) for c in compiled['classes']]},
+        'training': training or {},
+        'files': files,
+    }
+    with open(os.path.join(folder_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+
+    versioned_folder.publish(path, folder_path)
+
+    return manifest
+
+
+### function to check that a manifest matches the features of this code
+# raises BundleError if the bundle cannot be used
+def check_compatible(manifest):
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise BundleError('bundle format %s is not supported (expected %d)'
+                          % (manifest.get('format_version'), FORMAT_VERSION))
+    features = manifest['features']
+    if (features['classes'] != list(feature_builder.CLASSES) or
+            features['counts'] != list(feature_builder.NONTEXT_COLUMNS)):
+        raise BundleError('bundle expects classes %s and counts %s, the feature '
+                          'builder produces %s and %s'
+                          % (features['classes'], features['counts'],
+                             feature_builder.CLASSES, feature_builder.NONTEXT_COLUMNS))
+    if features['n_features'] != len(feature_order(features['vector_dim'])):
+        raise BundleError('bundle has %d predictors for vectors of dimension %d'
+                          % (features['n_features'], features['vector_dim']))
+
+
+### loaded bundle; the components are read on first use
+class Bundle(object):
+    def __init__(self, path):
+        # the version published when the bundle is opened (the manifest and
+        # every component are read from it, never from the link)
+        self.path = versioned_folder.resolve(path)
+        manifest_path = os.path.join(self.path, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            raise BundleError('%s is not a model bundle (no manifest.json)' % path)
+        with open(manifest_path, 'r') as f:
+            self.manifest = json.load(f)
+        check_compatible(self.manifest)
+        self.version = self.manifest['version']
+        self.features = self.manifest['features']
+        self._components = {}
+
+        # truncated or missing files (the checksums are checked by verify)
+        for name, info in self.manifest['files'].items():
+            file_path = os.path.join(self.path, name)
+            if not os.path.exists(file_path) or os.path.getsize(file_path) != info['bytes']:
+                raise BundleError('%s is missing or has the wrong size' % file_path)
+
+    ### function to get a component ('model', 'scaler' or 'word2vec')
+    def get(self, name):
+        if name not in self._components:
+            loader = getattr(self, '_load_' + name, None)
+            if loader is None:
+                raise KeyError('unknown bundle component %s' % name)
+            self._components[name] = loader()
+        return self._components[name]
+
+    def _array(self, name):
+        # memory-mapped, except scalars
+        array = np.load(os.path.join(self.path, name), mmap_mode = 'r')
+        return np.array(array) if array.ndim == 0 else array
+
+    def _load_model(self):
+        folder = 'forest/'
+        compiled = dict((name[len(folder):-4], self._array(name))
+                        for name in self.manifest['files'] if name.startswith(folder))
+        if int(compiled['n_features']) != self.features['n_features']:
+            raise BundleError('forest has %d features, manifest %d'
+                              % (int(compiled['n_features']), self.features['n_features']))
+        return compiled
+
+    def _load_scaler(self):
+        from sklearn.preprocessing import StandardScaler
+
+        scaler = StandardScaler()
+        scaler.mean_ = self._array('scaler/mean.npy')
+        scaler.scale_ = self._array('scaler/scale.npy')
+        scaler.var_ = scaler.scale_ ** 2
+        scaler.n_samples_seen_ = self.manifest['training'].get('patents', 0)
+        if len(scaler.mean_) != self.features['n_features']:
+            raise BundleError('scaler has %d features, manifest %d'
+                              % (len(scaler.mean_), self.features['n_features']))
+        return scaler
+
+    def _load_word2vec(self):
+        vectors = word_vectors.load_vectors(os.path.join(self.path, 'word2vec'))
+        if vectors['vectors'].shape[1] != self.features['vector_dim']:
+            raise BundleError('word2vec vectors have dimension %d, manifest %d'
+                              % (vectors['vectors'].shape[1], self.features['vector_dim']))
+        return vectors
+
+    ### function to compare the files with the checksums of the manifest
+    # output: list of the files that do not match (empty if the bundle is intact)
+    def verify(self):
+        return [name for name, info in sorted(self.manifest['files'].items())
+                if file_checksum(os.path.join(self.path, name)) != info['sha256']]
+
+
+### function to open a bundle
+# input: bundle folder, verify: also compare the checksums of all the files
+#        (reads every file, slower than the compatibility checks)
+# output: Bundle
+# raises BundleError for missing, corrupted or incompatible bundles
+def open_bundle(path, verify=False):
+    bundle = Bundle(path)
+    if verify:
+        mismatched = bundle.verify()
+        if mismatched:
+            raise BundleError('checksum mismatch in %s: %s' % (path, ', '.join(mismatched)))
+    return bundle
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description = 'Build, verify or describe a model bundle')
+    subparsers = parser.add_subparsers(dest = 'command')
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('bundle')
+    build_parser.add_argument('--model', default = 'models/final_model.p')
+    build_parser.add_argument('--scaler', default = 'models/final_model_scaler.p')
+    build_parser.add_argument('--word2vec', default = 'models/word2vec_claims_final')
+    build_parser.add_argument('--years', type = int, nargs = 2, default = [2004, 2007],
+                              help = 'first and last publication year of the training data')
+    build_parser.add_argument('--patents', type = int, default = None,
+                              help = 'number of training patents')
+    build_parser.add_argument('--version', default = None)
+    for command in ['verify', 'info']:
+        subparsers.add_parser(command).add_argument('bundle')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        import pickle
+        from gensim.models import Word2Vec
+        with open(args.model, 'rb') as f:
+            forest = pickle.load(f)
+        with open(args.scaler, 'rb') as f:
+            scaler = pickle.load(f)
+        training = {'years': args.years, 'label': 'payment_times >= 2'}
+        if args.patents:
+            training['patents'] = args.patents
+        manifest = build(args.bundle, forest, scaler, Word2Vec.load(args.word2vec),
+                         training, args.version)
+        print('bundle %s written to %s' % (manifest['version'], args.bundle))
+    elif args.command == 'verify':
+        mismatched = open_bundle(args.bundle).verify()
+        for name in mismatched:
+            sys.stderr.write('checksum mismatch: %s\n' % name)
+        print('ok' if not mismatched else '%d files do not match' % len(mismatched))
+        if mismatched:
+            sys.exit(1)
+    else:
+        start = time.time()
+        bundle = open_bundle(args.bundle)
+        for name in COMPONENTS:
+            bundle.get(name)
+        manifest = dict(bundle.manifest)
+        del manifest['files']
+        print(json.dumps(manifest, indent = 1, sort_keys = True))
+        print('opened and loaded in %.3fs' % (time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
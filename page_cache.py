@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import zlib
+import sqlite3
+import threading
+
+##### Persistent cache of the downloaded patent pages #####
+# pages are stored compressed in a sqlite file keyed by url
+# sqlite locking makes the cache safe to share between processes
+# entries expire after a time to live and the least recently used
+# pages are evicted when the cache grows over its size limit
+#
+# reading a page does not write to the file: the access times used by the
+# eviction are kept in memory and written every TOUCH_SECONDS (and before
+# an eviction), and the total size is kept in the totals table
+#
+# settings can be given by environment variables:
+# PATENT_CACHE_DIR: folder of the cache file
+# PATENT_CACHE_TTL: time to live of a page in seconds (0 for no expiry)
+# PATENT_CACHE_MAX_MB: size limit of the cache
+# PATENT_CACHE_OFFLINE: set to 1 to never download pages
+# PATENT_CACHE_DISABLE: set to 1 to always download pages
+
+
+# default time to live of a page: the fees, citations and similar documents
+# of a patent page change over time
+DEFAULT_TTL = 7 * 24 * 3600
+
+# seconds between two writes of the access times of the cached pages
+TOUCH_SECONDS = 60
+
+
+### error raised when a page is not cached in offline mode
+class OfflineCacheMiss(IOError):
+    pass
+
+
+### function to create the settings of a cache
+# input: folder of the cache file, time to live (seconds, PATENT_CACHE_TTL or
+#        DEFAULT_TTL by default, 0 for no expiry), size limit (bytes), offline mode
+# output: dictionary of settings used by the other functions
+def open_cache(directory=None, ttl=None, max_bytes=None, offline=None):
+    env = os.environ
+    if directory is None:
+        directory = env.get('PATENT_CACHE_DIR',
+                            os.path.join(os.path.expanduser('~'), '.cache',
+                                         'patent_evaluator'))
+    if ttl is None:
+        ttl = float(env.get('PATENT_CACHE_TTL', DEFAULT_TTL))
+    if max_bytes is None:
+        max_bytes = int(float(env.get('PATENT_CACHE_MAX_MB', 2048)) * 2**20)
+    if offline is None:
+        offline = env.get('PATENT_CACHE_OFFLINE') == '1'
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    cache = {
+        'path': os.path.join(directory, 'pages.sqlite'),
+        'ttl': ttl or None,
+        'max_bytes': max_bytes,
+        'offline': offline,
+        # access times not written yet: url -> time
+        'touched': {},
+        'touched_at': time.time(),
+        'lock': threading.Lock(),
+    }
+
+    con = _connect(cache)
+    with con:
+        con.execute("""CREATE TABLE IF NOT EXISTS pages (
+                           url TEXT PRIMARY KEY,
+                           page BLOB NOT NULL,
+                           size INTEGER NOT NULL,
+                           fetched_at REAL NOT NULL,
+                           accessed_at REAL NOT NULL)""")
+        con.execute("""CREATE INDEX IF NOT EXISTS pages_accessed
+                           ON pages (accessed_at)""")
+        # total size of the pages, updated with every write
+        # (computed once for cache files written before this table existed)
+        con.execute("""CREATE TABLE IF NOT EXISTS totals (
+                           name TEXT PRIMARY KEY,
+                           bytes INTEGER NOT NULL)""")
+        con.execute("""INSERT OR IGNORE INTO totals
+                           SELECT 'pages', COALESCE(SUM(size), 0) FROM pages""")
+
+    return cache
+
+
+# cache used when none is given (created on first use)
+_default_cache = None
+
+
+### function to get the default cache
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = open_cache()
+    return _default_cache
+
+
+# connections of the current thread: path -> (process id, connection)
+_connections = threading.local()
+
+
+### function to get the connection of the current thread to the cache file
+# each thread of each process keeps one connection (a forked worker
+# opens its own)
+def _connect(cache):
+    connections = getattr(_connections, 'by_path', None)
+    if connections is None:
+        connections = _connections.by_path = {}
+    pid, con = connections.get(cache['path'], (None, None))
+    if pid != os.getpid():
+        con = sqlite3.connect(cache['path'], timeout = 30)
+        con.execute('PRAGMA journal_mode=WAL')
+        connections[cache['path']] = (os.getpid(), con)
+    return con
+
+
+### function to read a page from the cache
+# input: url, cache settings
+# output: html page, or None if it is not cached or expired
+#         (expired pages are still returned in offline mode)
+def get(url, cache=None):
+    cache = cache or default_cache()
+    con = _connect(cache)
+    row = con.execute('SELECT page, fetched_at FROM pages WHERE url = ?',
+                      (url,)).fetchone()
+    if row is None:
+        return None
+
+    page, fetched_at = row
+    now = time.time()
+    if (cache['ttl'] is not None and now - fetched_at > cache['ttl']
+            and not cache['offline']):
+        return None
+
+    _touch(cache, url, now)
+    _flush_touched(con, cache)
+
+    return zlib.decompress(bytes(page))
+
+
+### function to store a page in the cache
+# input: url, html page, cache settings
+def put(url, page, cache=None):
+    cache = cache or default_cache()
+    data = zlib.compress(page, 6)
+    now = time.time()
+
+    con = _connect(cache)
+    with con:
+        # the size of the replaced page is read by the first write of the
+        # transaction, so a page written by another process meanwhile is
+        # subtracted once
+        con.execute("""UPDATE totals SET bytes = bytes + ? -
+                           COALESCE((SELECT size FROM pages WHERE url = ?), 0)
+                       WHERE name = 'pages'""", (len(data), url))
+        con.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)',
+                    (url, sqlite3.Binary(data), len(data), now, now))
+    _evict(con, cache)
+
+
+### function to update the total size of the pages
+# must be called in the transaction that changes the pages
+def _add_bytes(con, delta):
+    con.execute("UPDATE totals SET bytes = bytes + ? WHERE name = 'pages'", (delta,))
+
+
+### function to read the total size of the pages
+def _total_bytes(con):
+    return con.execute("SELECT bytes FROM totals WHERE name = 'pages'").fetchone()[0]
+
+
+### function to record the access to a cached page
+def _touch(cache, url, now):
+    with cache['lock']:
+        cache['touched'][url] = now
+
+
+### function to write the access times recorded in memory
+# written every TOUCH_SECONDS, or now if force is set
+def _flush_touched(con, cache, force=False):
+    if not force and time.time() - cache['touched_at'] < TOUCH_SECONDS:
+        return
+    with cache['lock']:
+        touched = cache['touched']
+        cache['touched'] = {}
+        cache['touched_at'] = time.time()
+    if not touched:
+        return
+    with con:
+        con.executemany('UPDATE pages SET accessed_at = ? WHERE url = ?',
+                        [(now, url) for url, now in touched.items()])
+
+
+### function to remove the least recently used pages over the size limit
+# the cache is reduced to 90% of the limit so eviction does not run each time
+def _evict(con, cache):
+    total = _total_bytes(con)
+    if total <= cache['max_bytes']:
+        _flush_touched(con, cache)
+        return
+
+    # the recent accesses decide what is evicted
+    _flush_touched(con, cache, force = True)
+    target = 0.9 * cache['max_bytes']
+    rows = con.execute('SELECT url, size FROM pages ORDER BY accessed_at').fetchall()
+    evicted = []
+    selected = 0
+    for url, size in rows:
+        if total - selected <= target:
+            break
+        evicted.append((url, size))
+        selected += size
+    with con:
+        # only the pages deleted here are subtracted (another process
+        # evicting at the same time deletes and subtracts the others)
+        freed = 0
+        for url, size in evicted:
+            if con.execute('DELETE FROM pages WHERE url = ? AND size = ?',
+                           (url, size)).rowcount == 1:
+                freed += size
+        _add_bytes(con, -freed)
+
+
+### function to read a page, downloading it on a cache miss
+# input: url, function downloading the page, cache settings
+# output: html page
+# raises OfflineCacheMiss if the page is not cached in offline mode
+def get_page(url, fetch, cache=None):
+    if os.environ.get('PATENT_CACHE_DISABLE') == '1':
+        return fetch(url)
+
+    cache = cache or default_cache()
+    page = get(url, cache)
+    if page is not None:
+        return page
+
+    if cache['offline']:
+        raise OfflineCacheMiss('%s is not in the page cache (offline mode)' % url)
+
+    page = fetch(url)
+    put(url, page, cache)
+
+    return page
+
+
+### function to remove the expired pages
+def purge_expired(cache=None):
+    cache = cache or default_cache()
+    if cache['ttl'] is None:
+        return 0
+
+    con = _connect(cache)
+    with con:
+        expired = time.time() - cache['ttl']
+        # the size is read by the first write of the transaction
+        con.execute("""UPDATE totals SET bytes = bytes -
+                           (SELECT COALESCE(SUM(size), 0) FROM pages WHERE fetched_at < ?)
+                       WHERE name = 'pages'""", (expired,))
+        deleted = con.execute('DELETE FROM pages WHERE fetched_at < ?',
+                              (expired,)).rowcount
+
+    return deleted
+
+
+### function to report the content of the cache
+# output: dictionary with number of pages and compressed size
+def stats(cache=None):
+    cache = cache or default_cache()
+    con = _connect(cache)
+    pages = con.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+    size = _total_bytes(con)
+
+    return {'path': cache['path'], 'pages': pages, 'bytes': size,
+            'max_bytes': cache['max_bytes'], 'ttl': cache['ttl'],
+            'offline': cache['offline']}
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+
+import io
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime
+from lxml import etree
+
+##### Single pass extraction of a Google Patent result page #####
+# the page is parsed as a stream by lxml and every field is read on the way
+# only the sections that need their content (claims, description, ...)
+# are kept in memory, the rest of the tree is cleared as soon as it is read
+
+
+# all the information the patent_scraper functions read from a page
+PatentRecord = namedtuple('PatentRecord', [
+    'title',                # find_patent_title
+    'abstract',             # find_patent_abstract
+    'classification',       # find_patent_class
+    'num_applications',     # find_patent_applications
+    'assignee',             # find_ori_assignee
+    'patent_citations',     # find_citation_nums
+    'non_patent_citations', # find_citation_nums
+    'description',          # read_patent_content
+    'num_claims',           # read_patent_claims / read_patent_claims_WO
+    'claim_content',        # read_patent_claims / read_patent_claims_WO
+    'similar_doc_num',      # count_similar_documents
+    'payment_times',        # find_maintainance_years
+    'num_inventors',        # find_num_inventors
+])
+
+
+### function to read the string of an element the way BeautifulSoup does
+# the string is only defined when the element has a single child
+# (returns None otherwise)
+def element_string(elem):
+    children = len(elem)
+    if children == 0:
+        return elem.text
+    if children == 1 and not elem.text and not elem[0].tail:
+        return element_string(elem[0])
+    return None
+
+
+### function to read all the text of an element (BeautifulSoup get_text)
+def element_text(elem):
+    return ''.join(elem.itertext())
+
+
+### function to read the attribute values of an element as a set
+def _classes(elem):
+    return set((elem.get('class') or '').split())
+
+
+### function to find the number of fee payments in a legal event row
+def _is_fee_payment(row):
+    for info in row.iter('td'):
+        if info.get('itemprop') != 'title':
+            continue
+        # the text of the cell and each of its children
+        if info.text == 'Fee payment':
+            return True
+        for child in info:
+            if element_string(child) == 'Fee payment' or child.tail == 'Fee payment':
+                return True
+        return False
+    return False
+
+
+### function to count the fee payments of a page without reading the rest
+# only the page from the first legal event row is parsed (the legal events
+# are at the end of the page), same count as find_maintainance_years
+# input: html page (bytes)
+# output: number of fee payments
+def count_fee_payments(page):
+    first = page.find(b'itemprop="legalEvents"')
+    if first < 0:
+        return 0
+    start = page.rfind(b'<tr', 0, first)
+
+    payment_times = 0
+    context = etree.iterparse(io.BytesIO(page[start:]), events=('end',),
+                              tag='tr', html=True, remove_comments=True)
+    for event, elem in context:
+        if elem.get('itemprop') == 'legalEvents' and _is_fee_payment(elem):
+            payment_times += 1
+        elem.clear()
+
+    return payment_times
+
+
+### function to read the publication date of a similar document row
+def _publication_date(row):
+    for elem in row.iter('time'):
+        if elem.get('itemprop') == 'publicationDate':
+            return element_string(elem)
+    return None
+
+
+### function to read the claims section
+# input: claims section element, WO_index (1 for international patents),
+#        claim_text: 'string' reads the claim divs with a single string only,
+#        'text' reads all the text of the claim divs
+# output: number of claims and claim text
+def _read_claims(section, WO_index, claim_text):
+    num_claims = None
+    claim_content = []
+
+    for elem in section.iter():
+        tag = elem.tag
+        if tag == 'span' and num_claims is None and WO_index == 0:
+            if elem.get('itemprop') == 'count':
+                num_claims = int(element_string(elem))
+        elif tag == 'claim' and WO_index != 0:
+            # the number of the last claim
+            num_claims = int(elem.get('num'))
+        elif tag == 'div' and 'claim-text' in _classes(elem):
+            if claim_text == 'text':
+                claim_content.append(element_text(elem))
+            else:
+                content = element_string(elem)
+                if content is not None:
+                    claim_content.append(content)
+
+    claim_content = ' '.join(claim_content)
+    if claim_text == 'text':
+        claim_content = claim_content.replace('\n', ' ')
+
+    return num_claims, claim_content
+
+
+### function to read the background and summary of the description section
+def _read_description(section):
+    description = []
+    for header in section.iter('heading'):
+        for elem in header.itersiblings():
+            if elem.tag == 'p':
+                description.append(element_text(elem))
+
+    return ' '.join(description)
+
+
+### function to read the main title from the page title
+def _main_title(title_content):
+    if title_content is None:
+        return None
+    elements = title_content.split('-')
+    len_1 = len(elements[0])
+    len_2 = len(elements[-1])
+
+    return title_content[len_1+2 : len(title_content)-len_2-2].strip()
+
+
+### function to read the number of citations from a section title
+def _citation_count(content):
+    words = content.split(" ")
+    return int(words[2][1:len(words[2])-1])
+
+
+### function to decide whether an element has to be kept until its end tag
+def _is_captured(elem):
+    tag = elem.tag
+    itemprop = elem.get('itemprop')
+    if tag == 'section':
+        return itemprop in ('claims', 'description')
+    if tag == 'tr':
+        return itemprop in ('legalEvents', 'similarDocuments')
+    if tag in ('title', 'h2'):
+        return True
+    if tag == 'span':
+        return itemprop == 'Code'
+    if tag == 'dd':
+        return itemprop == 'assigneeOriginal'
+    return False
+
+
+### function to extract all the information of a patent page in one pass
+# input: html page (bytes), WO_index (1 for international patents),
+#        claim_text: how claim divs are read ('string' or 'text')
+# output: PatentRecord
+# raises ValueError when the claims or the submission date are missing
+def extract_page(page, WO_index=0, claim_text='string'):
+    title = None
+    abstract = None
+    classification = None
+    num_applications = 0
+    assignee = None
+    patent_citations = 0
+    non_patent_citations = 0
+    description = None
+    num_claims = None
+    claim_content = None
+    submission_date = None
+    similar_dates = []
+    payment_times = 0
+    num_inventors = 0
+    claims_found = False
+    in_head = False
+
+    # depth of the captured elements we are in
+    captured = 0
+
+    context = etree.iterparse(io.BytesIO(page), events=('start', 'end'),
+                              html=True, remove_comments=True)
+
+    for event, elem in context:
+        tag = elem.tag
+
+        if event == 'start':
+            if _is_captured(elem):
+                captured += 1
+            if tag == 'head':
+                in_head = True
+            elif tag == 'meta':
+                name = elem.get('name')
+                itemprop = elem.get('itemprop')
+                if itemprop == 'Leaf':
+                    num_applications += 1
+                elif name == 'DC.contributor' and elem.get('scheme') == 'inventor':
+                    num_inventors += 1
+                elif name == 'DC.date' and elem.get('scheme') == 'dateSubmitted':
+                    if submission_date is None:
+                        submission_date = elem.get('content')
+                elif name == 'description' and in_head and abstract is None:
+                    abstract = elem.get('content')
+            continue
+
+        # end of an element: all its content is available
+        if tag == 'head':
+            in_head = False
+        elif tag == 'title':
+            if title is None:
+                title = _main_title(element_string(elem))
+        elif tag == 'h2':
+            content = element_string(elem)
+            if content is not None:
+                words = content.split(" ")
+                if words[0] == 'Patent' and len(words) > 2:
+                    patent_citations = _citation_count(content)
+                elif words[0] == 'Non-Patent' and len(words) > 2:
+                    non_patent_citations = _citation_count(content)
+        elif tag == 'span' and classification is None:
+            if elem.get('itemprop') == 'Code':
+                code = element_text(elem)
+                classification = code[0] if code else 'NA'
+        elif tag == 'dd' and assignee is None:
+            if elem.get('itemprop') == 'assigneeOriginal':
+                assignee = element_string(elem)
+        elif tag == 'tr':
+            itemprop = elem.get('itemprop')
+            if itemprop == 'legalEvents':
+                if _is_fee_payment(elem):
+                    payment_times += 1
+            elif itemprop == 'similarDocuments':
+                similar_dates.append(_publication_date(elem))
+        elif tag == 'section':
+            itemprop = elem.get('itemprop')
+            if itemprop == 'claims' and not claims_found:
+                claims_found = True
+                num_claims, claim_content = _read_claims(elem, WO_index, claim_text)
+            elif itemprop == 'description' and description is None:
+                description = _read_description(elem)
+
+        if _is_captured(elem):
+            captured -= 1
+
+        # free the parsed elements that are not needed anymore
+        if captured == 0:
+            elem.clear()
+            parent = elem.getparent()
+            if parent is not None:
+                while elem.getprevious() is not None:
+                    del parent[0]
+
+    del context
+
+    if not claims_found or num_claims is None:
+        raise ValueError('claims section not found')
+    if submission_date is None:
+        raise ValueError('submission date not found')
+
+    # count similar documents published before the submission date
+    submission_date = datetime.strptime(submission_date, '%Y-%m-%d')
+    similar_doc_num = 0
+    for publication_date in similar_dates:
+        # a small number of publications do not have the same date format
+        try:
+            if datetime.strptime(publication_date, '%Y-%m-%d') < submission_date:
+                similar_doc_num += 1
+        except (TypeError, ValueError):
+            continue
+
+    return PatentRecord(
+        title=title,
+        abstract=abstract,
+        classification=classification if classification is not None else 'NA',
+        num_applications=num_applications,
+        assignee=assignee,
+        patent_citations=patent_citations,
+        non_patent_citations=non_patent_citations,
+        description=description,
+        num_claims=num_claims,
+        claim_content=claim_content,
+        similar_doc_num=similar_doc_num,
+        payment_times=payment_times,
+        num_inventors=num_inventors,
+    )
+
+
+### function to compare the speed of the extractor with the soup functions
+# input: list of html pages (bytes), number of repetitions
+# output: dictionary with pages per second of both methods
+def benchmark(pages, repeat=3, WO_index=0):
+    import patent_scraper as ps
+    from bs4 import BeautifulSoup
+
+    def soup_functions(page):
+        soup = BeautifulSoup(page, "lxml")
+        ps.find_patent_title(soup)
+        ps.find_patent_abstract(soup)
+        ps.find_patent_class(soup)
+        ps.find_patent_applications(soup)
+        ps.find_citation_nums(soup)
+        ps.count_similar_documents(soup)
+        ps.find_maintainance_years(soup)
+        ps.find_num_inventors(soup)
+        if WO_index == 0:
+            ps.read_patent_claims(soup)
+        else:
+            ps.read_patent_claims_WO(soup)
+        try:
+            ps.read_patent_content(soup)
+        except AttributeError:
+            pass
+
+    def single_pass(page):
+        extract_page(page, WO_index)
+
+    results = {}
+    for name, func in [('soup', soup_functions), ('extractor', single_pass)]:
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            for page in pages:
+                func(page)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = len(pages) / best if best > 0 else float('inf')
+
+    results['speedup'] = results['extractor'] / results['soup']
+
+    return results
+
+
+if __name__ == '__main__':
+    # usage: python page_extractor.py page1.html page2.html ...
+    pages = []
+    for path in sys.argv[1:]:
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+
+    results = benchmark(pages)
+    print('soup functions: %.1f pages/s' % results['soup'])
+    print('single pass extractor: %.1f pages/s' % results['extractor'])
+    print('speedup: %.2fx' % results['speedup'])
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import feature_builder
+import versioned_folder
+
+##### Precomputed predictors of known patents #####
+# the 113 predictors (7 one-hot classes, 6 non-text counts, word2vec vector)
+# of every known patent are saved in a memory-mapped float32 matrix,
+# so the webapp does not need to scrape and embed them again
+#
+# the index folder is replaced atomically when the index is rebuilt
+# (versioned_folder.py), so the ids, titles and predictors always match
+#
+# the claim vectors are those of one word2vec model: the index records its
+# version (claim_cache.model_version), and an index built with another
+# model must not be used (see built_with)
+#
+# layout of an index folder:
+#   ids.json          patent numbers in row order
+#   titles.json       titles in row order
+#   predictors.npy    float32 matrix of size (number of patents, 113)
+#   meta.json         version of the word2vec model of the claim vectors
+
+
+# classes of the one-hot encoding (class A is the baseline)
+CLASSES = feature_builder.CLASSES
+# non-text columns of the feature store, in the order of the predictors
+NONTEXT_COLUMNS = feature_builder.NONTEXT_COLUMNS
+
+
+### function to save an index
+# input: index folder, list of patent numbers, list of titles,
+#        predictors of size (number of patents, 113),
+#        version of the word2vec model of the claim vectors
+def save_index(path, ids, titles, predictors, word2vec_version=None):
+    folder = versioned_folder.new_version(path)
+
+    with open(os.path.join(folder, 'ids.json'), 'w') as f:
+        json.dump(list(ids), f)
+    with open(os.path.join(folder, 'titles.json'), 'w') as f:
+        json.dump(list(titles), f)
+    with open(os.path.join(folder, 'meta.json'), 'w') as f:
+        json.dump({'word2vec_version': word2vec_version}, f)
+    np.save(os.path.join(folder, 'predictors.npy'), np.asarray(predictors, dtype = np.float32))
+
+    # readers reload the index when the published predictors change
+    versioned_folder.publish(path, folder)
+
+
+### function to load an index
+# input: path to the predictors.npy file of the index folder
+# output: dictionary with the row of each patent, the titles,
+#         the memory-mapped predictors and the version of the word2vec
+#         model (None for indexes saved without it)
+def load_index(path):
+    # all the files are read from the same version
+    folder = versioned_folder.resolve(os.path.dirname(path))
+    with open(os.path.join(folder, 'ids.json'), 'r') as f:
+        ids = json.load(f)
+    with open(os.path.join(folder, 'titles.json'), 'r') as f:
+        titles = json.load(f)
+    meta = {}
+    if os.path.exists(os.path.join(folder, 'meta.json')):
+        with open(os.path.join(folder, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+    return {
+        'rows': dict((patent_number, i) for i, patent_number in enumerate(ids)),
+        'titles': titles,
+        'predictors': np.load(os.path.join(folder, os.path.basename(path)), mmap_mode = 'r'),
+        'word2vec_version': meta.get('word2vec_version'),
+    }
+
+
+### function to check that an index was built with a word2vec model
+# input: loaded index (or similar patent index), word2vec model
+#        (see claim_embedding.model_lookup)
+# output: True if the claim vectors of the index are those of the model
+def built_with(index, word2vec_model):
+    import claim_cache
+
+    version = index.get('word2vec_version')
+    return version is not None and version == claim_cache.model_version(word2vec_model)
+
+
+### function to find the predictors of a known patent
+# input: loaded index, patent number
+# output: title and predictors of size (1, 113), or None if unknown
+def lookup(index, patent_number):
+    row = index['rows'].get(patent_number)
+    if row is None:
+        return None
+
+    return index['titles'][row], index['predictors'][row:row + 1]
+
+
+### function to build an index from the feature store
+# input: feature store folder (non-text columns, id, title and claims),
+#        trained word2vec model, index folder, years to include
+def build_from_store(store, word2vec_model, path, years=None):
+    import feature_store
+    import claim_cache
+
+    data = feature_store.read(store, ['id', 'title', 'claims'] + CLASSES +
+                              NONTEXT_COLUMNS, years, mmap = None)
+
+    # tokenize and embed all the claims at once (claims already in the
+    # claim cache are not tokenized again)
+    vectors = claim_cache.embed(list(data['claims'].values), word2vec_model)
+
+    predictors = np.concatenate([data[CLASSES].values.astype(np.float32),
+                                 data[NONTEXT_COLUMNS].values.astype(np.float32),
+                                 vectors], axis = 1)
+    titles = [title.strip() if title is not None else None
+              for title in data['title'].values]
+
+    save_index(path, data['id'].values, titles, predictors,
+               claim_cache.model_version(word2vec_model))
+
+
+### function to build an index by reading the patent pages
+# pages are read through the page cache, so cached pages are not downloaded
+# input: list of patent numbers, trained word2vec model, index folder
+# output: list of patent numbers that could not be read
+def build_from_pages(patent_numbers, word2vec_model, path):
+    import patent_scraper as ps
+    import claim_cache
+
+    ids, titles, predictors, failed = [], [], [], []
+    for patent_number in patent_numbers:
+        url = 'https://patents.google.com/patent/' + patent_number + '/en'
+        WO_index = 1 if patent_number[:2] == 'WO' else 0
+        try:
+            record, features = ps.read_patent_page(ps.fetch_page(url), WO_index,
+                                                   word2vec_model)
+        except Exception:
+            failed.append(patent_number)
+            continue
+        ids.append(patent_number)
+        titles.append(record.title)
+        predictors.append(features)
+
+    save_index(path, ids, titles, np.concatenate(predictors, axis = 0),
+               claim_cache.model_version(word2vec_model))
+
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description = 'Build the index of precomputed predictors of known patents')
+    parser.add_argument('--store', help = 'feature store folder')
+    parser.add_argument('--years', type = int, nargs = '*', default = None)
+    parser.add_argument('--patent-numbers',
+                        help = 'pickled list of patent numbers to read from the pages')
+    parser.add_argument('--word2vec', default = 'models/word2vec_claims_final')
+    parser.add_argument('-o', '--output', default = 'flask/models/patent_index')
+    args = parser.parse_args(argv)
+
+    from gensim.models import Word2Vec
+    word2vec_model = Word2Vec.load(args.word2vec)
+
+    if args.store:
+        build_from_store(args.store, word2vec_model, args.output, args.years)
+    elif args.patent_numbers:
+        import pickle
+        with open(args.patent_numbers, 'rb') as f:
+            patent_numbers = pickle.load(f)
+        failed = build_from_pages(patent_numbers, word2vec_model, args.output)
+        for patent_number in failed:
+            sys.stderr.write('failed %s\n' % patent_number)
+    else:
+        parser.error('--store or --patent-numbers is required')
+
+
+if __name__ == '__main__':
+    main()
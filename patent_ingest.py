@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import csv
+import argparse
+from datetime import datetime
+from collections import OrderedDict
+import pandas as pd
+import feature_store
+import scrape_engine
+
+##### Streaming ingestion of the patent_lists files #####
+# the csv files downloaded from the Google Patents search are found by name
+# (patent_lists/patent_list_YYYYMM.csv), their first line (the search url)
+# is skipped, and their rows are read one at a time with typed dates
+# a patent listed in two quarters is only kept the first time
+#
+# the rows are streamed to the scraper and written to the feature store
+# one publication year at a time, so adding years does not increase the
+# memory used (only the set of ids seen is kept)
+
+
+# name of the files of the patent lists
+LIST_PATTERN = re.compile(r'^patent_list_(\d{4})(\d{2})\.csv$')
+
+# columns of the lists read as dates
+DATE_COLUMNS = ['priority date', 'filing/creation date', 'publication date', 'grant date']
+
+
+### function to find the patent list files
+# input: folder of the lists, years to keep (all by default)
+# output: list of (year, month, path) in chronological order
+def discover(directory='patent_lists', years=None):
+    found = []
+    for name in os.listdir(directory):
+        match = LIST_PATTERN.match(name)
+        if match is None:
+            continue
+        year, month = int(match.group(1)), int(match.group(2))
+        if years is None or year in years:
+            found.append((year, month, os.path.join(directory, name)))
+
+    return sorted(found)
+
+
+### function to read the search url written on the first line of a list
+def search_url(path):
+    with open(path, 'rb') as f:
+        first = next(csv.reader(f))
+    return first[1] if len(first) > 1 else None
+
+
+### function to read a date of a list
+# output: datetime.date, or None if the cell is empty or not a date
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+### function to read the rows of a list file one at a time
+# input: csv file
+# output: generator of ordered dictionaries column -> value (unicode text,
+#         datetime.date for the DATE_COLUMNS, and 'list': the file name)
+def read_list(path):
+    name = os.path.basename(path)
+    with open(path, 'rb') as f:
+        reader = csv.reader(f)
+        # first line: search url, second line: column names
+        next(reader)
+        columns = [column.decode('utf-8') for column in next(reader)]
+        dates = [column in DATE_COLUMNS for column in columns]
+
+        for cells in reader:
+            if not cells:
+                continue
+            row = OrderedDict()
+            for column, is_date, cell in zip(columns, dates, cells):
+                row[column] = parse_date(cell) if is_date else cell.decode('utf-8')
+            row['list'] = name
+            yield row
+
+
+### function to stream the rows of many list files
+# input: list files (all the files of patent_lists by default),
+#        dedupe: skip the patents already read from an earlier file
+# output: generator of rows (see read_list)
+def iter_rows(paths=None, dedupe=True):
+    if paths is None:
+        paths = [path for _, _, path in discover()]
+
+    seen = set()
+    for path in paths:
+        for row in read_list(path):
+            if dedupe:
+                if row['id'] in seen:
+                    continue
+                seen.add(row['id'])
+            yield row
+
+
+### function to group rows into DataFrames
+# input: rows, number of rows per DataFrame
+# output: generator of DataFrames in the layout of read_patent_lists
+def iter_chunks(rows, size=1000):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield pd.DataFrame(chunk)
+            chunk = []
+    if chunk:
+        yield pd.DataFrame(chunk)
+
+
+### function to scrape streamed rows
+# only the rows being scraped are kept in memory
+# input: rows, options of scrape_engine.scrape
+# output: generator of (row, PatentRecord or None, error or None)
+#         in the order the patents are finished
+def scrape_rows(rows, **options):
+    in_flight = {}
+
+    def patents():
+        for i, row in enumerate(rows):
+            in_flight[i] = row
+            yield row['id'], row['result link']
+
+    for i, patent_id, record, error in scrape_engine.scrape(patents(), **options):
+        yield in_flight.pop(i), record, error
+
+
+### function to scrape the lists into a feature store
+# the scraped patents are written one publication year at a time
+# (the lists are in chronological order, so a year is complete when the
+# next one starts)
+# input: store folder, list files, options of scrape_engine.scrape
+# output: dictionary with the number of patents stored and failed per year
+def ingest(store, paths=None, **options):
+    summary = {}
+    current = {'year': None, 'rows': [], 'records': []}
+
+    def flush():
+        if current['rows']:
+            data = scrape_engine.add_record_columns(pd.DataFrame(current['rows']),
+                                                    current['records'])
+            for column in DATE_COLUMNS:
+                if column in data.columns:
+                    data[column] = [None if value is None else value.isoformat()
+                                    for value in data[column].values]
+            if summary[current['year']]['partial']:
+                # the year was split between lists: add to the saved rows
+                saved = feature_store.read(store, list(data.columns),
+                                           [current['year']], mmap = None)
+                data = pd.concat([saved, data], axis = 0, ignore_index = True)
+            feature_store.write_year(store, current['year'], data)
+            summary[current['year']]['partial'] = True
+        current['rows'], current['records'] = [], []
+
+    # rows of one year at a time, scraped before the next year is read
+    for year, rows in _group_by_year(iter_rows(paths)):
+        summary.setdefault(year, {'stored': 0, 'failed': 0, 'partial': False})
+        current['year'] = year
+        for row, record, error in scrape_rows(rows, **options):
+            if error is not None:
+                summary[year]['failed'] += 1
+                sys.stderr.write('failed %s: %s\n' % (row['id'], error))
+                continue
+            current['rows'].append(row)
+            current['records'].append(record)
+            summary[year]['stored'] += 1
+        flush()
+
+    for counts in summary.values():
+        del counts['partial']
+    return summary
+
+
+### function to split streamed rows by publication year
+# output: generator of (year, generator of rows); each group must be
+#         consumed before the next one is requested
+def _group_by_year(rows):
+    rows = iter(rows)
+    state = {'next': next(rows, None)}
+
+    def group(year):
+        while state['next'] is not None and _year(state['next']) == year:
+            row = state['next']
+            state['next'] = next(rows, None)
+            yield row
+
+    while state['next'] is not None:
+        year = _year(state['next'])
+        yield year, group(year)
+
+
+def _year(row):
+    date = row.get('publication date')
+    return date.year if date is not None else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description = 'Scrape the patent_lists files into a feature store')
+    parser.add_argument('--lists', default = 'patent_lists', help = 'folder of the lists')
+    parser.add_argument('--years', type = int, nargs = '+', default = None)
+    parser.add_argument('--store', required = True, help = 'feature store folder')
+    parser.add_argument('--workers', type = int, default = 8)
+    parser.add_argument('--rate', type = float, default = 2.0)
+    parser.add_argument('--base-url', default = None)
+    parser.add_argument('--dry-run', action = 'store_true',
+                        help = 'only count the rows of the lists')
+    args = parser.parse_args(argv)
+
+    paths = [path for _, _, path in discover(args.lists, args.years)]
+    if args.dry_run:
+        counts = {}
+        for row in iter_rows(paths):
+            counts[_year(row)] = counts.get(_year(row), 0) + 1
+        for year in sorted(counts):
+            print('%d: %d patents' % (year, counts[year]))
+        return
+
+    summary = ingest(args.store, paths, workers = args.workers, rate = args.rate,
+                     base_url = args.base_url)
+    for year in sorted(summary):
+        print('%d: %d stored, %d failed' % (year, summary[year]['stored'],
+                                            summary[year]['failed']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import random
+import socket
+import argparse
+import threading
+import urllib2
+import urlparse
+import multiprocessing
+from Queue import Queue
+import numpy as np
+import pandas as pd
+import page_extractor
+import page_cache
+import feature_builder
+
+##### Concurrent scraping of the patents in the patent_lists files #####
+# pages are downloaded by a pool of threads (rate limited per host)
+# and parsed by a separate pool of processes
+
+
+# HTTP status codes worth retrying
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+### function to read the patent lists downloaded from Google Patents search
+# input: list of csv files (the first line is the search url)
+# output: DataFrame with all the patents
+def read_patent_lists(paths):
+    lists = [pd.read_csv(path, skiprows = 1) for path in paths]
+    return pd.concat(lists, axis = 0, ignore_index = True)
+
+
+### function to create a per-host rate limiter
+# input: maximum number of requests per second to each host
+# output: function wait(url) blocking until a request to the host is allowed
+def make_rate_limiter(rate):
+    lock = threading.Lock()
+    next_slot = {}
+    interval = 1.0 / rate if rate else 0.0
+
+    def wait(url):
+        if not interval:
+            return
+        host = urlparse.urlparse(url).netloc
+        # reserve the next free slot of the host
+        with lock:
+            now = time.time()
+            slot = max(now, next_slot.get(host, now))
+            next_slot[host] = slot + interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+    return wait
+
+
+### function to download a page with retries
+# input: url, rate limiter, number of retries, base of the backoff (seconds),
+#        timeout of each request (seconds)
+# output: html content of the page
+# raises the last error when all the attempts failed
+def fetch_with_retries(url, wait, retries=3, backoff=1.0, timeout=30):
+    attempt = 0
+    while True:
+        wait(url)
+        try:
+            response = urllib2.urlopen(url, timeout = timeout)
+            try:
+                return response.read()
+            finally:
+                response.close()
+        except urllib2.HTTPError as e:
+            if e.code not in RETRY_STATUS or attempt >= retries:
+                raise
+        except (urllib2.URLError, socket.timeout, socket.error):
+            if attempt >= retries:
+                raise
+        # exponential backoff with jitter
+        time.sleep(backoff * (2 ** attempt) * (0.5 + random.random()))
+        attempt += 1
+
+
+### function to parse a page in the parsing pool
+# errors are returned instead of raised so that one page cannot stop the pool
+def _parse_page(page, WO_index):
+    try:
+        return page_extractor.extract_page(page, WO_index), None
+    except Exception as e:
+        return None, '%s: %s' % (type(e).__name__, e)
+
+
+### function to scrape a list of patents
+# input: list or iterator of (patent id, url) pairs (read lazily, so the
+#        patents can be streamed, e.g. from patent_ingest.iter_rows)
+#        workers: number of download threads
+#        parse_workers: number of parsing processes (number of cores by default)
+#        rate: maximum requests per second to each host
+#        retries, backoff, timeout: see fetch_with_retries
+#        base_url: replace the scheme and host of the urls (e.g. a local server)
+#        cache: page_cache settings, or False to always download the pages
+# output: generator of (index, patent id, PatentRecord or None, error or None)
+#         in the order the patents are finished
+def scrape(patents, workers=8, parse_workers=None, rate=2.0, retries=3,
+           backoff=1.0, timeout=30, base_url=None, cache=None):
+    if parse_workers is None:
+        parse_workers = multiprocessing.cpu_count()
+
+    wait = make_rate_limiter(rate)
+    # only a few patents are read ahead of the download threads
+    todo = Queue(4 * workers)
+    results = Queue()
+    parse_pool = multiprocessing.Pool(parse_workers)
+    # limit the number of downloaded pages waiting to be parsed
+    pending = threading.BoundedSemaphore(4 * parse_workers)
+
+    if cache is None:
+        cache = page_cache.default_cache()
+
+    # marker of the end of the patents (followed by their number and the
+    # error raised while reading them, if any)
+    end = object()
+
+    def producer():
+        n = 0
+        error = None
+        try:
+            for i, (patent_id, url) in enumerate(patents):
+                todo.put((i, patent_id, url))
+                n += 1
+        except Exception as e:
+            error = e
+        for _ in range(workers):
+            todo.put(None)
+        results.put((end, n, error))
+
+    def parsed(i, patent_id):
+        def callback(result):
+            pending.release()
+            record, error = result
+            results.put((i, patent_id, record, error))
+        return callback
+
+    def fetch_worker():
+        while True:
+            item = todo.get()
+            if item is None:
+                return
+            i, patent_id, url = item
+
+            def download(url):
+                if base_url is not None:
+                    url = base_url.rstrip('/') + urlparse.urlparse(url).path
+                return fetch_with_retries(url, wait, retries, backoff, timeout)
+
+            try:
+                if cache:
+                    # pages are cached under their original url
+                    page = page_cache.get_page(url, download, cache)
+                else:
+                    page = download(url)
+            except Exception as e:
+                results.put((i, patent_id, None, '%s: %s' % (type(e).__name__, e)))
+                continue
+            WO_index = 1 if patent_id[:2] == 'WO' else 0
+            pending.acquire()
+            parse_pool.apply_async(_parse_page, (page, WO_index),
+                                   callback = parsed(i, patent_id))
+
+    threads = [threading.Thread(target = fetch_worker) for _ in range(workers)]
+    threads.append(threading.Thread(target = producer))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        total = None
+        done = 0
+        while total is None or done < total:
+            result = results.get()
+            if result[0] is end:
+                total, error = result[1], result[2]
+                if error is not None:
+                    raise error
+                continue
+            done += 1
+            yield result
+    finally:
+        parse_pool.terminate()
+        parse_pool.join()
+
+
+### function to scrape the patents of a patent list into the notebook layout
+# input: DataFrame read by read_patent_lists, options of scrape
+# output: DataFrame with the scraped columns added, list of failed patents
+def scrape_patent_list(patent_list, progress_every=500, **options):
+    patents = zip(patent_list['id'].values, patent_list['result link'].values)
+    records = [None] * len(patents)
+    failures = []
+
+    start = time.time()
+    for done, (i, patent_id, record, error) in enumerate(scrape(patents, **options)):
+        if error is not None:
+            failures.append((patent_id, error))
+        else:
+            records[i] = record
+
+        # track the progress
+        if progress_every and (done + 1) % progress_every == 0:
+            elapsed = time.time() - start
+            sys.stderr.write('%d/%d patents, %.1f patents/s, %d failed\n'
+                             % (done + 1, len(patents), (done + 1) / elapsed,
+                                len(failures)))
+
+    # keep the patents that were scraped
+    scraped = np.asarray([record is not None for record in records], dtype = bool)
+    patent_list = patent_list[scraped].copy()
+    records = [record for record in records if record is not None]
+
+    return add_record_columns(patent_list, records), failures
+
+
+### function to add the scraped information to a patent list
+# input: DataFrame of patents, list of PatentRecord in the same order
+# output: DataFrame with the same columns as the scraping notebook
+def add_record_columns(patent_list, records):
+    patent_list = patent_list.copy()
+    patent_list["abstract"] = [r.abstract for r in records]
+    patent_list["classification"] = [r.classification for r in records]
+    patent_list["num_applications"] = [r.num_applications for r in records]
+    patent_list["num_patent_citations"] = [r.patent_citations for r in records]
+    patent_list["num_nonpatent_citations"] = [r.non_patent_citations for r in records]
+    patent_list["description"] = [r.description for r in records]
+    patent_list["num_claims"] = [r.num_claims for r in records]
+    patent_list["claims"] = [r.claim_content for r in records]
+    patent_list["num_similar_doc"] = [r.similar_doc_num for r in records]
+    patent_list["payment_times"] = [r.payment_times for r in records]
+    patent_list["num_authors"] = feature_builder.count_authors(
+        patent_list['inventor/author'].values)
+
+    return patent_list
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description = 'Scrape the patents of patent_lists csv files')
+    parser.add_argument('lists', nargs = '+', help = 'patent_lists csv files')
+    parser.add_argument('-o', '--output', required = True,
+                        help = 'pickle file for the scraped DataFrame')
+    parser.add_argument('--workers', type = int, default = 8,
+                        help = 'number of download threads')
+    parser.add_argument('--parse-workers', type = int, default = None,
+                        help = 'number of parsing processes')
+    parser.add_argument('--rate', type = float, default = 2.0,
+                        help = 'maximum requests per second to each host')
+    parser.add_argument('--retries', type = int, default = 3)
+    parser.add_argument('--backoff', type = float, default = 1.0)
+    parser.add_argument('--timeout', type = float, default = 30)
+    parser.add_argument('--base-url', default = None,
+                        help = 'replace https://patents.google.com in the links')
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = 'always download the pages')
+    parser.add_argument('--offline', action = 'store_true',
+                        help = 'only use the pages in the page cache')
+    args = parser.parse_args(argv)
+
+    if args.no_cache:
+        cache = False
+    else:
+        cache = page_cache.open_cache(offline = True if args.offline else None)
+
+    patent_list = read_patent_lists(args.lists)
+    patent_list, failures = scrape_patent_list(
+        patent_list, workers = args.workers, parse_workers = args.parse_workers,
+        rate = args.rate, retries = args.retries, backoff = args.backoff,
+        timeout = args.timeout, base_url = args.base_url, cache = cache)
+
+    patent_list.to_pickle(args.output)
+
+    for patent_id, error in failures:
+        sys.stderr.write('failed %s: %s\n' % (patent_id, error))
+    sys.stderr.write('%d patents scraped, %d failed\n'
+                     % (patent_list.shape[0], len(failures)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import pandas as pd
+import page_extractor
+import scrape_engine
+
+##### Resumable scraping jobs #####
+# the scraped records are committed in chunks to a sqlite file in the job
+# folder, so an interrupted job resumes after the last committed patent
+# patents that cannot be downloaded or parsed are quarantined with the error
+# instead of stopping the job, and re-running a job over the same
+# patent_lists files only scrapes the patents that are not committed yet
+
+
+### function to open (or create) the database of a job
+# input: job folder
+# output: sqlite connection
+def open_job(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    con = sqlite3.connect(os.path.join(path, 'job.sqlite'), timeout = 30)
+    con.execute('PRAGMA journal_mode=WAL')
+    with con:
+        con.execute("""CREATE TABLE IF NOT EXISTS records (
+                           patent_id TEXT PRIMARY KEY,
+                           position INTEGER NOT NULL,
+                           list_row TEXT NOT NULL,
+                           record TEXT NOT NULL,
+                           committed_at REAL NOT NULL)""")
+        con.execute("""CREATE TABLE IF NOT EXISTS quarantine (
+                           patent_id TEXT PRIMARY KEY,
+                           position INTEGER NOT NULL,
+                           list_row TEXT NOT NULL,
+                           error TEXT NOT NULL,
+                           attempts INTEGER NOT NULL,
+                           failed_at REAL NOT NULL)""")
+
+    return con
+
+
+### function to check a record before it is committed
+# raises ValueError for records that cannot be stored in the database later
+# (e.g. the 2004 row with a NUL character)
+def validate_record(record):
+    for name, value in zip(record._fields, record):
+        if isinstance(value, basestring) and u'\x00' in value:
+            raise ValueError('NUL character in %s' % name)
+    if record.num_claims is None or record.num_claims < 0:
+        raise ValueError('invalid number of claims')
+
+
+### function to read the ids already handled by a job
+# output: set of committed ids, set of quarantined ids
+def handled_ids(con):
+    committed = set(row[0] for row in con.execute('SELECT patent_id FROM records'))
+    quarantined = set(row[0] for row in con.execute('SELECT patent_id FROM quarantine'))
+    return committed, quarantined
+
+
+### function to commit a chunk of results in one transaction
+def _commit(con, records, failures):
+    now = time.time()
+    with con:
+        con.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)',
+                        [(patent_id, position, list_row, record, now)
+                         for patent_id, position, list_row, record in records])
+        con.executemany('DELETE FROM quarantine WHERE patent_id = ?',
+                        [(patent_id,) for patent_id, _, _, _ in records])
+        for patent_id, position, list_row, error in failures:
+            row = con.execute('SELECT attempts FROM quarantine WHERE patent_id = ?',
+                              (patent_id,)).fetchone()
+            attempts = row[0] + 1 if row else 1
+            con.execute('INSERT OR REPLACE INTO quarantine VALUES (?, ?, ?, ?, ?, ?)',
+                        (patent_id, position, list_row, error, attempts, now))
+
+
+### function to run a scraping job
+# input: DataFrame read by scrape_engine.read_patent_lists, job folder,
+#        number of patents committed at once, retry the quarantined patents,
+#        options of scrape_engine.scrape
+# output: dictionary with the numbers of scraped, quarantined and skipped patents
+def run_job(patent_list, path, chunk_size=200, retry_failed=False, **options):
+    con = open_job(path)
+    committed, quarantined = handled_ids(con)
+    skip = committed if retry_failed else committed | quarantined
+
+    # the same patent can be listed in two files
+    patent_list = patent_list.drop_duplicates('id')
+    todo = [(position, row) for position, row in
+            enumerate(patent_list.to_dict('records')) if row['id'] not in skip]
+    total = patent_list.shape[0]
+    done = total - len(todo)
+
+    summary = {'total': total, 'skipped': done, 'scraped': 0, 'quarantined': 0}
+    records, failures = [], []
+    start = time.time()
+
+    patents = [(row['id'], row['result link']) for position, row in todo]
+    try:
+        for i, patent_id, record, error in scrape_engine.scrape(patents, **options):
+            position, row = todo[i]
+            list_row = json.dumps(row, default = str)
+            if error is None:
+                try:
+                    validate_record(record)
+                except ValueError as e:
+                    error = 'ValueError: %s' % e
+
+            if error is None:
+                records.append((patent_id, position, list_row,
+                                json.dumps(record._asdict())))
+            else:
+                failures.append((patent_id, position, list_row, error))
+
+            if len(records) + len(failures) >= chunk_size:
+                summary['scraped'] += len(records)
+                summary['quarantined'] += len(failures)
+                done += len(records) + len(failures)
+                _commit(con, records, failures)
+                records, failures = [], []
+                _report(done, total, summary, start)
+    finally:
+        # keep what was scraped when the job is interrupted
+        summary['scraped'] += len(records)
+        summary['quarantined'] += len(failures)
+        done += len(records) + len(failures)
+        _commit(con, records, failures)
+        con.close()
+
+    _report(done, total, summary, start)
+    summary['seconds'] = time.time() - start
+
+    return summary
+
+
+### function to report the progress of a job
+def _report(done, total, summary, start):
+    elapsed = max(time.time() - start, 1e-9)
+    handled = summary['scraped'] + summary['quarantined']
+    sys.stderr.write('%d/%d patents done, %.2f patents/s, %d quarantined\n'
+                     % (done, total, handled / elapsed, summary['quarantined']))
+
+
+### function to read the committed records of a job
+# output: DataFrame in the layout of the scraping notebook, in list order
+def export(path):
+    con = open_job(path)
+    try:
+        rows = con.execute('SELECT list_row, record FROM records ORDER BY position').fetchall()
+    finally:
+        con.close()
+
+    patent_list = pd.DataFrame([json.loads(list_row) for list_row, _ in rows])
+    records = [page_extractor.PatentRecord(**json.loads(record)) for _, record in rows]
+
+    return scrape_engine.add_record_columns(patent_list, records)
+
+
+### function to read the quarantined patents of a job
+# output: DataFrame with the patent id, the error and the number of attempts
+def quarantine(path):
+    con = open_job(path)
+    try:
+        return pd.read_sql_query('SELECT patent_id, error, attempts, failed_at '
+                                 'FROM quarantine ORDER BY position', con)
+    finally:
+        con.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description = 'Run a resumable scraping job')
+    parser.add_argument('lists', nargs = '+', help = 'patent_lists csv files')
+    parser.add_argument('--job', required = True, help = 'job folder')
+    parser.add_argument('--chunk-size', type = int, default = 200)
+    parser.add_argument('--retry-failed', action = 'store_true',
+                        help = 'scrape the quarantined patents again')
+    parser.add_argument('--export', help = 'pickle file for the scraped DataFrame')
+    parser.add_argument('--workers', type = int, default = 8)
+    parser.add_argument('--rate', type = float, default = 2.0)
+    parser.add_argument('--base-url', default = None)
+    args = parser.parse_args(argv)
+
+    patent_list = scrape_engine.read_patent_lists(args.lists)
+    summary = run_job(patent_list, args.job, args.chunk_size, args.retry_failed,
+                      workers = args.workers, rate = args.rate,
+                      base_url = args.base_url)
+    sys.stderr.write('%(scraped)d scraped, %(quarantined)d quarantined, '
+                     '%(skipped)d already done\n' % summary)
+
+    if args.export:
+        export(args.job).to_pickle(args.export)
+
+
+if __name__ == '__main__':
+    main()
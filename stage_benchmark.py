@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import pickle
+import platform
+import argparse
+import numpy as np
+import patent_scraper as ps
+import page_extractor
+import scrape_engine
+
+##### Stage-level micro-benchmarks of the scoring pipeline #####
+# each stage of reading and scoring a patent is timed separately on the
+# pages saved in benchmark_fixtures (no network access is needed):
+#   parse: BeautifulSoup parse of generate_soup (ps.parse_soup)
+#   find_* / read_*: each extractor of patent_scraper on the parsed page
+#   extract_page: single pass extractor of page_extractor
+#   tokenize_cleaning, dec_vec, scaler.transform, predict_proba
+# stages whose model file is missing (or whose nltk data is not installed)
+# are reported as skipped, and the run fails unless --allow-skipped is given
+# (a stage that is never timed cannot show a regression)
+#
+# the results are written as JSON and compared with a stored baseline
+# (benchmark_fixtures/baseline.json); baselines are machine specific, save
+# a new one with --save-baseline before comparing changes on another machine
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_fixtures')
+BASELINE = os.path.join(FIXTURES, 'baseline.json')
+
+# fixture pages: name -> (file, WO_index)
+PAGES = {
+    'US': ('US7654321B2.html', 0),
+    'WO': ('WO2005012345A1.html', 1),
+}
+# sample rows of the patent_lists files
+PATENT_LIST_SAMPLE = os.path.join(FIXTURES, 'patent_list_sample.csv')
+
+# extractors run on every page, the claims reader depends on the page format
+EXTRACTORS = ['find_maintainance_years', 'find_patent_title', 'find_patent_abstract',
+              'find_patent_class', 'find_patent_applications', 'find_ori_assignee',
+              'find_citation_nums', 'read_patent_content', 'count_similar_documents',
+              'find_num_inventors']
+CLAIM_READERS = {0: 'read_patent_claims', 1: 'read_patent_claims_WO'}
+
+# slowdown over the baseline reported as a regression
+# (stages that take microseconds vary by about 30% between runs)
+TOLERANCE = 0.5
+
+
+### function to time a function
+# the number of calls per measurement is chosen so that a measurement
+# takes about min_seconds, and the best and median of the measurements are kept
+# input: function without arguments, number of measurements
+# output: dictionary with the seconds per call
+def time_stage(func, repeat=7, min_seconds=0.1):
+    start = time.time()
+    func()
+    once = max(time.time() - start, 1e-7)
+    number = max(1, int(min_seconds / once))
+
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(number):
+            func()
+        timings.append((time.time() - start) / number)
+
+    return {'best': min(timings), 'median': float(np.median(timings)),
+            'number': number, 'repeat': repeat}
+
+
+### function to load an optional artifact
+# output: loaded object, or None and the reason it is missing
+def _load_optional(path, loader):
+    if not os.path.exists(path):
+        return None, 'missing %s' % path
+    return loader(path), None
+
+
+def _load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _load_word2vec(path):
+    if os.path.isdir(path):
+        import word_vectors
+        return word_vectors.load_vectors(path)
+    from gensim.models import Word2Vec
+    return Word2Vec.load(path)
+
+
+### function to load the models used by the last stages
+# input: paths of the scaler, random forest and word2vec model
+#        (the word2vec path can be a folder exported by word_vectors.py)
+# output: dictionary name -> (object or None, reason it is missing)
+def load_models(scaler_path, model_path, word2vec_path):
+    return {
+        'scaler': _load_optional(scaler_path, _load_pickle),
+        'model': _load_optional(model_path, _load_pickle),
+        'word2vec': _load_optional(word2vec_path, _load_word2vec),
+    }
+
+
+### function to benchmark the stages of one fixture page
+# input: html page, WO_index, models loaded by load_models, repeat
+# output: dictionary stage -> timing (or skipped reason)
+def benchmark_page(page, WO_index, models, repeat=7):
+    results = {}
+    soup = ps.parse_soup(page)
+
+    results['parse'] = time_stage(lambda: ps.parse_soup(page), repeat)
+    for name in EXTRACTORS + [CLAIM_READERS[WO_index]]:
+        func = getattr(ps, name)
+        results[name] = time_stage(lambda: func(soup), repeat)
+
+    claim_text = ps.CLAIM_TEXT if WO_index == 0 else ps.CLAIM_TEXT_WO
+    results['extract_page'] = time_stage(
+        lambda: page_extractor.extract_page(page, WO_index, claim_text), repeat)
+    record = page_extractor.extract_page(page, WO_index, claim_text)
+
+    # text stages
+    try:
+        tokens = ps.tokenize_cleaning(record.claim_content)
+        results['tokenize_cleaning'] = time_stage(
+            lambda: ps.tokenize_cleaning(record.claim_content), repeat)
+    except LookupError:
+        # nltk stop words, punkt or wordnet not downloaded
+        # (dec_vec is then timed on the lower-cased words)
+        tokens = record.claim_content.lower().split()
+        results['tokenize_cleaning'] = {'skipped': 'nltk data not installed'}
+
+    word2vec, reason = models['word2vec']
+    if word2vec is not None:
+        results['dec_vec'] = time_stage(lambda: ps.dec_vec(word2vec, tokens), repeat)
+        claims = ps.dec_vec(word2vec, tokens)
+    else:
+        results['dec_vec'] = {'skipped': reason}
+        claims = None
+
+    # model stages
+    scaler, reason = models['scaler']
+    if scaler is None:
+        results['scaler.transform'] = {'skipped': reason}
+        results['predict_proba'] = {'skipped': reason}
+        return results
+
+    nontext = [record.num_applications, record.patent_citations,
+               record.non_patent_citations, record.num_claims,
+               record.similar_doc_num, record.num_inventors]
+    class_one_hot = [1.0 if record.classification == c else 0.0
+                     for c in ['B', 'C', 'D', 'E', 'F', 'G', 'H']]
+    if claims is None:
+        # same width as the training data, the values do not change the timing
+        claims = np.zeros((1, len(scaler.mean_) - 13))
+    predictors = np.concatenate([np.asarray([class_one_hot + nontext], dtype = float),
+                                 claims], axis = 1)
+
+    results['scaler.transform'] = time_stage(lambda: scaler.transform(predictors), repeat)
+    scaled = scaler.transform(predictors)
+
+    model, reason = models['model']
+    if model is not None:
+        results['predict_proba'] = time_stage(lambda: model.predict_proba(scaled), repeat)
+    else:
+        results['predict_proba'] = {'skipped': reason}
+
+    return results
+
+
+### function to run the whole suite
+# input: models loaded by load_models, repeat
+# output: dictionary with the environment and the timings of the stages
+#         (keys 'page/stage', and 'patent_lists/...' for the sample rows)
+def run(models, repeat=7):
+    stages = {}
+    for name, (filename, WO_index) in sorted(PAGES.items()):
+        with open(os.path.join(FIXTURES, filename), 'rb') as f:
+            page = f.read()
+        for stage, timing in benchmark_page(page, WO_index, models, repeat).items():
+            stages['%s/%s' % (name, stage)] = timing
+
+    # reading the sample of the patent lists
+    stages['patent_lists/read_patent_lists'] = time_stage(
+        lambda: scrape_engine.read_patent_lists([PATENT_LIST_SAMPLE]), repeat)
+    n_rows = scrape_engine.read_patent_lists([PATENT_LIST_SAMPLE]).shape[0]
+
+    # reading and scoring the sample rows, stage by stage (all rows are US patents)
+    per_page = sum(timing['best'] for stage, timing in stages.items()
+                   if stage.startswith('US/') and 'best' in timing
+                   and stage != 'US/extract_page')
+    stages['patent_lists/pipeline_estimate'] = {'best': per_page * n_rows, 'rows': n_rows}
+
+    import sklearn
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'numpy': np.__version__,
+            'sklearn': sklearn.__version__,
+        },
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'stages': stages,
+    }
+
+
+### function to compare results with a baseline
+# input: results of run, baseline results, tolerated slowdown
+# output: dictionary stage -> ratio to the baseline and regression flag;
+#         stages skipped (or missing) in either file have no ratio and the
+#         reason in 'skipped'
+def compare(results, baseline, tolerance=TOLERANCE):
+    comparison = {}
+    for stage in sorted(set(results['stages']) | set(baseline['stages'])):
+        timing = results['stages'].get(stage, {'skipped': 'not in the results'})
+        reference = baseline['stages'].get(stage, {'skipped': 'not in the baseline'})
+        if 'best' not in timing or 'best' not in reference:
+            reason = timing.get('skipped') or 'baseline: ' + reference.get('skipped', 'no timing')
+            comparison[stage] = {'ratio': None, 'regression': False, 'skipped': reason}
+            continue
+        ratio = timing['best'] / max(reference['best'], 1e-12)
+        comparison[stage] = {'ratio': ratio, 'regression': ratio > 1 + tolerance}
+
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description = 'Benchmark the stages of patent scoring')
+    parser.add_argument('--scaler', default = 'models/final_model_scaler.p')
+    parser.add_argument('--model', default = 'models/final_model.p')
+    parser.add_argument('--word2vec', default = 'models/word2vec_claims_final')
+    parser.add_argument('--repeat', type = int, default = 7)
+    parser.add_argument('--baseline', default = BASELINE)
+    parser.add_argument('--save-baseline', action = 'store_true',
+                        help = 'store the results as the new baseline')
+    parser.add_argument('--tolerance', type = float, default = TOLERANCE)
+    parser.add_argument('--allow-skipped', action = 'store_true',
+                        help = 'do not fail when a stage is skipped in the results '
+                        'or in the baseline')
+    parser.add_argument('-o', '--output', help = 'JSON file for the results (stdout by default)')
+    args = parser.parse_args(argv)
+
+    results = run(load_models(args.scaler, args.model, args.word2vec), args.repeat)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent = 1, sort_keys = True)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            results['comparison'] = compare(results, json.load(f), args.tolerance)
+
+    output = json.dumps(results, indent = 1, sort_keys = True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    # report the regressions (and the stages that were not compared) and fail
+    # so that they are noticed
+    comparison = results.get('comparison', {})
+    regressions = sorted(stage for stage, item in comparison.items() if item['regression'])
+    for stage in regressions:
+        sys.stderr.write('regression: %s is %.2fx slower than the baseline\n'
+                         % (stage, comparison[stage]['ratio']))
+    # stages not compared (or, for a new baseline, not timed)
+    items = results['stages'] if args.save_baseline else comparison
+    skipped = sorted(stage for stage, item in items.items() if 'skipped' in item)
+    for stage in skipped:
+        sys.stderr.write('skipped: %s (%s)\n' % (stage, items[stage]['skipped']))
+    if skipped and not args.allow_skipped:
+        sys.stderr.write('%d stages were not timed; install the models and the nltk data '
+                         'or pass --allow-skipped\n' % len(skipped))
+    return 1 if regressions or (skipped and not args.allow_skipped) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
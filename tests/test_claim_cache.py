@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import claim_cache
+import claim_embedding
+
+
+def split(text):
+    return text.lower().split()
+
+
+class ClaimCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        random = np.random.RandomState(0)
+        words = ['method', 'signal', 'sensor', 'filter', 'compound', 'carrier']
+        self.model = {'vocab': dict((word, i) for i, word in enumerate(words)),
+                      'vectors': random.normal(size = (len(words), 4)).astype(np.float32)}
+        self.texts = ['A method of filtering a signal', 'A sensor and a filter',
+                      'A compound and a carrier', 'Signal sensor method']
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def table_sizes(self, cache):
+        con = sqlite3.connect(cache['path'])
+        try:
+            return con.execute('SELECT (SELECT COALESCE(SUM(size), 0) FROM claims) + '
+                               '(SELECT COALESCE(SUM(size), 0) FROM vectors)').fetchone()[0]
+        finally:
+            con.close()
+
+    def test_vectors_match_embedding(self):
+        cache = claim_cache.open_cache(self.folder)
+        expected = claim_embedding.embed_documents(self.model, [split(t) for t in self.texts])
+        for _ in range(2):
+            vectors = claim_cache.embed(self.texts, self.model, cache, tokenizer = split)
+            np.testing.assert_allclose(vectors, expected, rtol = 1e-6)
+        self.assertEqual(cache['counters']['vector_hits'], len(self.texts))
+
+    def test_size_counter_matches_tables(self):
+        cache = claim_cache.open_cache(self.folder)
+        claim_cache.embed(self.texts, self.model, cache, tokenizer = split)
+        # the same claims from another process are not counted twice
+        other = claim_cache.open_cache(self.folder)
+        claim_cache.embed(self.texts[1:], self.model, other, tokenizer = split)
+        self.assertEqual(claim_cache.stats(cache)['bytes'], self.table_sizes(cache))
+
+        claim_cache.purge_models([], cache)
+        self.assertEqual(claim_cache.stats(cache)['bytes'], self.table_sizes(cache))
+
+    def test_hits_do_not_write(self):
+        cache = claim_cache.open_cache(self.folder)
+        claim_cache.embed(self.texts, self.model, cache, tokenizer = split)
+        con = claim_cache._connect(cache)
+        changes = con.total_changes
+        claim_cache.embed(self.texts, self.model, cache, tokenizer = split)
+        self.assertEqual(con.total_changes, changes)
+        self.assertEqual(len(cache['touched']['vectors']), len(self.texts))
+
+    def test_eviction_keeps_recent_entries(self):
+        cache = claim_cache.open_cache(self.folder)
+        claim_cache.embed(self.texts[1:2], self.model, cache, tokenizer = split)
+        claim_cache.embed(self.texts[:1], self.model, cache, tokenizer = split)
+        # both claims are read again (access times in memory only), then the
+        # limit is exceeded: the entries of the second claim are the oldest
+        claim_cache.embed(self.texts[1:2], self.model, cache, tokenizer = split)
+        claim_cache.embed(self.texts[:1], self.model, cache, tokenizer = split)
+        cache['max_bytes'] = claim_cache.stats(cache)['bytes'] - 1
+        claim_cache.embed(self.texts[:1], self.model, cache, tokenizer = split)
+
+        self.assertLessEqual(claim_cache.stats(cache)['bytes'], cache['max_bytes'])
+        self.assertEqual(claim_cache.stats(cache)['bytes'], self.table_sizes(cache))
+        self.assertGreater(cache['counters']['evicted'], 0)
+        con = claim_cache._connect(cache)
+        self.assertIn(claim_cache.text_key(self.texts[0]),
+                      set(key for key, in con.execute('SELECT key FROM vectors')))
+        self.assertNotIn(claim_cache.text_key(self.texts[1]),
+                         set(key for key, in con.execute('SELECT key FROM claims')))
+    def test_concurrent_dictionary_sync(self):
+        import time
+        import threading
+
+        class SlowConnection(object):
+            # rows of the tokens table, read slowly so the threads overlap
+            def execute(self, query, params):
+                def rows():
+                    for token_id, token in [(1, 'method'), (2, 'signal'), (3, 'sensor')]:
+                        if token_id >= params[0]:
+                            time.sleep(0.02)
+                            yield token_id, token
+                return rows()
+
+        cache = {'tokens': [None], 'token_ids': {}, 'lock': threading.Lock()}
+        threads = [threading.Thread(target = claim_cache._sync_dictionary,
+                                    args = (SlowConnection(), cache)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(cache['tokens'], [None, 'method', 'signal', 'sensor'])
+        self.assertEqual(cache['token_ids'], {'method': 1, 'signal': 2, 'sensor': 3})
+
+    def test_model_version_follows_the_model(self):
+        other = {'vocab': self.model['vocab'], 'vectors': self.model['vectors'] * 2}
+        version = claim_cache.model_version(self.model)
+        self.assertNotEqual(claim_cache.model_version(other), version)
+        self.assertEqual(claim_cache.model_version(self.model), version)
+
+if __name__ == '__main__':
+    unittest.main()
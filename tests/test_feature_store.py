@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import feature_store
+
+
+class FeatureStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store)
+
+    def data(self, ids):
+        return pd.DataFrame({'id': np.array(ids, dtype = object),
+                             'count': np.arange(len(ids))}, columns = ['id', 'count'])
+
+    def test_read_back(self):
+        feature_store.write_year(self.store, 2004, self.data(['US1', 'US2']))
+        feature_store.write_year(self.store, 2005, self.data(['US3']))
+        data = feature_store.read(self.store, ['id', 'count'])
+        self.assertEqual(list(data['id']), ['US1', 'US2', 'US3'])
+        self.assertEqual(list(data['count']), [0, 1, 0])
+
+    def test_unfinished_writes_are_not_years(self):
+        feature_store.write_year(self.store, 2004, self.data(['US1']))
+        # folders left by interrupted writes
+        os.makedirs(os.path.join(self.store, 'year=2005.tmp'))
+        os.makedirs(os.path.join(self.store, 'year=2006@20261018-120000-000000'))
+        self.assertEqual(feature_store.years(self.store), [2004])
+        self.assertEqual(len(feature_store.read(self.store, ['id'])), 1)
+
+    def test_rewrite_keeps_the_year_readable(self):
+        feature_store.write_year(self.store, 2004, self.data(['US1', 'US2']))
+        arrays, _ = feature_store.read_arrays(self.store, ['count'])
+        feature_store.write_year(self.store, 2004, self.data(['US3', 'US4', 'US5']))
+
+        # arrays opened before the rewrite still read the old version
+        self.assertEqual(list(arrays['count'][0]), [0, 1])
+        self.assertEqual(list(feature_store.read(self.store, ['id'])['id']),
+                         ['US3', 'US4', 'US5'])
+        self.assertEqual(feature_store.years(self.store), [2004])
+
+
+if __name__ == '__main__':
+    unittest.main()
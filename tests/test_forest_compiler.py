@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import forest_compiler
+
+
+class CompiledForestTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from sklearn.ensemble import RandomForestClassifier
+
+        random = np.random.RandomState(0)
+        cls.X = random.normal(size = (300, 12))
+        y = (cls.X[:, 0] + cls.X[:, 3] * cls.X[:, 5] + random.normal(scale = 0.5, size = 300) > 0)
+        cls.forest = RandomForestClassifier(n_estimators = 10, min_samples_leaf = 3,
+                                            random_state = 0).fit(cls.X, y.astype(int))
+        cls.compiled = forest_compiler.compile_forest(cls.forest)
+        cls.X_test = random.normal(size = (200, 12))
+
+    def test_batch_matches_sklearn(self):
+        np.testing.assert_allclose(forest_compiler.predict_proba(self.compiled, self.X_test),
+                                   self.forest.predict_proba(self.X_test), rtol = 0, atol = 1e-12)
+
+    def test_single_rows_match_sklearn(self):
+        for row in self.X_test[:20]:
+            np.testing.assert_allclose(
+                forest_compiler.predict_proba(self.compiled, row.reshape(1, -1)),
+                self.forest.predict_proba(row.reshape(1, -1)), rtol = 0, atol = 1e-12)
+
+    def test_rows_on_thresholds_match_sklearn(self):
+        # values exactly on a split go to the left child, like sklearn
+        tree = self.forest.estimators_[0].tree_
+        splits = tree.feature >= 0
+        X = np.repeat(self.X_test[:1], splits.sum(), axis = 0)
+        X[np.arange(len(X)), tree.feature[splits]] = tree.threshold[splits]
+        np.testing.assert_allclose(forest_compiler.predict_proba(self.compiled, X),
+                                   self.forest.predict_proba(X), rtol = 0, atol = 1e-12)
+
+    def test_save_load(self):
+        folder = tempfile.mkdtemp()
+        try:
+            forest_compiler.save_forest(self.compiled, os.path.join(folder, 'forest.npz'))
+            loaded = forest_compiler.load_forest(os.path.join(folder, 'forest.npz'))
+            np.testing.assert_array_equal(forest_compiler.predict_proba(loaded, self.X_test),
+                                          forest_compiler.predict_proba(self.compiled,
+                                                                        self.X_test))
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import http_client
+
+
+class DelayServerTest(unittest.TestCase):
+    delay = 0.3
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        with open(os.path.join(self.folder, 'US1.html'), 'wb') as f:
+            f.write(b'<html><body>US1</body></html>')
+        self.server = http_client.delay_server(self.folder, self.delay)
+        self.url = 'http://127.0.0.1:%d/patent/US1/en' % self.server.server_address[1]
+
+    def tearDown(self):
+        http_client.shutdown()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def test_read_timeout(self):
+        start = time.time()
+        with self.assertRaises(requests.Timeout):
+            http_client.get(self.url, timeout = (1.0, self.delay / 3))
+        self.assertLess(time.time() - start, self.delay)
+
+    def test_connection_reused(self):
+        for _ in range(3):
+            self.assertIn(b'US1', http_client.get(self.url))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_downloads_in_flight(self):
+        start = time.time()
+        results = [http_client.get_async(self.url) for _ in range(6)]
+        pages = [result.get(timeout = 5) for result in results]
+        self.assertTrue(all(b'US1' in page for page in pages))
+        # concurrent, not one delay after the other
+        self.assertLess(time.time() - start, 3 * self.delay)
+
+    def test_conditional_get(self):
+        page, etag, _ = http_client.get_conditional(self.url)
+        self.assertIn(b'US1', page)
+        self.assertIsNone(http_client.get_conditional(self.url, etag)[0])
+
+    def test_missing_page(self):
+        url = self.url.replace('US1', 'US2')
+        with self.assertRaises(requests.HTTPError):
+            http_client.get(url)
+
+
+if __name__ == '__main__':
+    unittest.main()
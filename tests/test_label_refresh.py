@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import label_refresh
+
+
+def dates(*values):
+    return np.array(values, dtype = 'datetime64[D]')
+
+
+class CanChangeTest(unittest.TestCase):
+    def test_count_read_before_later_windows_closed(self):
+        # granted in 2010 and scraped in 2017 with 1 payment: the second fee
+        # (due 2017-07, window closed in 2018) may have been paid since
+        grant = dates('2010-01-05')
+        self.assertTrue(label_refresh.can_change([1], grant, '2026-10-18',
+                                                 observed = dates('2017-03-01'))[0])
+        # the same count read in 2019, after the second window closed: expired
+        self.assertFalse(label_refresh.can_change([1], grant, '2026-10-18',
+                                                  observed = dates('2019-03-01'))[0])
+
+    def test_unknown_observation_date_assumes_no_lapse(self):
+        grant = dates('2010-01-05')
+        self.assertTrue(label_refresh.can_change([1], grant, '2026-10-18')[0])
+        self.assertTrue(label_refresh.can_change([0], grant, '2026-10-18',
+                                                 observed = dates('NaT'))[0])
+
+    def test_labels_that_cannot_change(self):
+        grant = dates('2010-01-05', '2010-01-05', 'NaT')
+        # already useful, first fee not paid in its window, unknown grant date
+        mask = label_refresh.can_change([2, 0, 0], grant, '2026-10-18',
+                                        observed = dates('2016-01-01', '2016-01-01',
+                                                         '2016-01-01'))
+        self.assertEqual(list(mask), [False, False, False])
+
+    def test_observation_after_refresh_date(self):
+        # a count read after the refresh date is read as of the refresh date
+        grant = dates('2010-01-05')
+        self.assertTrue(label_refresh.can_change([1], grant, '2017-03-01',
+                                                 observed = dates('2026-10-18'))[0])
+
+    def test_track_payments(self):
+        grant = dates('2004-01-05', '2004-01-05')
+        mask = label_refresh.can_change([2, 3], grant, '2026-10-18', None,
+                                        observed = dates('2014-01-01', '2016-01-01'))
+        # the third fee (due 2015-07) could still be recorded after 2014
+        self.assertEqual(list(mask), [True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
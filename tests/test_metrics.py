@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'flask', 'flaskexample'))
+import metrics
+
+
+class RenderTest(unittest.TestCase):
+    def setUp(self):
+        metrics._histograms.clear()
+        metrics._counters.clear()
+
+    def test_histogram_lines(self):
+        metrics.observe('parse', 0.003)
+        metrics.observe('parse', 0.2)
+        lines = metrics.render().splitlines()
+        self.assertIn('# TYPE patent_stage_seconds histogram', lines)
+        self.assertIn('patent_stage_seconds_bucket{stage="parse",le="0.005"} 1', lines)
+        self.assertIn('patent_stage_seconds_bucket{stage="parse",le="+Inf"} 2', lines)
+        self.assertIn('patent_stage_seconds_count{stage="parse"} 2', lines)
+
+    def test_labels_are_escaped(self):
+        metrics.observe('/a"b\\c\nd', 0.1, 'patent_request_seconds', 'endpoint')
+        text = metrics.render()
+        self.assertIn('patent_request_seconds_count{endpoint="/a\\"b\\\\c\\nd"} 1', text)
+        # one sample per line
+        self.assertEqual(len([line for line in text.splitlines()
+                              if line.startswith('patent_request_seconds_count')]), 1)
+
+    def test_trace_records_endpoint(self):
+        metrics.start_trace('/output')
+        with metrics.timer('predict'):
+            pass
+        self.assertIsNotNone(metrics.finish_trace())
+        self.assertIn('patent_request_seconds_count{endpoint="/output"} 1', metrics.render())
+        self.assertIn('patent_stage_seconds_count{stage="predict"} 1', metrics.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
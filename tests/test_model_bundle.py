@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import model_bundle
+import forest_compiler
+import versioned_folder
+
+# dimension of the test word vectors
+DIM = 4
+
+
+def fit_models(seed):
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.preprocessing import StandardScaler
+
+    random = np.random.RandomState(seed)
+    n_features = len(model_bundle.feature_order(DIM))
+    X = random.normal(loc = 3.0, scale = 2.0, size = (200, n_features))
+    y = (X[:, 0] + X[:, -1] > 6).astype(int)
+    scaler = StandardScaler().fit(X)
+    forest = RandomForestClassifier(n_estimators = 10, random_state = seed).fit(
+        scaler.transform(X), y)
+    word2vec = {'vocab': {'method': 0, 'signal': 1, 'filter': 2},
+                'vectors': random.normal(size = (3, DIM)).astype(np.float32)}
+    return X, forest, scaler, word2vec
+
+
+class BundleTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'bundle')
+        self.X, self.forest, self.scaler, self.word2vec = fit_models(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def build(self, models=None, version='v1'):
+        forest, scaler, word2vec = models or (self.forest, self.scaler, self.word2vec)
+        return model_bundle.build(self.path, forest, scaler, word2vec,
+                                  {'years': [2004, 2007], 'patents': 200}, version)
+
+    def test_round_trip(self):
+        self.build()
+        bundle = model_bundle.open_bundle(self.path, verify = True)
+        self.assertEqual(bundle.version, 'v1')
+        scaler = bundle.get('scaler')
+        np.testing.assert_array_equal(scaler.transform(self.X), self.scaler.transform(self.X))
+        np.testing.assert_allclose(
+            forest_compiler.predict_proba(bundle.get('model'), scaler.transform(self.X)),
+            self.forest.predict_proba(self.scaler.transform(self.X)), rtol = 0, atol = 1e-12)
+        vectors = bundle.get('word2vec')
+        self.assertEqual(vectors['vocab'], self.word2vec['vocab'])
+        np.testing.assert_array_equal(vectors['vectors'], self.word2vec['vectors'])
+
+    def test_checksum_mismatch(self):
+        self.build()
+        # same size, different content
+        path = os.path.join(self.path, 'scaler', 'mean.npy')
+        with open(path, 'r+b') as f:
+            f.seek(-1, 2)
+            last = f.read(1)
+            f.seek(-1, 2)
+            f.write(b'\x00' if last != b'\x00' else b'\x01')
+        self.assertEqual(model_bundle.open_bundle(self.path).verify(), ['scaler/mean.npy'])
+        self.assertRaises(model_bundle.BundleError, model_bundle.open_bundle, self.path, True)
+
+    def test_truncated_file(self):
+        self.build()
+        with open(os.path.join(self.path, 'forest', 'threshold.npy'), 'ab') as f:
+            f.write(b'\x00')
+        self.assertRaises(model_bundle.BundleError, model_bundle.open_bundle, self.path)
+
+    def test_incompatible_manifest(self):
+        self.build()
+        manifest_path = os.path.join(self.path, 'manifest.json')
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        for change in [{'format_version': 99},
+                       {'features': dict(manifest['features'], counts = ['num_claims'])},
+                       {'features': dict(manifest['features'], n_features = 12)}]:
+            with open(manifest_path, 'w') as f:
+                json.dump(dict(manifest, **change), f)
+            self.assertRaises(model_bundle.BundleError, model_bundle.open_bundle, self.path)
+
+    def test_wrong_number_of_predictors(self):
+        from sklearn.preprocessing import StandardScaler
+        scaler = StandardScaler().fit(self.X[:, :-1])
+        self.assertRaises(model_bundle.BundleError, self.build,
+                          (self.forest, scaler, self.word2vec))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_rebuild_while_loaded(self):
+        self.build()
+        old = model_bundle.open_bundle(self.path)
+        old_model = old.get('model')
+        old_proba = forest_compiler.predict_proba(old_model, self.scaler.transform(self.X))
+
+        X, forest, scaler, word2vec = fit_models(1)
+        self.build((forest, scaler, word2vec), 'v2')
+        new = model_bundle.open_bundle(self.path)
+        self.assertEqual(new.version, 'v2')
+        self.assertNotEqual(new.path, old.path)
+
+        # the opened bundle still reads its own version, lazily loaded
+        # components included
+        np.testing.assert_array_equal(
+            forest_compiler.predict_proba(old_model, self.scaler.transform(self.X)), old_proba)
+        np.testing.assert_array_equal(old.get('scaler').mean_, self.scaler.mean_)
+        np.testing.assert_array_equal(new.get('scaler').mean_, scaler.mean_)
+
+        self.build(version = 'v3')
+        self.assertEqual(len(versioned_folder.versions(self.path)), versioned_folder.KEEP)
+
+    def test_publish_while_opening(self):
+        self.build()
+        old_folder = versioned_folder.resolve(self.path)
+        X, forest, scaler, word2vec = fit_models(1)
+        self.build((forest, scaler, word2vec), 'v2')
+
+        # the link moves to v2 after the bundle resolved v1
+        resolve = versioned_folder.resolve
+        versioned_folder.resolve = lambda path: old_folder
+        try:
+            bundle = model_bundle.open_bundle(self.path)
+        finally:
+            versioned_folder.resolve = resolve
+        self.assertEqual(bundle.version, 'v1')
+        np.testing.assert_array_equal(bundle.get('scaler').mean_, self.scaler.mean_)
+
+
+if __name__ == '__main__':
+    unittest.main()
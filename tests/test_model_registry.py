@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import logging
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask', 'flaskexample'))
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+import model_registry
+import model_bundle
+import versioned_folder
+from test_model_bundle import fit_models
+
+
+class BundleRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'bundle')
+        self.check_interval = model_registry.CHECK_INTERVAL
+        model_registry.CHECK_INTERVAL = 0
+        # the separate model files are not registered with a bundle
+        self.separate = dict((name, model_registry._artifacts.pop(name))
+                             for name in model_bundle.COMPONENTS
+                             if name in model_registry._artifacts)
+        logging.getLogger('flaskexample.model_registry').disabled = True
+
+    def tearDown(self):
+        model_registry.CHECK_INTERVAL = self.check_interval
+        model_registry._artifacts.pop('bundle', None)
+        model_registry._artifacts.update(self.separate)
+        logging.getLogger('flaskexample.model_registry').disabled = False
+        shutil.rmtree(self.folder)
+
+    def build(self, seed, version):
+        X, forest, scaler, word2vec = fit_models(seed)
+        model_bundle.build(self.path, forest, scaler, word2vec, None, version)
+        return scaler
+
+    def register(self):
+        model_registry.register('bundle', os.path.join(self.path, 'manifest.json'),
+                                loader = model_registry.load_bundle)
+
+    def test_components_of_one_version(self):
+        scaler = self.build(0, 'v1')
+        self.register()
+        used = model_registry.get_models()
+        self.assertEqual(sorted(used), sorted(model_bundle.COMPONENTS))
+        self.assertEqual(list(used['scaler'].mean_), list(scaler.mean_))
+        # the components are also available by name
+        self.assertIs(model_registry.get('scaler'), used['scaler'])
+
+        new_scaler = self.build(1, 'v2')
+        # the manifest of the new version may keep the mtime and size
+        os.utime(os.path.join(self.path, 'manifest.json'), (1, 1))
+        used = model_registry.get_models()
+        self.assertEqual(model_registry.get('bundle').version, 'v2')
+        self.assertEqual(list(used['scaler'].mean_), list(new_scaler.mean_))
+        self.assertIs(used['model'], model_registry.get('bundle').get('model'))
+
+    def test_failed_reload_keeps_serving(self):
+        self.build(0, 'v1')
+        self.register()
+        loaded = model_registry.get('bundle')
+
+        # a new version with a manifest this code cannot use
+        folder = versioned_folder.new_version(self.path)
+        with open(os.path.join(folder, 'manifest.json'), 'w') as f:
+            json.dump({'format_version': 99}, f)
+        versioned_folder.publish(self.path, folder)
+
+        self.assertIs(model_registry.get('bundle'), loaded)
+        self.assertIs(model_registry.get_models()['model'], loaded.get('model'))
+        self.assertEqual(model_registry.stats()['bundle']['version'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
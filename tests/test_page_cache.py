@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import page_cache
+
+
+class PageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = page_cache.open_cache(self.folder, ttl = 0, max_bytes = 10**9,
+                                           offline = False)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def table_size(self):
+        con = sqlite3.connect(self.cache['path'])
+        try:
+            return con.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+        finally:
+            con.close()
+
+    def page(self, i, length=2000):
+        return ''.join(chr(65 + (i * 7 + j * j) % 26) for j in range(length))
+
+    def test_size_counter_matches_table(self):
+        for i in range(5):
+            page_cache.put('url%d' % i, self.page(i), self.cache)
+        # replaced pages are subtracted once
+        page_cache.put('url0', self.page(9, 5000), self.cache)
+        self.assertEqual(page_cache.stats(self.cache)['bytes'], self.table_size())
+
+        self.cache['max_bytes'] = self.table_size() - 1
+        page_cache.put('url5', self.page(5), self.cache)
+        self.assertLessEqual(page_cache.stats(self.cache)['bytes'], self.cache['max_bytes'])
+        self.assertEqual(page_cache.stats(self.cache)['bytes'], self.table_size())
+
+    def test_concurrent_writers_keep_the_counter(self):
+        self.cache['max_bytes'] = 12000
+
+        def work(n):
+            for i in range(30):
+                page_cache.put('url%d' % (i % 8), self.page(i + n), self.cache)
+
+        threads = [threading.Thread(target = work, args = (n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(page_cache.stats(self.cache)['bytes'], self.table_size())
+
+    def test_hits_do_not_write(self):
+        page_cache.put('url0', self.page(0), self.cache)
+        con = page_cache._connect(self.cache)
+        changes = con.total_changes
+        self.assertEqual(page_cache.get('url0', self.cache), self.page(0))
+        self.assertEqual(con.total_changes, changes)
+        self.assertIn('url0', self.cache['touched'])
+
+        page_cache._flush_touched(con, self.cache, force = True)
+        self.assertEqual(self.cache['touched'], {})
+        self.assertEqual(con.total_changes, changes + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
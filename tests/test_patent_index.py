@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patent_index
+import versioned_folder
+
+
+class PatentIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'patent_index')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def save(self, ids):
+        predictors = np.arange(len(ids) * 113, dtype = np.float32).reshape((len(ids), 113))
+        patent_index.save_index(self.path, ids, ['title ' + i for i in ids], predictors)
+
+    def test_lookup(self):
+        self.save(['US1', 'US2'])
+        index = patent_index.load_index(os.path.join(self.path, 'predictors.npy'))
+        title, predictors = patent_index.lookup(index, 'US2')
+        self.assertEqual(title, 'title US2')
+        self.assertEqual(predictors[0, 0], 113)
+        self.assertIsNone(patent_index.lookup(index, 'US3'))
+
+    def test_rebuild_keeps_loaded_version_consistent(self):
+        self.save(['US1', 'US2'])
+        old = patent_index.load_index(os.path.join(self.path, 'predictors.npy'))
+        self.save(['US3', 'US4', 'US5'])
+        new = patent_index.load_index(os.path.join(self.path, 'predictors.npy'))
+
+        self.assertEqual(len(old['titles']), old['predictors'].shape[0])
+        self.assertEqual(sorted(new['rows']), ['US3', 'US4', 'US5'])
+        self.assertEqual(new['predictors'].shape[0], 3)
+
+    def test_old_versions_removed(self):
+        for i in range(4):
+            self.save(['US%d' % i])
+        self.assertEqual(len(versioned_folder.versions(self.path)), versioned_folder.KEEP)
+        self.assertTrue(os.path.islink(self.path))
+
+    def test_unversioned_folder_replaced(self):
+        os.makedirs(self.path)
+        with open(os.path.join(self.path, 'ids.json'), 'w') as f:
+            json.dump(['OLD'], f)
+        self.save(['US1'])
+        index = patent_index.load_index(os.path.join(self.path, 'predictors.npy'))
+        self.assertEqual(list(index['rows']), ['US1'])
+
+    def test_word2vec_version(self):
+        import claim_cache
+
+        vocab = {'method': 0, 'signal': 1}
+        model = {'vocab': vocab, 'vectors': np.eye(2, 100, dtype = np.float32)}
+        other = {'vocab': vocab, 'vectors': np.eye(2, 100, 1, dtype = np.float32)}
+        predictors = np.ones((1, 113), dtype = np.float32)
+        patent_index.save_index(self.path, ['US1'], ['t'], predictors,
+                                claim_cache.model_version(model))
+        index = patent_index.load_index(os.path.join(self.path, 'predictors.npy'))
+        self.assertTrue(patent_index.built_with(index, model))
+        self.assertFalse(patent_index.built_with(index, other))
+
+        # indexes saved without a version are not used
+        self.save(['US1'])
+        index = patent_index.load_index(os.path.join(self.path, 'predictors.npy'))
+        self.assertFalse(patent_index.built_with(index, model))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'flask', 'flaskexample'))
+import model_registry
+import prediction_cache
+
+
+FORM = {'title': 'A method', 'patent_class': 'G', 'num_authors': '3',
+        'num_applications': '2', 'patent_citations': '15', 'non_patent_citations': '4',
+        'num_claims': '20', 'num_similar_doc': '8', 'claims': 'a method of processing'}
+
+
+class KeysTest(unittest.TestCase):
+    def test_patent_key(self):
+        self.assertEqual(prediction_cache.patent_key('US7948209B2'), 'patent:US7948209B2')
+        self.assertNotEqual(prediction_cache.patent_key('US1'),
+                            prediction_cache.manual_key(FORM))
+
+    def test_equivalent_forms_share_key(self):
+        form = dict(FORM, title = 'Another title', patent_class = ' g ',
+                    num_authors = '3.0', claims = ' a  method\nof processing ')
+        self.assertEqual(prediction_cache.manual_key(form), prediction_cache.manual_key(FORM))
+
+    def test_different_inputs_change_key(self):
+        for field, value in [('claims', 'a device'), ('num_claims', '21'),
+                             ('patent_class', 'H')]:
+            form = dict(FORM)
+            form[field] = value
+            self.assertNotEqual(prediction_cache.manual_key(form),
+                                prediction_cache.manual_key(FORM), field)
+
+
+class BackendTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.fingerprint = ['v1']
+        self.original = model_registry.fingerprint
+        model_registry.fingerprint = lambda names=None: self.fingerprint[0]
+
+    def tearDown(self):
+        model_registry.fingerprint = self.original
+        prediction_cache.set_backend(None)
+        shutil.rmtree(self.folder)
+
+    def check_backend(self, backend):
+        prediction_cache.set_backend(backend)
+        key = prediction_cache.patent_key('US1')
+        self.assertIsNone(prediction_cache.get(key))
+        prediction_cache.put(key, {'proba': [0.25, 0.75]})
+        self.assertEqual(prediction_cache.get(key), {'proba': [0.25, 0.75]})
+
+        # new models: the cached predictions are not read
+        self.fingerprint[0] = 'v2'
+        self.assertIsNone(prediction_cache.get(key))
+
+    def test_memory_backend(self):
+        backend = prediction_cache.MemoryBackend(max_size = 10)
+        self.check_backend(backend)
+        self.assertEqual(len(backend), 0)
+
+    def test_sqlite_backend(self):
+        self.check_backend(prediction_cache.SqliteBackend(
+            os.path.join(self.folder, 'predictions.sqlite'), max_size = 10))
+
+    def test_sqlite_keeps_entries_of_other_workers(self):
+        path = os.path.join(self.folder, 'predictions.sqlite')
+        prediction_cache.set_backend(prediction_cache.SqliteBackend(path))
+        key = prediction_cache.patent_key('US1')
+        prediction_cache.put(key, {'proba': [0.5, 0.5]})
+
+        # another worker writes a prediction of the new models first
+        self.fingerprint[0] = 'v2'
+        other = prediction_cache.SqliteBackend(path)
+        other.put(prediction_cache._versioned_key(key), {'proba': [0.25, 0.75]})
+        prediction_cache.set_backend(prediction_cache.SqliteBackend(path))
+        prediction_cache._state['fingerprint'] = 'v1'
+
+        self.assertEqual(prediction_cache.get(key), {'proba': [0.25, 0.75]})
+
+    def test_sqlite_size_limit(self):
+        backend = prediction_cache.SqliteBackend(os.path.join(self.folder, 'p.sqlite'),
+                                                 max_size = 3)
+        for i in range(5):
+            backend.put('k%d' % i, i)
+        self.assertEqual(len(backend), 3)
+        self.assertIsNone(backend.get('k0'))
+        self.assertEqual(backend.get('k4'), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import similar_patents
+import versioned_folder
+
+
+def random_vectors(n, dim=16, seed=0):
+    return similar_patents.normalize(np.random.RandomState(seed).normal(size = (n, dim)))
+
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        self.vectors = random_vectors(300)
+        self.queries = np.random.RandomState(1).normal(size = (25, 16))
+        self.index = {'vectors': self.vectors}
+
+    def check_exact(self, rows, scores, k, exclude=None):
+        expected = similar_patents.brute_force(self.vectors, self.queries, k + 1)[0]
+        for i in range(len(self.queries)):
+            wanted = [row for row in expected[i]
+                      if exclude is None or row != exclude[i]][:k]
+            self.assertEqual(list(rows[i]), wanted)
+        # similarities in decreasing order
+        self.assertTrue(np.all(np.diff(scores, axis = 1) <= 0))
+
+    def test_matches_brute_force(self):
+        rows, scores = similar_patents.search(self.index, self.queries, 10)
+        self.check_exact(rows, scores, 10)
+        np.testing.assert_allclose(
+            scores, np.dot(similar_patents.normalize(self.queries),
+                           self.vectors.T)[np.arange(25)[:, None], rows], rtol = 1e-5)
+
+    def test_block_edges(self):
+        # blocks smaller than k, not dividing the patents or the queries
+        for block_size, query_block_size in [(1, 1), (7, 3), (10, 25), (299, 24), (1000, 1000)]:
+            rows, scores = similar_patents.search(self.index, self.queries, 10,
+                                                  block_size = block_size,
+                                                  query_block_size = query_block_size)
+            self.check_exact(rows, scores, 10)
+
+    def test_exclusion(self):
+        # each query leaves out its own best patent (and one query none)
+        best = similar_patents.brute_force(self.vectors, self.queries, 1)[0][:, 0]
+        exclude = best.copy()
+        exclude[0] = -1
+        for block_size in [7, similar_patents.BLOCK_SIZE]:
+            rows, scores = similar_patents.search(self.index, self.queries, 5, exclude,
+                                                  block_size = block_size)
+            self.check_exact(rows, scores, 5, exclude)
+            self.assertEqual(rows[0, 0], best[0])
+
+    def test_more_neighbours_than_patents(self):
+        index = {'vectors': self.vectors[:4]}
+        rows, scores = similar_patents.search(index, self.queries[:3], 10)
+        self.assertEqual(rows.shape, (3, 4))
+        for query_rows in rows:
+            self.assertEqual(sorted(query_rows), [0, 1, 2, 3])
+
+    def test_clustered_recall(self):
+        vectors = random_vectors(2000, seed = 2)
+        order, centroids, offsets = similar_patents.cluster(vectors, 16)
+        index = {'vectors': vectors[order], 'centroids': centroids, 'offsets': offsets}
+        self.assertEqual(offsets[-1], len(vectors))
+
+        # probing every cluster is exact
+        rows = similar_patents.search(index, self.queries, 10, n_probe = 16)[0]
+        expected = similar_patents.brute_force(index['vectors'], self.queries, 10)[0]
+        np.testing.assert_array_equal(rows, expected)
+
+        # probing some clusters finds most of the neighbours
+        result = similar_patents.benchmark(index, self.queries, 10, n_probes = (0, 8))
+        self.assertEqual(result[0]['recall'], 1.0)
+        self.assertGreater(result[1]['recall'], 0.8)
+
+    def test_similar_drops_missing_results(self):
+        index = {'vectors': self.vectors[:3], 'ids': ['US1', 'US2', 'US3'],
+                 'titles': ['a', 'b', 'c'], 'centroids': None}
+        results = similar_patents.similar(index, self.queries[:1], 3, [1])
+        self.assertEqual(sorted(item['patent_number'] for item in results[0]), ['US1', 'US3'])
+
+
+class IndexFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'similar_index')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_save_load(self):
+        vectors = random_vectors(50)
+        ids = ['US%d' % i for i in range(50)]
+        similar_patents.save_index(self.path, ids, ['t%d' % i for i in range(50)],
+                                   vectors * 3, n_clusters = 4)
+        index = similar_patents.load_index(os.path.join(self.path, 'vectors.npy'))
+        self.assertEqual(sorted(index['ids']), sorted(ids))
+        row = index['rows']['US7']
+        self.assertEqual(index['titles'][row], 't7')
+        np.testing.assert_allclose(index['vectors'][row], vectors[7], rtol = 1e-5)
+        self.assertEqual(len(index['centroids']), 4)
+
+    def test_rebuild_keeps_loaded_version(self):
+        similar_patents.save_index(self.path, ['US1', 'US2'], ['a', 'b'], random_vectors(2))
+        old = similar_patents.load_index(os.path.join(self.path, 'vectors.npy'))
+        similar_patents.save_index(self.path, ['US3', 'US4', 'US5'], ['c', 'd', 'e'],
+                                   random_vectors(3), n_clusters = 2)
+
+        # the loaded index still reads the files of its version
+        self.assertEqual(old['ids'], ['US1', 'US2'])
+        self.assertEqual(len(old['vectors']), 2)
+        self.assertIsNone(old['centroids'])
+        new = similar_patents.load_index(os.path.join(self.path, 'vectors.npy'))
+        self.assertEqual(sorted(new['ids']), ['US3', 'US4', 'US5'])
+        self.assertEqual(len(versioned_folder.versions(self.path)), 2)
+
+        # the files of a version never change after it is published
+        with open(os.path.join(versioned_folder.versions(self.path)[0], 'ids.json')) as f:
+            self.assertEqual(json.load(f), ['US1', 'US2'])
+
+    def test_word2vec_version_of_the_patent_index(self):
+        import claim_cache
+        import patent_index
+
+        model = {'vocab': {'method': 0}, 'vectors': np.ones((1, 100), dtype = np.float32)}
+        index_path = os.path.join(self.folder, 'patent_index')
+        patent_index.save_index(index_path, ['US1', 'US2'], ['a', 'b'],
+                                np.ones((2, 113), dtype = np.float32),
+                                claim_cache.model_version(model))
+        similar_patents.build_from_patent_index(index_path, self.path)
+        index = similar_patents.load_index(os.path.join(self.path, 'vectors.npy'))
+        self.assertTrue(patent_index.built_with(index, model))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import word_vectors
+import versioned_folder
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'word2vec_vectors')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def model(self, words, seed):
+        vectors = np.random.RandomState(seed).normal(size = (len(words), 4))
+        return {'vocab': dict((word, i) for i, word in enumerate(words)),
+                'vectors': vectors.astype(np.float32)}
+
+    def test_export_and_load(self):
+        model = self.model(['method', 'signal', 'sensor'], 0)
+        word_vectors.export_vectors(model, self.path, ('float32', 'int8'))
+        loaded = word_vectors.load_vectors(self.path)
+        self.assertEqual(loaded['vocab'], model['vocab'])
+        np.testing.assert_array_equal(loaded['vectors'], model['vectors'])
+
+        quantized = word_vectors.load_vectors(self.path, 'int8')
+        np.testing.assert_allclose(quantized['vectors'] * quantized['scales'][:, None],
+                                   model['vectors'], atol = 0.05)
+
+    def test_re_export_keeps_loaded_version(self):
+        old_model = self.model(['method', 'signal'], 0)
+        word_vectors.export_vectors(old_model, self.path)
+        old = word_vectors.load_vectors(self.path)
+        new_model = self.model(['sensor', 'filter', 'carrier'], 1)
+        word_vectors.export_vectors(new_model, self.path)
+
+        # the loaded vocabulary and matrix are still those of one export
+        self.assertEqual(old['vocab'], old_model['vocab'])
+        np.testing.assert_array_equal(old['vectors'], old_model['vectors'])
+        new = word_vectors.load_vectors(self.path)
+        self.assertEqual(new['vocab'], new_model['vocab'])
+        self.assertEqual(len(new['vectors']), 3)
+        self.assertTrue(os.path.islink(self.path))
+        self.assertEqual(len(versioned_folder.versions(self.path)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
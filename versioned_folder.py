@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+
+##### Folders replaced atomically by a new version #####
+# an index or model folder is a symbolic link to a versioned folder next to
+# it; a new version is written completely into its own folder, then the link
+# is replaced by one rename, so a reader that resolves the link once sees
+# either all the old files or all the new ones, never a mix
+#
+# layout:
+#   models/patent_index -> patent_index@20261018-113136-482913
+#   models/patent_index@20261018-113136-482913/...
+#   models/patent_index@20261017-090211-104377/...   previous version
+
+
+# versions kept (the current one and the previous one, which readers that
+# resolved the link before the switch may still be reading)
+KEEP = 2
+
+
+### function to create the folder of a new version
+# input: path of the published folder (the link)
+# output: new empty folder to write the version into
+def new_version(path):
+    path = path.rstrip('/')
+    now = time.time()
+    folder = '%s@%s-%06d' % (path, time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+                             int(now * 1e6) % 10**6)
+    os.makedirs(folder)
+    return folder
+
+
+### function to list the versions of a folder, oldest first
+def versions(path):
+    path = path.rstrip('/')
+    parent = os.path.dirname(path) or '.'
+    prefix = os.path.basename(path) + '@'
+    return sorted(os.path.join(parent, name) for name in os.listdir(parent)
+                  if name.startswith(prefix) and not name.endswith('.tmp'))
+
+
+### function to make a written version the published one
+# a real folder at the path (written before versioned folders) is kept as
+# the oldest version
+# input: path of the published folder, folder of the new version
+def publish(path, folder):
+    path = path.rstrip('/')
+    link = path + '@link.tmp'
+    if os.path.lexists(link):
+        os.remove(link)
+    # relative target, so the models folder can be moved
+    os.symlink(os.path.basename(folder), link)
+    if os.path.isdir(path) and not os.path.islink(path):
+        os.rename(path, path + '@00000000-000000-000000')
+    os.rename(link, path)
+
+    for old in versions(path)[:-KEEP]:
+        if os.path.realpath(old) != os.path.realpath(path):
+            shutil.rmtree(old, ignore_errors = True)
+
+
+### function to resolve the published folder once
+# readers open all their files from the resolved folder
+def resolve(path):
+    return os.path.realpath(path.rstrip('/'))
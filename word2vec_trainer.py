@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import json
+import time
+import pickle
+import argparse
+import multiprocessing
+import feature_store
+import claim_cache
+
+##### Word2vec training from tokenized shards on disk #####
+# the claims of the feature store are tokenized by a pool of processes
+# into shard files (one patent per line, tokens separated by spaces), and
+# the word2vec model is trained on a stream over the shards, so only one
+# year of raw claims and one line of tokens are in memory at a time
+#
+# shards, the corpus manifest and the model are written to a temporary
+# file and renamed when complete, so an interrupted tokenization restarts
+# where it stopped and the model registry never reloads a half written
+# model; the stream is read again from the first shard for the vocabulary
+# and for every epoch
+#
+# the model is saved with Word2Vec.save, the format format_claims and the
+# model registry load (word_vectors.py exports it for the webapp), as one
+# file (no separate .npy files, which could not be renamed together)
+#
+# layout of a corpus folder:
+#   year=2004-00000.txt   tokens of the patents of 2004, shard 0
+#   corpus.json           number of patents and tokens of each shard
+
+
+# parameters of the model of word2vec_training.ipynb
+SIZE = 100
+WINDOW = 5
+MIN_COUNT = 5
+EPOCHS = 5
+
+
+### function to get the path of a shard
+def shard_path(folder, year, index):
+    return os.path.join(folder, 'year=%d-%05d.txt' % (year, index))
+
+
+### function to list the complete shards of a corpus folder, in order
+def shard_paths(folder):
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if name.startswith('year=') and name.endswith('.txt'))
+
+
+### function to write a JSON file by renaming a complete temporary file
+def _write_json(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent = 1, sort_keys = True)
+    os.rename(path + '.tmp', path)
+
+
+### function to tokenize the claims of one shard and write them
+# runs in the processes of the pool
+# input: (shard path, list of claim texts)
+# output: shard path, number of patents, number of tokens
+def _write_shard(job):
+    path, texts = job
+    n_tokens = 0
+    # claims tokenized before (e.g. by an earlier corpus) come from the cache
+    token_lists = claim_cache.tokenize(texts, processes = 1)
+    with io.open(path + '.tmp', 'w', encoding = 'utf-8') as f:
+        for tokens in token_lists:
+            n_tokens += len(tokens)
+            f.write(u' '.join(tokens) + u'\n')
+    os.rename(path + '.tmp', path)
+    return path, len(texts), n_tokens
+
+
+### function to tokenize the claims of a feature store into shards
+# shards already written by an earlier run are kept (a corpus folder must
+# always be written from the same store, years and excluded ids)
+# input: store folder, corpus folder, years (all by default), patents per shard,
+#        number of processes (number of cores by default),
+#        ids to leave out (e.g. the testing patents)
+# output: dictionary with the patents and tokens written, the shards
+#         written and kept, and the seconds spent
+def write_shards(store, folder, years=None, shard_size=1000, processes=None, exclude=None):
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    exclude = set(exclude or [])
+    manifest_path = os.path.join(folder, 'corpus.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+    stats = {'patents': 0, 'tokens': 0, 'written': 0, 'kept': 0}
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for year in (years or feature_store.years(store)):
+            # one year of claims in memory at a time
+            arrays, _ = feature_store.read_arrays(store, ['id', 'claims'], [year], mmap = None)
+            texts = [text for patent_id, text in zip(arrays['id'][0], arrays['claims'][0])
+                     if patent_id not in exclude]
+
+            jobs = []
+            for index, first in enumerate(range(0, len(texts), shard_size)):
+                path = shard_path(folder, year, index)
+                if os.path.exists(path) and os.path.basename(path) in manifest:
+                    stats['kept'] += 1
+                    continue
+                jobs.append((path, texts[first:first + shard_size]))
+
+            for path, n_patents, n_tokens in pool.imap_unordered(_write_shard, jobs):
+                manifest[os.path.basename(path)] = {'patents': n_patents, 'tokens': n_tokens}
+                stats['patents'] += n_patents
+                stats['tokens'] += n_tokens
+                stats['written'] += 1
+                # record the finished shards as they complete
+                _write_json(manifest_path, manifest)
+    finally:
+        pool.close()
+        pool.join()
+    stats['seconds'] = time.time() - start
+
+    return stats
+
+
+### stream of the tokenized patents of a corpus folder
+# every iteration reads the shards again from the start (gensim iterates
+# once for the vocabulary and once per epoch)
+class ShardCorpus(object):
+    def __init__(self, folder):
+        self.paths = shard_paths(folder)
+
+    def __iter__(self):
+        for path in self.paths:
+            with io.open(path, 'r', encoding = 'utf-8') as f:
+                for line in f:
+                    yield line.split()
+
+
+### function to train the word2vec model on a corpus folder
+# input: corpus folder, model file, parameters of the model,
+#        number of training threads (number of cores by default)
+# output: trained model, dictionary with the vocabulary and training
+#         times and the words per second
+def train(folder, output, size=SIZE, window=WINDOW, min_count=MIN_COUNT,
+          epochs=EPOCHS, workers=None, seed=1):
+    from gensim.models import Word2Vec
+
+    corpus = ShardCorpus(folder)
+    workers = workers or multiprocessing.cpu_count()
+    model = Word2Vec(size = size, window = window, min_count = min_count,
+                     workers = workers, iter = epochs, seed = seed)
+
+    start = time.time()
+    model.build_vocab(corpus)
+    vocab_seconds = time.time() - start
+
+    start = time.time()
+    effective_words, raw_words = model.train(corpus, total_examples = model.corpus_count,
+                                             epochs = model.iter)
+    train_seconds = time.time() - start
+
+    # saved to an open file, gensim writes the arrays in the same file
+    with open(output + '.tmp', 'wb') as f:
+        model.save(f)
+    os.rename(output + '.tmp', output)
+
+    stats = {
+        'shards': len(corpus.paths),
+        'patents': model.corpus_count,
+        'vocabulary': len(model.wv.vocab),
+        'workers': workers,
+        'epochs': model.iter,
+        'vocab_seconds': vocab_seconds,
+        'train_seconds': train_seconds,
+        'raw_words': raw_words,
+        'effective_words': effective_words,
+        # raw words: all the tokens read, effective: tokens kept after
+        # min_count and downsampling
+        'raw_words_per_second': raw_words / train_seconds,
+        'effective_words_per_second': effective_words / train_seconds,
+    }
+    _write_json(output + '.stats.json', stats)
+
+    return model, stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description = 'Train the word2vec model of the claims from tokenized shards')
+    parser.add_argument('--store', help = 'feature store with the claims '
+                        '(tokenized into the corpus folder first)')
+    parser.add_argument('--years', type = int, nargs = '+', default = None)
+    parser.add_argument('--exclude', help = 'pickled list of patent numbers to leave out')
+    parser.add_argument('--corpus', required = True, help = 'folder of the shards')
+    parser.add_argument('--shard-size', type = int, default = 1000)
+    parser.add_argument('--processes', type = int, default = None,
+                        help = 'tokenization processes (number of cores by default)')
+    parser.add_argument('-o', '--output', default = 'models/word2vec_claims_final')
+    parser.add_argument('--workers', type = int, default = None,
+                        help = 'training threads (number of cores by default)')
+    parser.add_argument('--size', type = int, default = SIZE)
+    parser.add_argument('--window', type = int, default = WINDOW)
+    parser.add_argument('--min-count', type = int, default = MIN_COUNT)
+    parser.add_argument('--epochs', type = int, default = EPOCHS)
+    args = parser.parse_args(argv)
+
+    if args.store:
+        exclude = None
+        if args.exclude:
+            with open(args.exclude, 'rb') as f:
+                exclude = pickle.load(f)
+        stats = write_shards(args.store, args.corpus, args.years, args.shard_size,
+                             args.processes, exclude)
+        print('tokenized %d patents (%d tokens) into %d shards in %.1fs, %d shards kept'
+              % (stats['patents'], stats['tokens'], stats['written'], stats['seconds'],
+                 stats['kept']))
+
+    model, stats = train(args.corpus, args.output, args.size, args.window,
+                         args.min_count, args.epochs, args.workers)
+    print('trained on %d patents, %d words in the vocabulary, %.1fs: '
+          '%.0f words/s (%.0f effective words/s) with %d threads'
+          % (stats['patents'], stats['vocabulary'], stats['train_seconds'],
+             stats['raw_words_per_second'], stats['effective_words_per_second'],
+             stats['workers']))
+
+
+if __name__ == '__main__':
+    main()